@@ -1,5 +1,6 @@
 import torch
-from typing import List, Dict, Type, final, Union
+from typing import Iterator, List, Dict, Optional, Type, final, Union
+import os
 import re
 from abc import ABCMeta, abstractmethod
 from model import QwModel
@@ -10,7 +11,13 @@ from transformers import PreTrainedTokenizerBase
 import base64
 import io
 from PIL import Image
-from qwen_vl_utils import process_vision_info
+from scheduler import CancelToken, GenerationRequest, QueueFullError
+from streaming import IncrementalDecoder
+from session_store import SessionStore
+from engines import GenerationParams
+from native import run_blocking
+from semantic_cache import answered_request
+from metrics import observe_request
 
 
 LOGGER = MyLogger()
@@ -43,40 +50,73 @@ class FlyweightMeta(type):
 class Bot():
 
     __metaclass__ = ABCMeta
+    # 与 /chat 请求里的 bot_type 一致，用于选择生成配置
+    bot_type = 'default'
 
     def __init__(self, qw_model: QwModel, max_history: int = 4) -> None:
         self.tokenizer = qw_model.tokenizer
         self.model = qw_model.model
         self.processor = qw_model.processor  # 添加processor
-        self.user_histories: Dict[str, List[Dict[str, str]]] = {}
+        # 生成交给推理引擎（本进程内的模型、OpenAI 兼容服务或压测用的假引擎），由配置决定
+        self.engine = qw_model.engine
+        # 相同问题（同一 Bot、同样的历史和参数）复用已有回答，未开启时为 None
+        self.response_cache = qw_model.response_cache
+        # 与已知问题足够相似的首轮问题直接用已有回答，未开启时为 None
+        self.semantic_cache = qw_model.semantic_cache
+        # token 预算、停止串、截止时间和采样参数
+        self.profile = qw_model.generation_profile(self.bot_type)
+        self._prefix_ids = None  # 默认 system prompt 渲染后的 token，懒加载
+        self._chat_format_ids = None
+        # 有上限、会淘汰空闲会话的存储，用法与 dict 相同
+        self.user_histories: SessionStore = qw_model.create_session_store(type(self).__name__)
         self.max_history = max_history
+        # 上次读取提示词时的设置版本，设置没有变化时 refresh_system_prompt 直接返回
+        self._settings_version = settings_manager.current_version()
     @abstractmethod
     def generate_response(self, user_id: str, new_messages: List[Dict[str, Union[str, dict]]], max_length: int) -> str:
         pass  
 
     @final
     def _prepare_multimodal_history(self, user_id: str, new_messages: List[Dict[str, Union[str, dict]]], 
-                                   system_prompt: Dict[str, str], max_input_tokens: int = 2048) -> List[Dict[str, Union[str, dict]]]:
-        """处理包含多模态数据的历史消息"""
-        if user_id not in self.user_histories:
-            self.user_histories[user_id] = [system_prompt]
-
-        history = self.user_histories[user_id]
-        history.extend(new_messages)
-        history = [system_prompt] + history[1:][-self.max_history:]
-
-        # 处理多模态数据
-        processed_history = []
-        for msg in history:
-            if isinstance(msg.get('content'), dict):
+                                   system_prompt: Dict[str, str]) -> List[Dict[str, Union[str, dict]]]:
+        """处理包含多模态数据的历史消息
+
+        最近 max_history 条历史中保存过的图片/视频重新放回对应的消息里，追问时不需要重新上传；
+        这些媒体的预处理结果和视觉编码结果都有缓存，不会重新解码或重新经过 ViT。不改动已保存的历史。
+        """
+        # 先检查队列，避免请求被拒绝时用户消息已经写进历史
+        self.engine.check_capacity()
+        history = self.user_histories[user_id][1:] if user_id in self.user_histories else []
+
+        processed_history = [system_prompt]
+        for msg in history[-self.max_history:] + new_messages:
+            if msg.get('media'):
+                media = [item for item in msg['media'] if self._media_available(item)]
+                processed_history.append({
+                    'role': msg['role'],
+                    'content': media + [{'type': 'text', 'text': msg['content']}],
+                })
+            elif isinstance(msg.get('content'), dict):
                 # 处理包含媒体数据的消息
-                processed_msg = self._process_media_message(msg)
-                processed_history.append(processed_msg)
+                processed_history.append(self._process_media_message(msg))
             else:
-                processed_history.append(msg)
-                
+                processed_history.append({'role': msg['role'], 'content': msg['content']})
         return processed_history
-    
+
+    @staticmethod
+    def _media_available(item: Dict) -> bool:
+        # 上传目录会定期清理，已经删除的本地文件不再放回对话
+        source = item.get(item.get('type'))
+        if isinstance(source, str) and (source.startswith('file://') or source.startswith('/')):
+            return os.path.isfile(source[len('file://'):] if source.startswith('file://') else source)
+        return True
+
+    @final
+    def _session_has_media(self, user_id: str) -> bool:
+        if user_id not in self.user_histories:
+            return False
+        return any(msg.get('media') for msg in self.user_histories[user_id][1:][-self.max_history:])
+
     def _process_media_message(self, message: Dict[str, Union[str, dict]]) -> Dict[str, Union[str, dict]]:
         """处理包含多个媒体文件的消息"""
         content = message['content']
@@ -105,53 +145,33 @@ class Bot():
 
         return message
 
+    @final
+    def _multimodal_params(self, max_new_tokens: Optional[int]) -> GenerationParams:
+        # 同一批次的多模态请求共用一次 generate，采样参数相同的请求才会合批
+        return self.profile.params(max_new_tokens, multimodal=True)
+
     @final 
-    def generate_multimodal_response(self, messages, max_new_tokens=512):
+    def generate_multimodal_response(self, messages, max_new_tokens=None, user_id: str = None):
         """生成多模态响应，支持多文件输入"""
         try:
-            text = self.processor.apply_chat_template(
-                messages, tokenize=False, add_generation_prompt=True
+            request = self.stream_multimodal_response(messages, max_new_tokens, user_id)
+            result = self.tokenizer.decode(
+                request.wait(), skip_special_tokens=True, clean_up_tokenization_spaces=False
             )
-        
-            print(f"处理的消息: {messages}")  # 调试输出
-        
-            image_inputs, video_inputs = process_vision_info(messages)
-            inputs = self.processor(
-                text=[text],
-                images=image_inputs,
-                videos=video_inputs,
-                padding=True,
-                return_tensors="pt",
-            )
-            inputs = inputs.to("cuda")
-        
-            with torch.no_grad():
-                generated_ids = self.model.generate(
-                    **inputs, 
-                    max_new_tokens=max_new_tokens,
-                    min_new_tokens=20,           # 确保有足够的输出
-                    do_sample=True,              # 启用采样
-                    temperature=0.7,             # 适中的随机性
-                    top_p=0.9,                   # nucleus采样
-                    repetition_penalty=1.1,      # 减少重复
-                    pad_token_id=self.processor.tokenizer.eos_token_id
-                )
-            
-            generated_ids_trimmed = [
-                out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-            ]
-        
-            output_text = self.processor.batch_decode(
-                generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
-            )
-        
-            result = output_text[0] if output_text else ""
-            print(f"生成的响应: {result}")  # 调试输出
             return result
         
+        except QueueFullError:
+            raise
         except Exception as e:
-            print(f"多模态生成失败: {e}")
+            LOGGER.exception(f'多模态生成失败: {e}')
             return "抱歉，处理媒体文件时出现了错误。"
+
+    @final
+    def stream_multimodal_response(self, messages, max_new_tokens=None, user_id: str = None) -> GenerationRequest:
+        """多模态生成的流式版本，token 通过返回的 request 逐个取出"""
+        # 会话 id 用于按会话缓存视觉编码结果
+        return self.engine.submit_multimodal(messages, self._multimodal_params(max_new_tokens),
+                                             session_id=self._session_key(user_id) if user_id else None)
     
     @abstractmethod
     def reset_history(self, user_id: str) -> None:
@@ -159,76 +179,318 @@ class Bot():
     
     @final
     def _prepare_history(self, user_id: str, new_messages: List[Dict[str, str]], system_prompt: Dict[str, str], max_input_tokens: int = 2048, max_msg_tokens: int = 512) -> List[Dict[str, str]]:
-        if user_id not in self.user_histories:
-            self.user_histories[user_id] = [system_prompt]
-
-        history = self.user_histories[user_id]
-        history.extend(new_messages)
-        history = [system_prompt] + history[1:][-self.max_history:]
+        # 先检查队列，避免请求被拒绝时用户消息已经写进历史
+        self.engine.check_capacity()
+        # 在副本上拼接本轮消息，生成完成后由调用方写回；取消或出错时已保存的历史不受影响
+        saved = self.user_histories[user_id] if user_id in self.user_histories else [system_prompt]
+        history = [system_prompt] + (saved[1:] + list(new_messages))[-self.max_history:]
 
         # 限制每条消息的长度，然后限制总token数
-        tokenizer: PreTrainedTokenizerBase = self.tokenizer
+        # 每条消息的 token 只在第一次出现时计算，之后随历史一起保存，不会每轮重新分词
         total_tokens = 0
         limited_history = []
     
         # 从后往前加，直到不超限
         for msg in reversed(history):
             content = msg['content']
+            token_ids = self._message_ids(msg)
         
-            # 对每条消息进行长度截断
-            tokens = tokenizer(content, add_special_tokens=False, return_tensors='pt')
-            if tokens.input_ids.shape[-1] > max_msg_tokens:
-                # 截断到指定长度
-                truncated_tokens = tokens.input_ids[0][:max_msg_tokens]
-                content = tokenizer.decode(truncated_tokens, skip_special_tokens=True)
-                token_count = max_msg_tokens
-            else:
-                token_count = tokens.input_ids.shape[-1]
+            # 对每条消息进行长度截断，直接截 token，文本只在截断时解码一次
+            if len(token_ids) > max_msg_tokens:
+                token_ids = token_ids[:max_msg_tokens]
+                content = self.tokenizer.decode(token_ids, skip_special_tokens=True)
+            token_count = len(token_ids)
         
             if total_tokens + token_count > max_input_tokens:
                 break
             
             # 创建截断后的消息
-            truncated_msg = {'role': msg['role'], 'content': content}
+            truncated_msg = {'role': msg['role'], 'content': content, 'token_ids': token_ids}
             limited_history.insert(0, truncated_msg)
             total_tokens += token_count
 
         return limited_history
-    
+
+    @final
+    def _message_ids(self, msg: Dict) -> List[int]:
+        """消息内容的 token id，第一次计算后缓存在消息的 token_ids 字段里"""
+        token_ids = msg.get('token_ids')
+        if token_ids is None:
+            token_ids = self.tokenizer(msg['content'], add_special_tokens=False).input_ids
+            msg['token_ids'] = token_ids
+        return token_ids
+
     @final
-    def _generate_response(self, history: List[Dict[str, str]], max_length: int) -> str:
-        input_ids = self.tokenizer.apply_chat_template(
-        history, 
+    def _chat_format(self):
+        """ChatML 每条消息的头尾 token：(各角色的消息头, 消息尾, 模板默认补上的 system 消息)
+
+        第一次调用时用一段示例对话与 apply_chat_template 的结果比对，不一致时返回 None，
+        此时退回到用模板渲染整段文本再分词。
+        """
+        if self._chat_format_ids is None:
+            tokenizer: PreTrainedTokenizerBase = self.tokenizer
+            headers = {}
+            def header(role):
+                if role not in headers:
+                    headers[role] = tokenizer.encode(f'<|im_start|>{role}\n', add_special_tokens=False)
+                return headers[role]
+            footer = tokenizer.encode('<|im_end|>\n', add_special_tokens=False)
+
+            probe = [{'role': 'system', 'content': '你是一名物理老师。'},
+                     {'role': 'user', 'content': '你好'},
+                     {'role': 'assistant', 'content': 'Hello!'}]
+            expected = tokenizer(self._render_template(probe), add_special_tokens=False).input_ids
+            def render(messages):
+                ids = []
+                for msg in messages:
+                    ids += header(msg['role']) + self._message_ids(dict(msg)) + footer
+                return ids + header('assistant')
+
+            # 第一条消息不是 system 时（比如 system prompt 超出 token 预算被丢掉）模板会补上默认的 system prompt
+            rest = render(probe[1:])
+            user_only = tokenizer(self._render_template(probe[1:]), add_special_tokens=False).input_ids
+            default_system = user_only[:len(user_only) - len(rest)]
+            if render(probe) == expected and user_only[len(default_system):] == rest:
+                self._chat_format_ids = (header, footer, default_system)
+            else:
+                self._chat_format_ids = False
+        return self._chat_format_ids or None
+
+    @final
+    def _render_template(self, history: List[Dict[str, str]]) -> str:
+        return self.tokenizer.apply_chat_template(
+        [{'role': msg['role'], 'content': msg['content']} for msg in history], 
         tokenize=False, 
         add_generation_prompt=True,
         enable_thinking=False  # 添加这一行来启用思考模式
     )
-        model_inputs = self.tokenizer([input_ids], return_tensors='pt', padding=True, truncation=True).to('cuda')
-
-        with torch.no_grad():
-            generated_ids = self.model.generate(
-                model_inputs.input_ids,
-                max_new_tokens=100000,
-                attention_mask=model_inputs.attention_mask,
-                do_sample=True,
-                temperature=1.1,
-                top_p=0.98,
-                top_k=75,
+
+    @final
+    def _render_prompt_ids(self, history: List[Dict[str, str]]) -> List[int]:
+        """把历史拼成模型输入，直接拼接每条消息缓存的 token，省去整段重新分词"""
+        chat_format = self._chat_format()
+        if chat_format is None:
+            return self.tokenizer([self._render_template(history)], truncation=True).input_ids[0]
+        header, footer, default_system = chat_format
+        prompt_ids = [] if history and history[0]['role'] == 'system' else list(default_system)
+        for msg in history:
+            prompt_ids += header(msg['role']) + self._message_ids(msg) + footer
+        return prompt_ids + header('assistant')
+    
+    @final
+    def _submit_response(self, history: List[Dict[str, str]], max_length: Optional[int],
+                         user_id: str = None) -> GenerationRequest:
+        prompt_ids = self._render_prompt_ids(history)
+        # 请求的 max_length 不超过本 Bot 的 token 预算
+        params = self.profile.params(max_length)
+
+        question = self._first_turn_question(history)
+        if self.semantic_cache is not None and question is not None:
+            # 十万条时要扫描约 100MB 的矩阵，放到线程池里，不阻塞事件循环
+            found = run_blocking(self.semantic_cache.lookup, type(self).__name__, question)
+            if found is not None:
+                LOGGER.info(f'语义缓存命中 {found[1]:.3f}: {question}')
+                return answered_request(self.tokenizer, prompt_ids, found[0], self.bot_type)
+
+        def submit() -> GenerationRequest:
+            # 交给推理引擎，本地模型时与其他用户/其他 Bot 的请求合并成批次生成
+            return self.engine.submit(
+                prompt_ids,
+                params,
+                session_id=self._session_key(user_id) if user_id else None,
+                prefix=self._system_prefix(history),
             )
 
-        generated_ids = [
-            output_ids[len(model_inputs.input_ids[0]):] for output_ids in generated_ids
-        ]
+        if self.response_cache is None or not self.response_cache.accepts(params):
+            return submit()
+        key = self.response_cache.key(type(self).__name__, history, params)
+        return self.response_cache.get_or_submit(key, submit, self.bot_type)
 
-        response: str = self.tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
-        return response
+    @final
+    def _assistant_message(self, generated_ids: List[int]) -> Dict:
+        """生成结果转成历史消息，连同生成的 token（去掉结尾的 eos）一起保存"""
+        token_ids = list(generated_ids)
+        while token_ids and token_ids[-1] in self.engine.eos_token_ids:
+            token_ids.pop()
+        content = self.tokenizer.decode(generated_ids, skip_special_tokens=True)
+        return {'role': 'assistant', 'content': content, 'token_ids': token_ids}
+
+    @final
+    def _generate_message(self, history: List[Dict[str, str]], max_length: int, user_id: str = None) -> Dict:
+        request = self._submit_response(history, max_length, user_id)
+        message = self._assistant_message(request.wait())
+        self._remember_answer(history, request, message)
+        return message
+
+    @final
+    def _first_turn_question(self, history: List[Dict[str, str]]) -> Optional[str]:
+        """新会话的第一个问题（使用本 Bot 默认的 system prompt 时），其他情况返回 None"""
+        if len(history) != 2 or history[1]['role'] != 'user' or not isinstance(history[1]['content'], str):
+            return None
+        if history[0]['role'] != 'system' or history[0]['content'] != self.system_prompt['content']:
+            return None
+        return history[1]['content']
+
+    @final
+    def _remember_answer(self, history: List[Dict[str, str]], request: GenerationRequest, message: Dict) -> None:
+        # 完整生成（不是截断或缓存来的）的首轮回答加入语义缓存，之后相似的问题直接使用
+        question = self._first_turn_question(history)
+        if self.semantic_cache is None or question is None:
+            return
+        if request.finish_reason == 'stop' and request.response_cache in (None, 'miss'):
+            self.semantic_cache.learn(type(self).__name__, question, message['content'])
+
+    @final
+    def _generate_response(self, history: List[Dict[str, str]], max_length: int, user_id: str = None) -> str:
+        return self._generate_message(history, max_length, user_id)['content']
+
+    def _session_key(self, user_id: str) -> str:
+        # 各个 Bot 的历史互相独立，KV cache 也按 Bot 区分
+        return f'{type(self).__name__}:{user_id}'
+
+    @final
+    def _reset_session(self, user_id: str) -> None:
+        """清空历史，并通过 engine.drop_session 释放该会话的 KV cache 和视觉编码（KV cache 在调度线程里异步丢弃）"""
+        if user_id in self.user_histories:
+            self.user_histories[user_id] = [self.system_prompt]
+        self.engine.drop_session(self._session_key(user_id))
+
+    @final
+    def _system_prefix(self, history: List[Dict[str, str]]):
+        """history 以本 Bot 默认的 system prompt 开头时，返回 (Bot 名称, system prompt 的 token)
+
+        调度器据此复用所有会话共享的 system prompt KV cache；请求里临时指定的 system prompt 不参与共享。
+        """
+        first = history[0] if history else {}
+        if first.get('role') != 'system' or first.get('content') != self.system_prompt['content']:
+            return None
+        if self._prefix_ids is None:
+            chat_format = self._chat_format()
+            if chat_format is None:
+                self._prefix_ids = self.tokenizer.apply_chat_template(
+                    [{'role': 'system', 'content': first['content']}], tokenize=True, add_generation_prompt=False)
+            else:
+                header, footer, _ = chat_format
+                self._prefix_ids = header('system') + self._message_ids(self.system_prompt) + footer
+        return type(self).__name__, self._prefix_ids
+
+    @final
+    def _settings_changed(self) -> bool:
+        version = settings_manager.current_version()
+        if version == self._settings_version:
+            return False
+        self._settings_version = version
+        return True
+
+    @final
+    def _invalidate_prefix(self) -> None:
+        self._prefix_ids = None
+        self.system_prompt.pop('token_ids', None)
+        self.engine.invalidate_prefix(type(self).__name__)
+        if self.semantic_cache is not None:
+            self.semantic_cache.forget(type(self).__name__)
+
+    @staticmethod
+    def _has_multimodal(new_messages: List[Dict[str, Union[str, dict]]]) -> bool:
+        return any(
+            isinstance(msg.get('content'), list) and 
+            any(item.get('type') in ['video', 'image'] for item in msg['content'] if isinstance(item, dict))
+            for msg in new_messages
+        )
+
+    @final
+    def _save_multimodal_turn(self, user_id: str, prompt: Dict[str, str],
+                              new_messages: List[Dict[str, Union[str, dict]]], response: str) -> None:
+        """保存到历史 - 文本作为消息内容，图片/视频另存在 media 字段，追问时由 _prepare_multimodal_history 放回"""
+        history = self.user_histories[user_id] if user_id in self.user_histories else [prompt]
+
+        text_only_messages = []
+        for msg in new_messages:
+            if isinstance(msg.get('content'), list):
+                text_parts = [item.get('text', '') for item in msg['content'] if item.get('type') == 'text']
+                text_content = ' '.join(text_parts) or "用户发送了媒体文件"
+                media = [item for item in msg['content'] if item.get('type') in ('image', 'video')]
+                text_only_messages.append({'role': msg['role'], 'content': text_content, 'media': media})
+            else:
+                text_only_messages.append(msg)
+
+        history.extend(text_only_messages)
+        history.append({'role': 'assistant', 'content': response})
+        self.user_histories[user_id] = history
+
+    @final
+    def stream_response(self, user_id: str, new_messages: List[Dict[str, Union[str, dict]]], max_length: int,
+                        system_prompt=None, cancel_token: Optional[CancelToken] = None) -> Iterator[Dict]:
+        """generate_response 的流式版本
+
+        请求在调用时立即提交（队列已满时在这里抛 QueueFullError），返回的迭代器
+        先逐段产出 {'delta': 新增文本}，生成结束后写入历史，最后产出 {'response': 全文, 'usage': 用量统计}。
+        cancel_token 被取消或迭代器在结束前被关闭（客户端断开）时，生成在下一步 decode 之前停止；
+        这种情况和超过截止时间时，本轮的问题和回答都不写入历史。
+        """
+        LOGGER.debug(new_messages)
+        if system_prompt:
+            prompt = {"role": "system", "content": system_prompt}
+        else:
+            prompt = self.system_prompt
+
+        multimodal = self._has_multimodal(new_messages) or self._session_has_media(user_id)
+        if multimodal:
+            messages = self._prepare_multimodal_history(user_id, new_messages, prompt)
+            request = self.stream_multimodal_response(messages, max_length, user_id)
+        else:
+            history = self._prepare_history(user_id, new_messages, prompt)
+            request = self._submit_response(history, max_length, user_id)
+        if cancel_token is not None:
+            cancel_token.bind(request.cancel)
+
+        def events():
+            decoder = IncrementalDecoder(self.tokenizer)
+            try:
+                for token in request.iter_tokens():
+                    delta = decoder.push(token)
+                    if delta:
+                        yield {'delta': delta}
+            except GeneratorExit:
+                request.cancel()
+                raise
+            finally:
+                observe_request(self.bot_type, multimodal, request)
+            if request.finish_reason == 'cancelled':
+                yield {'response': '', 'usage': request.usage()}
+                return
+
+            message = self._assistant_message(decoder.ids)
+            response = message['content']
+            # 超过截止时间被截断的回答照常返回，但这一轮不写入历史，下一轮不会接着半截回答继续
+            keep = request.finish_reason != 'deadline'
+            if keep and multimodal:
+                self._save_multimodal_turn(user_id, prompt, new_messages, response)
+            elif keep:
+                self._remember_answer(history, request, message)
+                history.append(message)
+                self.user_histories[user_id] = history
+            yield {'response': response, 'usage': request.usage()}
+
+        return events()
+
+    @final
+    def reply(self, user_id: str, new_messages: List[Dict[str, Union[str, dict]]], max_length: Optional[int],
+              system_prompt=None, cancel_token: Optional[CancelToken] = None) -> Dict:
+        """非流式生成，返回 {'response': 全文, 'usage': 用量统计（含结束原因和生成的 token 数）}"""
+        result = None
+        for event in self.stream_response(user_id, new_messages, max_length, system_prompt=system_prompt,
+                                          cancel_token=cancel_token):
+            result = event
+        return result
 
 
 class ChatBot(Bot, metaclass = FlyweightMeta):
 
+    bot_type = 'normal'
+
     def __init__(self, qw_model: QwModel, max_history: int = 8) -> None:
         super().__init__(qw_model, max_history)
-        self.user_histories: Dict[str, List[Dict[str, str]]] = {}
         self.__repr__ = self.__str__
         # 动态获取提示词
         self.system_prompt = {
@@ -238,7 +500,10 @@ class ChatBot(Bot, metaclass = FlyweightMeta):
 
     def refresh_system_prompt(self):
         """刷新系统提示词"""
+        if not self._settings_changed():
+            return
         self.system_prompt["content"] = settings_manager.get_prompt("chat")
+        self._invalidate_prefix()
     #机器人的自我介绍
     def __str__(self) -> str:
         return 'I am your best friend who is very handsome'
@@ -253,53 +518,34 @@ class ChatBot(Bot, metaclass = FlyweightMeta):
             prompt = self.system_prompt
 
     # 2. 检查是否包含多模态内容
-        has_multimodal = any(
-            isinstance(msg.get('content'), list) and 
-            any(item.get('type') in ['video', 'image'] for item in msg['content'] if isinstance(item, dict))
-            for msg in new_messages
-        )
+        has_multimodal = self._has_multimodal(new_messages) or self._session_has_media(user_id)
 
         if has_multimodal:
-        # 多模态处理
-            system_message = [prompt]
-            full_messages = system_message + new_messages
-            response = self.generate_multimodal_response(full_messages, max_length)
-
-        # 保存到历史 - 只保存文本部分
-            if user_id not in self.user_histories:
-                self.user_histories[user_id] = [prompt]
-
-            text_only_messages = []
-            for msg in new_messages:
-                if isinstance(msg.get('content'), list):
-                    text_parts = [item.get('text', '') for item in msg['content'] if item.get('type') == 'text']
-                    text_content = ' '.join(text_parts) or "用户发送了媒体文件"
-                    text_only_messages.append({'role': msg['role'], 'content': text_content})
-                else:
-                    text_only_messages.append(msg)
-
-            self.user_histories[user_id].extend(text_only_messages)
-            self.user_histories[user_id].append({'role': 'assistant', 'content': response})
+        # 多模态处理（会话里之前发过图片/视频时，追问也走这里，历史中的媒体会一起带上）
+            full_messages = self._prepare_multimodal_history(user_id, new_messages, prompt)
+            response = self.generate_multimodal_response(full_messages, max_length, user_id)
+            self._save_multimodal_turn(user_id, prompt, new_messages, response)
 
         else:
         # 纯文本处理
             history = self._prepare_history(user_id, new_messages, prompt)
-            response = self._generate_response(history, max_length)
-            history.append({'role': 'assistant', 'content': response})
+            message = self._generate_message(history, max_length, user_id)
+            history.append(message)
+            response = message['content']
             self.user_histories[user_id] = history
 
         return response
 
     def reset_history(self, user_id):
-        if user_id in self.user_histories:
-            self.user_histories[user_id] = [self.system_prompt]
+        self._reset_session(user_id)
 
 
 class AstronomyBot(Bot, metaclass = FlyweightMeta):
 
+    bot_type = 'astronomy'
+
     def __init__(self, qw_model: QwModel, max_history: int = 8) -> None:
         super().__init__(qw_model, max_history)
-        self.user_histories: Dict[str, List[Dict[str, str]]] = {}
         self.__repr__ = self.__str__
         # 动态获取提示词
         self.system_prompt = {
@@ -309,7 +555,10 @@ class AstronomyBot(Bot, metaclass = FlyweightMeta):
 
     def refresh_system_prompt(self):
         """刷新系统提示词"""
+        if not self._settings_changed():
+            return
         self.system_prompt["content"] = settings_manager.get_prompt("chat")
+        self._invalidate_prefix()
 
     def __str__(self) -> str:
         return 'An astronomy AI teacher who helps students with astronomy learning.'
@@ -321,25 +570,22 @@ class AstronomyBot(Bot, metaclass = FlyweightMeta):
         else:
             prompt = self.system_prompt
         history = self._prepare_history(user_id, new_messages, prompt)
-        response = self._generate_response(history, max_length)
-        history.append({'role': 'assistant', 'content': response})
+        message = self._generate_message(history, max_length, user_id)
+        history.append(message)
+        response = message['content']
         self.user_histories[user_id] = history
         return response
 
     def reset_history(self, user_id):
-        if user_id in self.user_histories:
-            self.user_histories[user_id] = [self.system_prompt]
-    
-    def reset_history(self, user_id: str) -> None:
-        if user_id in self.user_histories:
-            self.user_histories[user_id] = [self.system_prompt]
+        self._reset_session(user_id)
 
 
 class ElectricityBot(Bot, metaclass=FlyweightMeta):
 
+    bot_type = 'electricity'
+
     def __init__(self, qw_model: QwModel, max_history: int = 8) -> None:
         super().__init__(qw_model, max_history)
-        self.user_histories: Dict[str, List[Dict[str, str]]] = {}
         self.__repr__ = self.__str__
         # 动态获取提示词
         self.system_prompt = {
@@ -349,7 +595,10 @@ class ElectricityBot(Bot, metaclass=FlyweightMeta):
 
     def refresh_system_prompt(self):
         """刷新系统提示词"""
+        if not self._settings_changed():
+            return
         self.system_prompt["content"] = settings_manager.get_prompt("chat")
+        self._invalidate_prefix()
         
     def __str__(self) -> str:
         return 'An electricity teacher who concentrates on helping users with electricity learning.'
@@ -361,21 +610,22 @@ class ElectricityBot(Bot, metaclass=FlyweightMeta):
         else:
             prompt = self.system_prompt
         history = self._prepare_history(user_id, new_messages, prompt)
-        response = self._generate_response(history, max_length)
-        history.append({'role': 'assistant', 'content': response})
+        message = self._generate_message(history, max_length, user_id)
+        history.append(message)
+        response = message['content']
         self.user_histories[user_id] = history
         return response
 
     def reset_history(self, user_id):
-        if user_id in self.user_histories:
-            self.user_histories[user_id] = [self.system_prompt]
+        self._reset_session(user_id)
 
 
 class MechanicsBot(Bot, metaclass=FlyweightMeta):
 
+    bot_type = 'mechanics'
+
     def __init__(self, qw_model: QwModel, max_history: int = 8) -> None:
         super().__init__(qw_model, max_history)
-        self.user_histories: Dict[str, List[Dict[str, str]]] = {}
         self.__repr__ = self.__str__
         # 动态获取提示词
         self.system_prompt = {
@@ -385,7 +635,10 @@ class MechanicsBot(Bot, metaclass=FlyweightMeta):
 
     def refresh_system_prompt(self):
         """刷新系统提示词"""
+        if not self._settings_changed():
+            return
         self.system_prompt["content"] = settings_manager.get_prompt("chat")
+        self._invalidate_prefix()
 
     def __str__(self) -> str:
         return 'A mechanics teacher who concentrates on helping users with mechanics learning.'
@@ -397,14 +650,14 @@ class MechanicsBot(Bot, metaclass=FlyweightMeta):
         else:
             prompt = self.system_prompt
         history = self._prepare_history(user_id, new_messages, prompt)
-        response = self._generate_response(history, max_length)
-        history.append({'role': 'assistant', 'content': response})
+        message = self._generate_message(history, max_length, user_id)
+        history.append(message)
+        response = message['content']
         self.user_histories[user_id] = history
         return response
 
     def reset_history(self, user_id):
-        if user_id in self.user_histories:
-            self.user_histories[user_id] = [self.system_prompt]
+        self._reset_session(user_id)
 
 class BotShop(object):
 
@@ -10,7 +10,8 @@ CFG_PATH: str = opj(PROJECT_ROOT, 'config', 'config.ini')
 
 
 def read_cfg() -> configargparse.Namespace:
-    parser = configargparse.ArgParser(description='Configuration for the server')
+    parser = configargparse.ArgParser(description='Configuration for the server',
+                                      ignore_unknown_config_file_keys=True)
     parser.add_argument('-c', '--config', is_config_file=True,
                         help='config file path', default='./config/config.ini')
     parser.add_argument('--origins', nargs='+', help='List of allowed origins', required=True)
@@ -0,0 +1,119 @@
+import os
+from typing import List, Optional, Union
+
+import torch
+
+from logger import MyLogger
+
+
+LOGGER = MyLogger()
+
+DeviceMap = Union[str, dict]
+
+
+def resolve_device(name: str = 'auto') -> torch.device:
+    """auto 依次选择 cuda、mps、cpu；其余按 torch 的写法解析（cpu / cuda / cuda:1 / mps）"""
+    if name != 'auto':
+        return torch.device(name)
+    if torch.cuda.is_available():
+        return torch.device('cuda')
+    if getattr(torch.backends, 'mps', None) is not None and torch.backends.mps.is_available():
+        return torch.device('mps')
+    return torch.device('cpu')
+
+
+def device_map_for(name: str = 'auto') -> DeviceMap:
+    """from_pretrained 的 device_map
+
+    auto 和不带编号的 cuda 交给 accelerate 按显存切分到所有可见的卡上；
+    指定了具体设备（cpu / cuda:1 / mps）时整个模型放在这一个设备上。
+    """
+    device = resolve_device(name)
+    if device.type == 'cuda' and device.index is None:
+        return 'auto'
+    return {'': str(device)}
+
+
+def input_device(model) -> torch.device:
+    """模型输入应放的设备，即词嵌入所在的设备
+
+    device_map 把模型切到多张卡上时 model.device 只是第一个参数的设备，未必是嵌入层所在的卡。
+    """
+    embeddings = model.get_input_embeddings()
+    if embeddings is not None:
+        return embeddings.weight.device
+    return model.device
+
+
+def parse_cpu_list(text: str) -> List[int]:
+    """解析 0-15,32-47 这种 Linux cpulist 写法"""
+    cores = []
+    for part in text.replace(' ', '').split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            cores.extend(range(int(first), int(last) + 1))
+        else:
+            cores.append(int(part))
+    return sorted(set(cores))
+
+
+def numa_node_cpus(node: int) -> List[int]:
+    with open(f'/sys/devices/system/node/node{node}/cpulist') as f:
+        return parse_cpu_list(f.read())
+
+
+def available_cpus() -> int:
+    """本进程可用的核数：按亲和性掩码计算，绑核或容器限制后比 os.cpu_count() 准确"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _pin_process(cores: List[int]) -> None:
+    # sched_setaffinity(0) 只作用于调用线程；模型可能在线程池里加载，已有的线程逐个设置，
+    # 之后创建的线程（torch 的线程池、调度线程、预处理子进程）继承各自创建者的掩码
+    try:
+        threads = [int(tid) for tid in os.listdir('/proc/self/task')]
+    except OSError:
+        threads = [0]
+    for tid in threads:
+        try:
+            os.sched_setaffinity(tid, cores)
+        except ProcessLookupError:  # 线程已经退出
+            pass
+
+
+def configure_cpu(intra_op_threads: int = 0, inter_op_threads: int = 0, cpu_cores: str = '',
+                  numa_node: int = -1) -> Optional[List[int]]:
+    """在加载模型之前调用：绑定 CPU 核并设置 torch 的线程数
+
+    同一台机器上跑多个推理副本时，每个副本绑定到互不重叠的一组核（或一个 NUMA 节点），
+    torch 的线程数默认等于绑定的核数，副本之间不会争抢同一批核。
+    绑定后再加载模型，权重按首次写入分配在本节点的内存上，推理时不跨节点访问。
+    返回绑定的核，没有绑定时返回 None。
+    """
+    cores = None
+    if numa_node >= 0:
+        cores = numa_node_cpus(numa_node)
+    if cpu_cores:
+        listed = parse_cpu_list(cpu_cores)
+        cores = listed if cores is None else sorted(set(cores) & set(listed))
+    if cores is not None:
+        if not cores:
+            raise ValueError(f'no cpu left after combining numa_node={numa_node} and cpu_cores={cpu_cores}')
+        _pin_process(cores)
+
+    threads = intra_op_threads or (len(cores) if cores is not None else 0)
+    if threads:
+        torch.set_num_threads(threads)
+    if inter_op_threads:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError as e:
+            # 只能在第一次并行计算之前设置一次
+            LOGGER.warning(f'inter_op_threads 未生效: {e}')
+    LOGGER.info(f'CPU 绑定 {cores if cores is not None else "未设置"}，'
+                f'intra-op 线程 {torch.get_num_threads()}，inter-op 线程 {torch.get_num_interop_threads()}')
+    return cores
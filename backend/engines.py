@@ -0,0 +1,362 @@
+import base64
+import hashlib
+import json
+import mimetypes
+import os
+import random
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+import requests
+
+from logger import MyLogger
+from native import allocate_lock, run_blocking
+from scheduler import GenerationRequest, QueueFullError
+
+
+LOGGER = MyLogger()
+
+Prefix = Optional[Tuple[str, List[int]]]
+
+
+class GenerationParams(object):
+    """一次生成的参数，各个引擎按自己的方式解释
+
+    生成出 stop 中任一字符串时结束（停止串保留在输出中）；deadline_seconds 为从提交起的最长用时，0 表示不限制。
+    """
+
+    def __init__(self, max_new_tokens: int, temperature: float = 1.0, top_p: float = 1.0, top_k: int = 0,
+                 repetition_penalty: float = 1.0, min_new_tokens: int = 0, stop: Sequence[str] = (),
+                 deadline_seconds: float = 0) -> None:
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.repetition_penalty = repetition_penalty
+        self.min_new_tokens = min_new_tokens
+        self.stop = tuple(stop)
+        self.deadline_seconds = deadline_seconds
+
+
+class InferenceEngine(metaclass=ABCMeta):
+    """Bot 背后的推理后端
+
+    Bot 负责拼历史、渲染 prompt；引擎负责把 prompt 变成 token。submit 立即返回 GenerationRequest，
+    调用方用 wait() 取完整结果，或用 iter_tokens() 边生成边取（stream 即是后者）。
+    """
+
+    eos_token_ids: Set[int] = set()
+
+    @abstractmethod
+    def submit(self, prompt_ids: List[int], params: GenerationParams, session_id: Optional[str] = None,
+               prefix: Prefix = None) -> GenerationRequest:
+        """提交渲染好的纯文本 prompt（token id）"""
+
+    @abstractmethod
+    def submit_multimodal(self, messages: List[Dict], params: GenerationParams,
+                          session_id: Optional[str] = None) -> GenerationRequest:
+        """提交带图片/视频的对话消息（qwen-vl 的消息格式）"""
+
+    def generate(self, batch: List[List[int]], params: GenerationParams) -> List[List[int]]:
+        pending = [self.submit(prompt_ids, params) for prompt_ids in batch]
+        return [request.wait() for request in pending]
+
+    def stream(self, prompt_ids: List[int], params: GenerationParams, session_id: Optional[str] = None,
+               prefix: Prefix = None) -> Iterator[int]:
+        return self.submit(prompt_ids, params, session_id, prefix).iter_tokens()
+
+    def check_capacity(self) -> None:
+        """排队已满时抛出 QueueFullError"""
+
+    def load(self) -> int:
+        """正在生成和排队的请求数"""
+        return 0
+
+    def queue_size(self) -> int:
+        """load() 中还在排队、没有开始生成的请求数"""
+        return 0
+
+    def invalidate_prefix(self, key: str) -> None:
+        """某个 Bot 的 system prompt 改变了"""
+
+    def drop_session(self, session_id: str) -> None:
+        """会话被重置，释放为它保留的 KV cache 和视觉编码"""
+
+    def warm_media(self, item: Dict) -> None:
+        """提前处理刚上传的媒体文件"""
+
+
+class _ThreadedEngine(InferenceEngine):
+    """每个请求在单独的线程（gevent 下为协程）里生成，同时进行的请求数不超过 max_concurrency"""
+
+    def __init__(self, tokenizer, max_concurrency: int, retry_after: int) -> None:
+        self.tokenizer = tokenizer
+        self.max_concurrency = max_concurrency
+        self.retry_after = retry_after
+        self.eos_token_ids = {tokenizer.eos_token_id} if tokenizer.eos_token_id is not None else set()
+        self._running = 0
+        self._lock = allocate_lock()
+
+    def check_capacity(self) -> None:
+        if self._running >= self.max_concurrency:
+            raise QueueFullError(self.retry_after)
+
+    def load(self) -> int:
+        return self._running
+
+    def _start(self, request: GenerationRequest, target, *args) -> GenerationRequest:
+        with self._lock:
+            self.check_capacity()
+            self._running += 1
+
+        def run():
+            request.started_at = time.perf_counter()
+            try:
+                target(request, *args)
+            except Exception as e:
+                LOGGER.exception(f'{type(self).__name__} 生成失败: {e}')
+                request.error = e
+            finally:
+                with self._lock:
+                    self._running -= 1
+                if request.error is None and request.finish_reason is None:
+                    request.finish_reason = 'length'
+                request.mark_done()
+
+        threading.Thread(target=run, daemon=True).start()
+        return request
+
+    @staticmethod
+    def _request(prompt_ids: List[int], params: GenerationParams, session_id: Optional[str]) -> GenerationRequest:
+        return GenerationRequest(prompt_ids, params.max_new_tokens, session_id=session_id, stop=params.stop,
+                                 deadline_seconds=params.deadline_seconds)
+
+    def _push_text(self, request: GenerationRequest, text: str) -> None:
+        # 服务端返回的是文本，重新分词后接到 request 上，Bot 侧照常按 token 增量解码
+        for token in self.tokenizer.encode(text, add_special_tokens=False):
+            request.push(token)
+
+
+class OpenAIEngine(_ThreadedEngine):
+    """OpenAI 兼容的 HTTP 后端，比如本地用 `vllm serve` 启动的服务
+
+    纯文本请求发到 /completions，prompt 直接使用 Bot 渲染好的 token id；多模态请求发到 /chat/completions，
+    本地图片/视频转成 data URL。都使用流式接口，收到一段文本就推给调用方。
+    """
+
+    def __init__(self, tokenizer, base_url: str, model_name: str, api_key: str = 'EMPTY', timeout: float = 600,
+                 max_concurrency: int = 64, retry_after: int = 5) -> None:
+        super().__init__(tokenizer, max_concurrency, retry_after)
+        self.base_url = base_url.rstrip('/')
+        self.model_name = model_name
+        self.timeout = timeout
+        self._session = requests.Session()
+        self._session.headers['Authorization'] = f'Bearer {api_key}'
+
+    def submit(self, prompt_ids: List[int], params: GenerationParams, session_id: Optional[str] = None,
+               prefix: Prefix = None) -> GenerationRequest:
+        request = self._request(prompt_ids, params, session_id)
+        body = dict(self._sampling(params), prompt=list(prompt_ids))
+        return self._start(request, self._stream, '/completions', body)
+
+    def submit_multimodal(self, messages: List[Dict], params: GenerationParams,
+                          session_id: Optional[str] = None) -> GenerationRequest:
+        request = self._request([], params, session_id)
+        body = dict(self._sampling(params), messages=[self._chat_message(msg) for msg in messages])
+        return self._start(request, self._stream, '/chat/completions', body)
+
+    def _sampling(self, params: GenerationParams) -> Dict[str, Any]:
+        body = {
+            'model': self.model_name,
+            'max_tokens': params.max_new_tokens,
+            'temperature': params.temperature,
+            'top_p': params.top_p,
+            'stream': True,
+            'stream_options': {'include_usage': True},
+        }
+        # 以下是 vLLM 在 OpenAI 协议之外支持的参数
+        if params.top_k > 0:
+            body['top_k'] = params.top_k
+        if params.repetition_penalty != 1.0:
+            body['repetition_penalty'] = params.repetition_penalty
+        if params.min_new_tokens:
+            body['min_tokens'] = params.min_new_tokens
+        if params.stop:
+            body['stop'] = list(params.stop)
+        return body
+
+    def _stream(self, request: GenerationRequest, path: str, body: Dict[str, Any]) -> None:
+        with self._session.post(self.base_url + path, json=body, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 429:
+                raise QueueFullError(int(response.headers.get('Retry-After', self.retry_after)))
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+                data = line[len('data:'):].strip()
+                if data == '[DONE]':
+                    break
+                chunk = json.loads(data)
+                if chunk.get('usage') and not request.prompt_ids:
+                    request.prompt_ids = [0] * chunk['usage'].get('prompt_tokens', 0)
+                for choice in chunk.get('choices', []):
+                    text = choice.get('text')
+                    if text is None:
+                        text = (choice.get('delta') or {}).get('content') or ''
+                    self._push_text(request, text)
+                    if choice.get('finish_reason'):
+                        request.finish_reason = 'length' if choice['finish_reason'] == 'length' else 'stop'
+                # 被取消或超过截止时间时断开连接，服务端随之停止生成
+                if request.finish_reason is None:
+                    request.finish_reason = request.interrupted()
+                    if request.finish_reason is not None:
+                        break
+
+    @staticmethod
+    def _chat_message(msg: Dict) -> Dict:
+        content = msg['content']
+        if not isinstance(content, list):
+            return {'role': msg['role'], 'content': content}
+        items = []
+        for item in content:
+            kind = item.get('type')
+            if kind == 'text':
+                items.append({'type': 'text', 'text': item.get('text', '')})
+            elif kind in ('image', 'video'):
+                url = _media_url(item.get(kind))
+                items.append({'type': f'{kind}_url', f'{kind}_url': {'url': url}})
+        return {'role': msg['role'], 'content': items}
+
+
+def _media_url(source: str) -> str:
+    path = source[len('file://'):] if source.startswith('file://') else source
+    if not os.path.isfile(path):
+        return source  # http 地址或已经是 data URL
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    with open(path, 'rb') as f:
+        return f"data:{mimetype};base64,{base64.b64encode(f.read()).decode('ascii')}"
+
+
+class FakeEngine(_ThreadedEngine):
+    """不加载模型的假引擎，用于在 CPU 上压测 HTTP、调度和会话这些外围部分
+
+    输出由 prompt 决定：同一 prompt 每次得到相同的 token 序列（从一段固定文本的 token 中选取），
+    每个 token 间隔 token_latency 秒，output_tokens 个 token 后以 eos 结束。
+    """
+
+    _TEXT = '这是一个用于压测的固定回答，内容与问题无关，只用来产生稳定的输出长度和时延。'
+
+    def __init__(self, tokenizer, token_latency: float = 0.02, output_tokens: int = 64,
+                 max_concurrency: int = 256, retry_after: int = 5) -> None:
+        super().__init__(tokenizer, max_concurrency, retry_after)
+        self.token_latency = token_latency
+        self.output_tokens = output_tokens
+        self._vocab = tokenizer.encode(self._TEXT, add_special_tokens=False)
+
+    def submit(self, prompt_ids: List[int], params: GenerationParams, session_id: Optional[str] = None,
+               prefix: Prefix = None) -> GenerationRequest:
+        request = self._request(prompt_ids, params, session_id)
+        return self._start(request, self._emit, repr(list(prompt_ids)))
+
+    def submit_multimodal(self, messages: List[Dict], params: GenerationParams,
+                          session_id: Optional[str] = None) -> GenerationRequest:
+        request = self._request([], params, session_id)
+        return self._start(request, self._emit, json.dumps(messages, sort_keys=True, ensure_ascii=False))
+
+    def _emit(self, request: GenerationRequest, seed: str) -> None:
+        rng = random.Random(hashlib.sha256(seed.encode('utf-8')).hexdigest())
+        for _ in range(min(self.output_tokens, request.max_new_tokens)):
+            time.sleep(self.token_latency)
+            request.push(rng.choice(self._vocab))
+            request.finish_reason = request.limit_reached(self.tokenizer)
+            if request.finish_reason is not None:
+                return
+        if len(request.output_ids) < request.max_new_tokens and self.eos_token_ids:
+            request.push(next(iter(self.eos_token_ids)))
+            request.finish_reason = 'stop'
+
+
+class HFEngine(InferenceEngine):
+    """本进程内的 transformers 模型：文本请求交给 BatchScheduler 连续批处理，
+    多模态请求经预处理（媒体缓存 / 预处理子进程）后按视觉 token 预算合批生成
+    """
+
+    def __init__(self, processor, scheduler, media_cache, device=None) -> None:
+        self.processor = processor
+        self.scheduler = scheduler
+        self.media_cache = media_cache
+        # 默认与调度器一致，放在模型词嵌入所在的设备上
+        self.device = device if device is not None else scheduler.device
+        self.eos_token_ids = scheduler.eos_token_ids
+
+    def submit(self, prompt_ids: List[int], params: GenerationParams, session_id: Optional[str] = None,
+               prefix: Prefix = None) -> GenerationRequest:
+        return self.scheduler.submit(prompt_ids, max_new_tokens=params.max_new_tokens,
+                                     temperature=params.temperature, top_p=params.top_p, top_k=params.top_k,
+                                     session_id=session_id, prefix=prefix, stop=params.stop,
+                                     deadline_seconds=params.deadline_seconds,
+                                     repetition_penalty=params.repetition_penalty,
+                                     min_new_tokens=params.min_new_tokens)
+
+    def submit_multimodal(self, messages: List[Dict], params: GenerationParams,
+                          session_id: Optional[str] = None) -> GenerationRequest:
+        try:
+            # 先在预处理子进程里解码媒体（等待期间推理线程继续为其他请求生成），
+            # 再交给调度器，与同时到达的其他多模态请求合成一批生成
+            inputs, media_keys = run_blocking(self._prepare_inputs, messages)
+        except Exception as e:
+            LOGGER.exception(f'多模态预处理失败: {e}')
+            request = GenerationRequest([], params.max_new_tokens)
+            request.error = e
+            request.mark_done()
+            return request
+        return self.scheduler.submit_multimodal(inputs, params.max_new_tokens, session_id=session_id,
+                                                media_keys=media_keys, stop=params.stop,
+                                                deadline_seconds=params.deadline_seconds,
+                                                **self._generate_kwargs(params))
+
+    def _prepare_inputs(self, messages: List[Dict]):
+        text = self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        # 消息里有用户内容，只在 debug 级别记录
+        LOGGER.debug(f'处理的消息: {messages}')
+        # 按文件内容缓存预处理结果，追问同一图片/视频时不再重新解码
+        inputs = self.media_cache.prepare(text, messages)
+        return inputs.to(self.device), self.media_cache.media_keys(messages)
+
+    def _generate_kwargs(self, params: GenerationParams) -> Dict[str, Any]:
+        # 同一批次的多模态请求共用一次 generate，参数相同的请求才会合批
+        kwargs = dict(
+            do_sample=params.temperature > 0,
+            temperature=params.temperature,
+            top_p=params.top_p,
+            repetition_penalty=params.repetition_penalty,
+            pad_token_id=self.processor.tokenizer.eos_token_id,
+        )
+        if params.top_k > 0:
+            kwargs['top_k'] = params.top_k
+        if params.min_new_tokens:
+            kwargs['min_new_tokens'] = params.min_new_tokens
+        return kwargs
+
+    def check_capacity(self) -> None:
+        self.scheduler.check_capacity()
+
+    def load(self) -> int:
+        return self.scheduler.load()
+
+    def queue_size(self) -> int:
+        return self.scheduler.queue_size()
+
+    def invalidate_prefix(self, key: str) -> None:
+        if self.scheduler.prefix_cache is not None:
+            self.scheduler.prefix_cache.invalidate(key)
+
+    def drop_session(self, session_id: str) -> None:
+        self.scheduler.discard_session(session_id)
+        if self.scheduler.vision_cache is not None:
+            self.scheduler.vision_cache.drop_session(session_id)
+
+    def warm_media(self, item: Dict) -> None:
+        self.media_cache.warm(item)
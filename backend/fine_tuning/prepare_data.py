@@ -41,7 +41,7 @@ class DataGenerator(object):
     def generate_response(self, new_messages, max_length):
         history = [self.system_prompt] + new_messages
         input_ids = self.tokenizer.apply_chat_template(history, tokenize=False, add_generation_prompt=True)
-        model_inputs = self.tokenizer([input_ids], return_tensors="pt", padding=True, truncation=True).to('cuda')
+        model_inputs = self.tokenizer([input_ids], return_tensors="pt", padding=True, truncation=True).to(self.model.device)
 
         with torch.no_grad():
             generated_ids = self.model.generate(
@@ -113,7 +113,7 @@ inputs = tokenizer.apply_chat_template([{"role": "user", "content": "假设你
                                        tokenize=True,
                                        return_tensors="pt",
                                        return_dict=True
-                                       ).to('cuda')
+                                       ).to(model.device)
 gen_kwargs = {"max_length": 2500, "do_sample": True, "top_k": 1}
 with torch.no_grad():
     outputs = model.generate(**inputs, **gen_kwargs)
@@ -0,0 +1,98 @@
+import copy
+import json
+import os
+from typing import Any, Dict, Optional
+
+from engines import GenerationParams
+from logger import MyLogger
+
+
+LOGGER = MyLogger()
+
+# 配置文件里没有写的项使用这些值；采样参数与之前写死在 Bot 里的一致
+_BUILTIN: Dict[str, Any] = {
+    'max_new_tokens': 2048,
+    'deadline_seconds': 120,
+    'stop': [],
+    'temperature': 1.1,
+    'top_p': 0.98,
+    'top_k': 75,
+    'repetition_penalty': 1.0,
+    'min_new_tokens': 0,
+    # 带图片/视频的请求在上面的基础上覆盖这些项
+    'multimodal': {
+        'max_new_tokens': 1024,
+        'temperature': 0.7,
+        'top_p': 0.9,
+        'top_k': 0,
+        'repetition_penalty': 1.1,
+        'min_new_tokens': 20,
+    },
+}
+
+
+class GenerationProfile(object):
+    """一个 Bot 的生成预算和采样参数
+
+    请求里的 max_length 只能在 max_new_tokens 之内调小，不填或不合法时用 max_new_tokens；
+    生成出 stop 中任一字符串、或从提交起超过 deadline_seconds 秒时结束，由调度器每产生一个 token 检查一次。
+    """
+
+    def __init__(self, name: str, settings: Dict[str, Any]) -> None:
+        self.name = name
+        self.settings = settings
+        multimodal = dict(settings, **settings['multimodal'])
+        self._text = self._params(settings)
+        self._multimodal = self._params(multimodal)
+
+    @staticmethod
+    def _params(settings: Dict[str, Any]) -> GenerationParams:
+        return GenerationParams(
+            int(settings['max_new_tokens']),
+            temperature=float(settings['temperature']),
+            top_p=float(settings['top_p']),
+            top_k=int(settings['top_k']),
+            repetition_penalty=float(settings['repetition_penalty']),
+            min_new_tokens=int(settings['min_new_tokens']),
+            stop=settings['stop'],
+            deadline_seconds=float(settings['deadline_seconds']),
+        )
+
+    def params(self, requested: Optional[int] = None, multimodal: bool = False) -> GenerationParams:
+        params = copy.copy(self._multimodal if multimodal else self._text)
+        if isinstance(requested, int) and not isinstance(requested, bool) and requested > 0:
+            params.max_new_tokens = min(requested, params.max_new_tokens)
+        # 不能比强制生成的最少 token 数还少
+        params.min_new_tokens = min(params.min_new_tokens, params.max_new_tokens)
+        return params
+
+
+def _merge(base: Dict[str, Any], overrides: Dict[str, Any], where: str) -> Dict[str, Any]:
+    unknown = set(overrides) - set(base)
+    if unknown:
+        raise ValueError(f'unknown keys in generation profile {where}: {sorted(unknown)}')
+    merged = dict(base, **overrides)
+    if 'multimodal' in base:
+        merged['multimodal'] = _merge(base['multimodal'], overrides.get('multimodal', {}), f'{where}.multimodal')
+    return merged
+
+
+def load_profiles(path: str) -> Dict[str, GenerationProfile]:
+    """读取 {"default": {...}, "<bot_type>": {...}}：default 覆盖内置值，各 Bot 的设置再覆盖 default"""
+    data: Dict[str, Dict[str, Any]] = {}
+    if path and os.path.isfile(path):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    elif path:
+        LOGGER.warning(f'生成配置文件不存在，使用内置默认值: {path}')
+
+    default = _merge(_BUILTIN, data.get('default', {}), 'default')
+    profiles = {'default': GenerationProfile('default', default)}
+    for name, overrides in data.items():
+        if name != 'default':
+            profiles[name] = GenerationProfile(name, _merge(default, overrides, name))
+    for profile in profiles.values():
+        params = profile.params()
+        LOGGER.info(f'生成配置 {profile.name}: 最多 {params.max_new_tokens} token，'
+                    f'截止时间 {params.deadline_seconds or "无"}s，停止串 {list(params.stop)}')
+    return profiles
@@ -0,0 +1,175 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+
+LegacyCache = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+
+def past_nbytes(past: LegacyCache) -> int:
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in past)
+
+
+def slice_past(past: LegacyCache, length: int) -> LegacyCache:
+    return tuple((k[:, :, :length], v[:, :, :length]) for k, v in past)
+
+
+def move_past(past: LegacyCache, device) -> LegacyCache:
+    return tuple((k.to(device), v.to(device)) for k, v in past)
+
+
+def common_prefix_length(a: List[int], b: List[int]) -> int:
+    length = min(len(a), len(b))
+    for i in range(length):
+        if a[i] != b[i]:
+            return i
+    return length
+
+
+class _CacheEntry(object):
+
+    def __init__(self, token_ids: List[int], past: LegacyCache) -> None:
+        self.token_ids = token_ids
+        self.past = past
+        self.nbytes = past_nbytes(past)
+        self.offloaded = False
+
+
+class SessionKVCache(object):
+    """按会话保存上一轮结束时的 KV cache，下一轮只需 prefill 新增的 token
+
+    缓存以 token 序列为准：新 prompt 与缓存的 token 取最长公共前缀，前缀部分直接复用，
+    所以历史被截断、system prompt 改变等情况都会自然退化为部分复用或完全重算。
+    设备上的缓存总量受 device_budget 限制，超出时按 LRU 把最久未用的会话挪到 CPU 内存
+    （开启 offload 时，CPU 上同样有预算），放不下的直接丢弃。
+    只由调度线程访问，因此不加锁。
+    """
+
+    def __init__(self, device_budget_bytes: int, offload: bool = False, cpu_budget_bytes: int = 0) -> None:
+        self.device_budget_bytes = device_budget_bytes
+        self.offload = offload
+        self.cpu_budget_bytes = cpu_budget_bytes
+        self._entries: 'OrderedDict[str, _CacheEntry]' = OrderedDict()
+        self.device_bytes = 0
+        self.cpu_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(self, session_id: str, prompt_ids: List[int], device) -> Tuple[int, Optional[LegacyCache]]:
+        """取出会话缓存中与 prompt 共同前缀的部分，返回 (复用的 token 数, past)
+
+        至少留一个 token 给 prefill 计算 logits。取出后条目从缓存中移除，生成结束时再写回。
+        """
+        entry = self._pop(session_id)
+        if entry is None:
+            self.misses += 1
+            return 0, None
+        length = min(common_prefix_length(entry.token_ids, prompt_ids), len(prompt_ids) - 1)
+        if length <= 0:
+            self.misses += 1
+            return 0, None
+        self.hits += 1
+        self.reused_tokens += length
+        return length, move_past(slice_past(entry.past, length), device)
+
+    def store(self, session_id: str, token_ids: List[int], past: LegacyCache) -> None:
+        if self.device_budget_bytes <= 0:
+            return
+        self._pop(session_id)
+        entry = _CacheEntry(token_ids, past)
+        if entry.nbytes > self.device_budget_bytes:
+            self.evictions += 1
+            return
+        self._entries[session_id] = entry
+        self.device_bytes += entry.nbytes
+        self._enforce_budget()
+
+    def discard(self, session_id: str) -> None:
+        self._pop(session_id)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'sessions': len(self._entries),
+            'device_bytes': self.device_bytes,
+            'cpu_bytes': self.cpu_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'reused_tokens': self.reused_tokens,
+            'evictions': self.evictions,
+        }
+
+    def _pop(self, session_id: str) -> Optional[_CacheEntry]:
+        entry = self._entries.pop(session_id, None)
+        if entry is not None:
+            if entry.offloaded:
+                self.cpu_bytes -= entry.nbytes
+            else:
+                self.device_bytes -= entry.nbytes
+        return entry
+
+    def _enforce_budget(self) -> None:
+        # OrderedDict 头部是最久未使用的会话
+        for session_id in list(self._entries.keys()):
+            if self.device_bytes <= self.device_budget_bytes:
+                break
+            entry = self._entries[session_id]
+            if entry.offloaded:
+                continue
+            self.device_bytes -= entry.nbytes
+            if self.offload and entry.nbytes <= self.cpu_budget_bytes:
+                entry.past = move_past(entry.past, 'cpu')
+                entry.offloaded = True
+                self.cpu_bytes += entry.nbytes
+            else:
+                del self._entries[session_id]
+                self.evictions += 1
+
+        for session_id in list(self._entries.keys()):
+            if self.cpu_bytes <= self.cpu_budget_bytes:
+                break
+            entry = self._entries[session_id]
+            if entry.offloaded:
+                del self._entries[session_id]
+                self.cpu_bytes -= entry.nbytes
+                self.evictions += 1
+
+
+class PrefixCache(object):
+    """各个 Bot 默认 system prompt 渲染后的 KV cache，所有会话只读共享
+
+    prefill 时直接拼在复用的 cache 之后计算，新 token 的 KV 会拼接成新张量，不会改动这里保存的张量。
+    提示词更新后由 Bot 调用 invalidate；即使漏掉，token 不一致时也会重新计算。
+    """
+
+    def __init__(self) -> None:
+        self._entries: Dict[str, _CacheEntry] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str, token_ids: List[int]) -> Optional[LegacyCache]:
+        entry = self._entries.get(key)
+        if entry is None or entry.token_ids != token_ids:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry.past
+
+    def put(self, key: str, token_ids: List[int], past: LegacyCache) -> None:
+        self._entries[key] = _CacheEntry(list(token_ids), past)
+
+    def invalidate(self, key: str) -> None:
+        self._entries.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'prefixes': len(self._entries),
+            'bytes': sum(entry.nbytes for entry in list(self._entries.values())),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -6,6 +6,9 @@ from loguru import logger
  
  
 class MyLogger:
+
+    # 多个模块各自实例化 MyLogger，sink 只需要添加一次，否则日志会重复写入
+    _configured = False
  
     def __init__(self, log_dir='logs', max_size=2, retention='7 days'):
         self.log_dir = log_dir
@@ -14,6 +17,8 @@ class MyLogger:
         self.logger = self.configure_logger()
  
     def configure_logger(self):
+        if MyLogger._configured:
+            return logger
   
         os.makedirs(self.log_dir, exist_ok=True)
         shared_config = {
@@ -29,6 +34,7 @@ class MyLogger:
             **shared_config
         )
         #logger.add(sink=self.get_log_path, **shared_config)
+        MyLogger._configured = True
  
         return logger
  
@@ -0,0 +1,301 @@
+import hashlib
+import json
+import os
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+from transformers import BatchFeature
+from qwen_vl_utils import extract_vision_info, fetch_image, fetch_video
+
+from logger import MyLogger
+from native import allocate_lock
+
+
+LOGGER = MyLogger()
+
+MediaEntry = Dict[str, torch.Tensor]
+
+# processor 输出中只和文本有关的部分，不进缓存
+_TEXT_KEYS = ('input_ids', 'attention_mask')
+
+
+def _entry_nbytes(entry: MediaEntry) -> int:
+    return sum(value.numel() * value.element_size() for value in entry.values())
+
+
+def _local_path(source: Any) -> Optional[str]:
+    if not isinstance(source, str):
+        return None
+    path = source[len('file://'):] if source.startswith('file://') else source
+    return path if os.path.isfile(path) else None
+
+
+def preprocess_item(processor, info: Dict, kind: str, storage_dtype: torch.dtype) -> MediaEntry:
+    """解码并预处理单个图片/视频，结果与整批调用 processor 时该媒体项对应的部分相同"""
+    if kind == 'image':
+        outputs = processor(text=[processor.image_token], images=[fetch_image(info)], return_tensors='pt')
+    else:
+        outputs = processor(text=[processor.video_token], videos=[fetch_video(info)], return_tensors='pt')
+    entry = {}
+    for name, value in outputs.items():
+        if name in _TEXT_KEYS:
+            continue
+        value = torch.as_tensor(value)
+        if value.is_floating_point() and value.dim() > 1:
+            value = value.to(storage_dtype)
+        entry[name] = value
+    return entry
+
+
+class VisionInputCache(object):
+    """按内容缓存预处理后的图片/视频输入（pixel values 和 grid 信息）
+
+    键由文件内容的 sha256、该媒体项自带的参数（fps、max_pixels 等）以及 processor 配置共同决定，
+    同一个文件换了路径也能命中，processor 配置变化后旧缓存自然失效。
+    内存中按 LRU 淘汰，总量不超过 max_bytes；配置了 disk_dir 时每个条目同时写一份到磁盘，
+    重启后或其他副本进程也能直接读取，磁盘上超过 disk_max_bytes 时删除最久未用的文件。
+    浮点张量按 storage_dtype 保存：视觉编码器本来就会转成模型的 dtype，这样不损失精度又能省一半内存。
+    传入 pool（MediaPreprocessPool）时解码和预处理在子进程中并行执行，否则在调用线程里执行。
+    """
+
+    def __init__(self, processor, max_bytes: int, disk_dir: Optional[str] = None, disk_max_bytes: int = 0,
+                 storage_dtype: torch.dtype = torch.float32, pool=None) -> None:
+        self.processor = processor
+        self.pool = pool
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.storage_dtype = storage_dtype
+        self._entries: 'OrderedDict[str, MediaEntry]' = OrderedDict()
+        self._file_digests: 'OrderedDict[Tuple[str, int, int], str]' = OrderedDict()
+        # 推理线程和后台预解码线程都会访问，用原生锁；_loading 保证同一媒体项同时只解码一次
+        self._lock = allocate_lock()
+        self._loading: Dict[str, Any] = {}
+        self._settings_digest = self._processor_digest(processor)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def _processor_digest(processor) -> str:
+        settings = {}
+        for name in ('image_processor', 'video_processor'):
+            component = getattr(processor, name, None)
+            if component is not None:
+                settings[name] = component.to_dict()
+        return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def prepare(self, text: str, messages: List[Dict]) -> BatchFeature:
+        """与 processor(text=[text], images=..., videos=...) 的结果相同，但每个媒体项只在第一次出现时解码和预处理"""
+        images, videos = [], []
+        for info in extract_vision_info(messages):
+            if 'image' in info or 'image_url' in info:
+                images.append(self._item_inputs(info, 'image'))
+            elif 'video' in info:
+                videos.append(self._item_inputs(info, 'video'))
+            else:
+                raise ValueError('image, image_url or video should in content.')
+
+        data = {}
+        if images:
+            text = self._expand_placeholders(text, self.processor.image_token, self.processor.image_processor.merge_size,
+                                             [entry['image_grid_thw'] for entry in images])
+            data.update(self._concat(images))
+        if videos:
+            text = self._expand_placeholders(text, self.processor.video_token, self.processor.video_processor.merge_size,
+                                             [entry['video_grid_thw'] for entry in videos])
+            data.update(self._concat(videos))
+        data.update(self.processor.tokenizer([text], padding=True, return_tensors='pt'))
+        return BatchFeature(data=data)
+
+    def media_keys(self, messages: List[Dict]) -> Dict[str, List[Optional[str]]]:
+        """各图片、视频的缓存键，顺序与 prepare 拼出的 batch 一致；无法稳定标识的媒体项为 None"""
+        keys = {'image': [], 'video': []}
+        for info in extract_vision_info(messages):
+            kind = 'video' if 'video' in info else 'image'
+            keys[kind].append(self._key(info, kind))
+        return keys
+
+    def warm(self, info: Dict) -> None:
+        """提前预处理一个媒体项（比如刚上传的文件），之后的对话请求直接命中缓存"""
+        kind = 'video' if 'video' in info else 'image'
+        try:
+            self._item_inputs(info, kind)
+        except Exception as e:
+            LOGGER.warning(f'预解码失败: {info} {e}')
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.nbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'disk_hits': self.disk_hits,
+                'evictions': self.evictions,
+            }
+
+    def _item_inputs(self, info: Dict, kind: str) -> MediaEntry:
+        key = self._key(info, kind)
+        if key is None:
+            return self._preprocess(info, kind)
+        entry = self._get(key)
+        if entry is not None:
+            return entry
+
+        with self._lock:
+            loading = self._loading.setdefault(key, allocate_lock())
+        with loading:
+            # 等锁期间其他线程可能已经处理完同一个媒体项
+            entry = self._get(key, count=False)
+            if entry is None:
+                entry = self._preprocess(info, kind)
+                self._put(key, entry)
+        with self._lock:
+            self._loading.pop(key, None)
+        return entry
+
+    def _preprocess(self, info: Dict, kind: str) -> MediaEntry:
+        if self.pool is not None:
+            return self.pool.preprocess(info, kind)
+        return preprocess_item(self.processor, info, kind, self.storage_dtype)
+
+    def _key(self, info: Dict, kind: str) -> Optional[str]:
+        source = info.get(kind) if kind in info else info.get('image_url')
+        if isinstance(source, dict):
+            source = source.get('url')
+        content = self._content_digest(source)
+        if content is None:
+            return None  # PIL 对象等无法稳定标识的输入不缓存
+        options = {name: value for name, value in info.items() if name not in (kind, 'image_url', 'type')}
+        key = json.dumps([self._settings_digest, kind, content, options], sort_keys=True, default=str)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _content_digest(self, source: Any) -> Optional[str]:
+        path = _local_path(source)
+        if path is None:
+            # base64 data URI 和 http 地址直接按字符串区分，同一地址视为同一内容
+            return hashlib.sha256(source.encode('utf-8')).hexdigest() if isinstance(source, str) else None
+
+        stat = os.stat(path)
+        file_key = (path, stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            digest = self._file_digests.get(file_key)
+            if digest is not None:
+                self._file_digests.move_to_end(file_key)
+                return digest
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        with self._lock:
+            self._file_digests[file_key] = digest
+            while len(self._file_digests) > 4096:
+                self._file_digests.popitem(last=False)
+        return digest
+
+    def _get(self, key: str, count: bool = True) -> Optional[MediaEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += count
+                return entry
+        entry = self._load_from_disk(key)
+        with self._lock:
+            if entry is None:
+                self.misses += count
+                return None
+            self.disk_hits += 1
+            self._remember(key, entry)
+        return entry
+
+    def _put(self, key: str, entry: MediaEntry) -> None:
+        with self._lock:
+            self._remember(key, entry)
+        self._save_to_disk(key, entry)
+
+    def _remember(self, key: str, entry: MediaEntry) -> None:
+        nbytes = _entry_nbytes(entry)
+        if nbytes > self.max_bytes:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.nbytes -= _entry_nbytes(previous)
+        self._entries[key] = entry
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= _entry_nbytes(evicted)
+            self.evictions += 1
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f'{key}.pt')
+
+    def _load_from_disk(self, key: str) -> Optional[MediaEntry]:
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            entry = torch.load(path, weights_only=True)
+            os.utime(path)  # 磁盘上同样按最近使用淘汰
+            return entry
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            LOGGER.warning(f'读取媒体缓存失败，重新预处理: {path} {e}')
+            return None
+
+    def _save_to_disk(self, key: str, entry: MediaEntry) -> None:
+        if not self.disk_dir or _entry_nbytes(entry) > self.disk_max_bytes:
+            return
+        path = self._disk_path(key)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        try:
+            torch.save(entry, tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            LOGGER.warning(f'写入媒体缓存失败: {path} {e}')
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            return
+        self._prune_disk()
+
+    def _prune_disk(self) -> None:
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith('.pt'):
+                try:
+                    stat = os.stat(os.path.join(self.disk_dir, name))
+                except FileNotFoundError:
+                    continue  # 其他进程刚删掉
+                files.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.unlink(os.path.join(self.disk_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    @staticmethod
+    def _expand_placeholders(text: str, token: str, merge_size: int, grids: List[torch.Tensor]) -> str:
+        # 与 Qwen2_5_VLProcessor 相同：每个占位符展开成该媒体项视觉 token 数个
+        merge_length = merge_size ** 2
+        for grid in grids:
+            count = int(grid[0].prod()) // merge_length
+            text = text.replace(token, '<|placeholder|>' * count, 1)
+        return text.replace('<|placeholder|>', token)
+
+    @staticmethod
+    def _concat(entries: List[MediaEntry]) -> Dict[str, torch.Tensor]:
+        return {name: torch.cat([entry[name] for entry in entries]) for name in entries[0]}
@@ -0,0 +1,184 @@
+import argparse
+import itertools
+import os
+import signal
+import sys
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Connection
+from typing import Any, Dict, List, Tuple
+
+import torch
+
+from device import available_cpus
+from logger import MyLogger
+from media_cache import MediaEntry, preprocess_item
+from native import allocate_lock, get_original
+
+
+LOGGER = MyLogger()
+
+_select = get_original('select', 'select')
+_waitpid = get_original('os', 'waitpid')
+# gevent 替换后的 posix_spawn 要在主线程的事件循环上注册子进程监视，线程池里调用会失败
+_posix_spawn = get_original('os', 'posix_spawn')
+# 张量在共享内存中的起始位置按此对齐，换成其他 dtype 的视图时不会出错
+_ALIGNMENT = 64
+_SHM_DIR = '/dev/shm'
+
+# 主进程与预处理子进程之间用一对管道通信：主进程发送 (媒体项, 类型)，子进程把结果写入一块共享内存，
+# 只回复共享内存的名字和各个张量的位置，像素数据不经过管道。
+
+
+def _share(entry: MediaEntry) -> Dict[str, Any]:
+    tensors = {name: tensor.contiguous() for name, tensor in entry.items()}
+    layout: List[Tuple[str, str, List[int], int, int]] = []
+    offset = 0
+    for name, tensor in tensors.items():
+        nbytes = tensor.numel() * tensor.element_size()
+        layout.append((name, str(tensor.dtype).replace('torch.', ''), list(tensor.shape), offset, nbytes))
+        offset += -(-nbytes // _ALIGNMENT) * _ALIGNMENT
+    size = max(offset, 1)
+
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    for (name, _, _, begin, nbytes) in layout:
+        if nbytes:
+            shm.buf[begin:begin + nbytes] = tensors[name].reshape(-1).view(torch.uint8).numpy()
+    shm.close()
+    # 由主进程负责删除，子进程的 resource_tracker 不再跟踪这块共享内存
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return {'shm': shm.name, 'size': size, 'tensors': layout}
+
+
+def _attach(reply: Dict[str, Any]) -> MediaEntry:
+    path = os.path.join(_SHM_DIR, reply['shm'])
+    if os.path.exists(path):
+        # 与 weights.mmap_safetensors 相同，直接映射子进程写好的页，不复制；删除文件后映射仍然有效
+        storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=reply['size'])
+        os.unlink(path)
+        data = torch.empty(0, dtype=torch.uint8).set_(storage)
+    else:
+        shm = shared_memory.SharedMemory(name=reply['shm'])
+        data = torch.frombuffer(shm.buf, dtype=torch.uint8, count=reply['size']).clone()
+        shm.close()
+        shm.unlink()
+    return {name: data[offset:offset + nbytes].view(getattr(torch, dtype)).view(shape)
+            for name, dtype, shape, offset, nbytes in reply['tensors']}
+
+
+class _Worker(object):
+    """一个预处理子进程，同一时间只处理一个媒体项，由 lock 保证"""
+
+    def __init__(self, command: List[str]) -> None:
+        self.command = command
+        self.lock = allocate_lock()
+        self.pid = None
+        self._reader = None
+        self._writer = None
+
+    def start(self) -> None:
+        parent_read, child_write = os.pipe()
+        child_read, parent_write = os.pipe()
+        os.set_inheritable(child_read, True)
+        os.set_inheritable(child_write, True)
+        # 不用 subprocess：gevent 替换后的 Popen 只能在主线程的事件循环里使用，而重启可能发生在线程池里
+        self.pid = _posix_spawn(self.command[0], self.command + ['--fds', f'{child_read},{child_write}'],
+                                  os.environ)
+        os.close(child_read)
+        os.close(child_write)
+        self._reader = Connection(parent_read, writable=False)
+        self._writer = Connection(parent_write, readable=False)
+
+    def stop(self) -> None:
+        if self.pid is not None:
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+                _waitpid(self.pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+            self._reader.close()
+            self._writer.close()
+            self.pid = None
+
+    def call(self, info: Dict, kind: str, timeout: float) -> MediaEntry:
+        if self.pid is None:
+            self.start()
+        try:
+            self._writer.send((info, kind))
+            if not _select([self._reader.fileno()], [], [], timeout)[0]:
+                raise TimeoutError(f'no reply in {timeout}s')
+            reply = self._reader.recv()
+        except (OSError, EOFError) as e:
+            # 子进程崩溃或超时，下次调用时重新启动
+            self.stop()
+            raise RuntimeError(f'media worker failed: {e!r}') from e
+        if 'error' in reply:
+            raise RuntimeError(reply['error'])
+        return _attach(reply)
+
+
+class MediaPreprocessPool(object):
+    """在子进程里解码、缩放图片和视频帧
+
+    解码和 processor 的变换基本都是持有 GIL 的 Python/NumPy 代码，放在主进程里会拖慢事件循环和推理线程。
+    多个请求的媒体项在各个子进程中并行处理，结果经共享内存交给主进程，由调用线程等待，
+    因此一个请求的预处理可以和其他请求的生成同时进行。
+    子进程直接执行本文件，不会像 multiprocessing 的 spawn 那样重新导入 wsgi.py 而再加载一次模型。
+    """
+
+    def __init__(self, model_path: str, workers: int, storage_dtype: torch.dtype, timeout: float = 300) -> None:
+        self.timeout = timeout
+        # 子进程继承本进程的绑核，按绑定的核数分线程
+        threads = max(1, available_cpus() // workers)
+        command = [sys.executable, os.path.abspath(__file__), '--model_path', model_path,
+                   '--dtype', str(storage_dtype).replace('torch.', ''), '--threads', str(threads)]
+        self._workers = [_Worker(command) for _ in range(workers)]
+        self._rotation = itertools.count()
+        for worker in self._workers:
+            worker.start()
+
+    def preprocess(self, info: Dict, kind: str) -> MediaEntry:
+        # 优先找空闲的子进程，都在忙时排在轮到的那个后面
+        start = next(self._rotation) % len(self._workers)
+        candidates = self._workers[start:] + self._workers[:start]
+        for worker in candidates:
+            if worker.lock.acquire(False):
+                break
+        else:
+            worker = candidates[0]
+            worker.lock.acquire()
+        try:
+            return worker.call(info, kind, self.timeout)
+        finally:
+            worker.lock.release()
+
+
+def _worker_main() -> None:
+    parser = argparse.ArgumentParser(description='Media preprocessing worker')
+    parser.add_argument('--model_path', required=True)
+    parser.add_argument('--dtype', default='bfloat16')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--fds', required=True)
+    args = parser.parse_args()
+
+    from modelscope import AutoProcessor
+
+    torch.set_num_threads(args.threads)
+    processor = AutoProcessor.from_pretrained(args.model_path, use_fast=True)
+    storage_dtype = getattr(torch, args.dtype)
+    read_fd, write_fd = map(int, args.fds.split(','))
+    reader = Connection(read_fd, writable=False)
+    writer = Connection(write_fd, readable=False)
+    while True:
+        try:
+            info, kind = reader.recv()
+        except EOFError:
+            return  # 主进程退出
+        try:
+            writer.send(_share(preprocess_item(processor, info, kind, storage_dtype)))
+        except Exception as e:
+            LOGGER.warning(f'预处理失败: {info} {e}')
+            writer.send({'error': f'{type(e).__name__}: {e}'})
+
+
+if __name__ == '__main__':
+    _worker_main()
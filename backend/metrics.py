@@ -0,0 +1,245 @@
+import bisect
+import sys
+from typing import Any, Callable, Dict, Iterator, List, Sequence, Tuple
+
+import psutil
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily
+from prometheus_client.registry import Collector
+
+from native import allocate_lock
+
+
+# 指标在调度线程和各个协程里更新。prometheus_client 自带的指标用 threading 的锁，gevent 下会被换成协程锁，
+# 系统线程和协程同时更新时可能卡住事件循环，所以这里自己用原生锁累计，抓取时由 InferenceCollector 转成 Prometheus 格式。
+# 多副本部署时前端通过 op=metrics 取各个副本的 snapshot()，加上 replica 标签后一起输出。
+
+_METRICS: List['_Metric'] = []
+
+
+class _Child(object):
+
+    def __init__(self, metric: '_Metric', key: Tuple[str, ...]) -> None:
+        self.metric = metric
+        self.key = key
+
+    def inc(self, amount: float = 1) -> None:
+        self.metric._add(self.key, amount)
+
+    def observe(self, value: float) -> None:
+        self.metric._add(self.key, value)
+
+
+class _Metric(object):
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], Any] = {}
+        self._lock = allocate_lock()
+        _METRICS.append(self)
+
+    def labels(self, *values: str) -> _Child:
+        return _Child(self, tuple(str(value) for value in values))
+
+    def _add(self, key: Tuple[str, ...], value: float) -> None:
+        raise NotImplementedError
+
+    def snapshot(self) -> List[list]:
+        raise NotImplementedError
+
+    def family(self, labelnames: List[str], samples: List[Tuple[List[str], Any]]):
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+
+    def inc(self, amount: float = 1) -> None:
+        self._add((), amount)
+
+    def _add(self, key: Tuple[str, ...], value: float) -> None:
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def snapshot(self) -> List[list]:
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def family(self, labelnames: List[str], samples: List[Tuple[List[str], Any]]):
+        family = CounterMetricFamily(self.name, self.documentation, labels=labelnames)
+        for labels, value in samples:
+            family.add_metric(labels, value)
+        return family
+
+
+class Histogram(_Metric):
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float],
+                 labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _add(self, key: Tuple[str, ...], value: float) -> None:
+        with self._lock:
+            # [各个桶的计数（不累加，最后一个是 +Inf）, 总和]
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def snapshot(self) -> List[list]:
+        with self._lock:
+            return [[list(key), [list(counts), total]] for key, (counts, total) in self._values.items()]
+
+    def family(self, labelnames: List[str], samples: List[Tuple[List[str], Any]]):
+        family = HistogramMetricFamily(self.name, self.documentation, labels=labelnames)
+        bounds = [str(float(bound)) for bound in self.buckets] + ['+Inf']
+        for labels, (counts, total) in samples:
+            cumulative, running = [], 0
+            for bound, count in zip(bounds, counts):
+                running += count
+                cumulative.append((bound, running))
+            family.add_metric(labels, cumulative, total)
+        return family
+
+
+_SECONDS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120, 240)
+_TOKENS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+_RATE = (1, 2, 5, 10, 15, 20, 30, 40, 60, 80, 120, 200)
+# kind 为 text 或 multimodal（带图片/视频，或会话里有过媒体）
+_REQUEST_LABELS = ('bot_type', 'kind')
+
+# 提前结束的生成：reason 为 cancelled（客户端断开）或 deadline（超过截止时间）
+GENERATION_INTERRUPTED = Counter('chatbot_generation_interrupted', 'Generations ended before finishing', ['reason'])
+# 客户端断开前已经生成、但没有人接收的 token
+WASTED_TOKENS = Counter('chatbot_wasted_tokens', 'Tokens generated for requests whose client went away')
+# 经过响应缓存的请求：result 为 hit（重放已完成的回答）、coalesced（跟随进行中的相同生成）、miss，
+# 以及语义缓存直接给出回答的 semantic
+RESPONSE_CACHE = Counter('chatbot_response_cache', 'Requests answered from or recorded in the response caches',
+                         ('bot_type', 'result'))
+REQUESTS = Counter('chatbot_requests', 'Chat requests by bot, kind and how they ended',
+                   _REQUEST_LABELS + ('finish_reason',))
+# 以下只统计正常结束（没有取消、没有出错）的请求，时间都从提交开始算
+QUEUE_WAIT = Histogram('chatbot_queue_wait_seconds', 'Seconds from submission until generation started',
+                       _SECONDS, _REQUEST_LABELS)
+TIME_TO_FIRST_TOKEN = Histogram('chatbot_time_to_first_token_seconds', 'Seconds from submission to the first token',
+                                _SECONDS, _REQUEST_LABELS)
+LATENCY = Histogram('chatbot_request_latency_seconds', 'Seconds from submission to the last token',
+                    _SECONDS, _REQUEST_LABELS)
+PROMPT_TOKENS = Histogram('chatbot_prompt_tokens', 'Prompt tokens per request', _TOKENS, _REQUEST_LABELS)
+GENERATED_TOKENS = Histogram('chatbot_generated_tokens', 'Generated tokens per request', _TOKENS, _REQUEST_LABELS)
+# 首个 token 之后的生成速度；缓存直接给出的回答没有经过生成，不计入
+TOKENS_PER_SECOND = Histogram('chatbot_decode_tokens_per_second', 'Tokens per second after the first token',
+                              _RATE, _REQUEST_LABELS)
+
+# 抓取时读取的状态：名称 -> (说明, 标签)
+_GAUGES: Dict[str, Tuple[str, Tuple[str, ...]]] = {
+    'chatbot_active_sessions': ('Conversation histories kept per bot', ('bot_type',)),
+    'chatbot_inference_requests': ('Requests generating or waiting in the inference queue', ('state',)),
+    'chatbot_process_resident_memory_bytes': ('Resident memory of the inference process', ()),
+    'chatbot_accelerator_memory_bytes': ('Accelerator memory allocated / reserved by torch and device total',
+                                         ('device', 'type')),
+}
+
+_watched: Dict[str, Any] = {}
+
+
+def watch(bots: Dict[str, Any], engine) -> None:
+    """登记本进程的 Bot 和推理引擎，抓取时读取会话数和队列状态"""
+    _watched['bots'] = bots
+    _watched['engine'] = engine
+
+
+def observe_request(bot_type: str, multimodal: bool, request) -> None:
+    """Bot 在一次对话结束（包括取消和出错）时调用"""
+    kind = 'multimodal' if multimodal else 'text'
+    if request.error is not None:
+        finish_reason = 'error'
+    elif not request.done.is_set():
+        # 客户端断开后调度器还没来得及结束生成
+        finish_reason = 'cancelled'
+    else:
+        finish_reason = request.finish_reason or 'unknown'
+    REQUESTS.labels(bot_type, kind, finish_reason).inc()
+    if finish_reason in ('cancelled', 'error'):
+        return
+
+    if request.started_at is not None:
+        QUEUE_WAIT.labels(bot_type, kind).observe(request.started_at - request.submitted_at)
+    if request.first_token_at is not None:
+        TIME_TO_FIRST_TOKEN.labels(bot_type, kind).observe(request.first_token_at - request.submitted_at)
+    LATENCY.labels(bot_type, kind).observe(request.finished_at - request.submitted_at)
+    PROMPT_TOKENS.labels(bot_type, kind).observe(len(request.prompt_ids))
+    generated = len(request.output_ids)
+    GENERATED_TOKENS.labels(bot_type, kind).observe(generated)
+    if request.response_cache not in ('hit', 'semantic') and generated > 1 \
+            and request.finished_at > request.first_token_at:
+        TOKENS_PER_SECOND.labels(bot_type, kind).observe(
+            (generated - 1) / (request.finished_at - request.first_token_at))
+
+
+def _accelerator_memory() -> Iterator[Tuple[List[str], float]]:
+    # 只读取已经初始化的设备，不为此导入 torch 或创建 CUDA 上下文（前端进程不加载模型）
+    torch = sys.modules.get('torch')
+    if torch is None:
+        return
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        for index in range(torch.cuda.device_count()):
+            device = f'cuda:{index}'
+            yield [device, 'allocated'], torch.cuda.memory_allocated(index)
+            yield [device, 'reserved'], torch.cuda.memory_reserved(index)
+            yield [device, 'total'], torch.cuda.get_device_properties(index).total_memory
+    elif getattr(torch.backends, 'mps', None) is not None and torch.backends.mps.is_available():
+        yield ['mps', 'allocated'], torch.mps.current_allocated_memory()
+        yield ['mps', 'reserved'], torch.mps.driver_allocated_memory()
+
+
+def _gauges() -> Dict[str, List[list]]:
+    gauges: Dict[str, List[list]] = {
+        'chatbot_process_resident_memory_bytes': [[[], psutil.Process().memory_info().rss]],
+        'chatbot_accelerator_memory_bytes': [[labels, value] for labels, value in _accelerator_memory()],
+    }
+    # 本地模式下模型加载完成之前还没有 Bot
+    if _watched:
+        engine = _watched['engine']
+        queued = engine.queue_size()
+        gauges['chatbot_active_sessions'] = [[[name], len(bot.user_histories)]
+                                             for name, bot in _watched['bots'].items()]
+        gauges['chatbot_inference_requests'] = [[['running'], engine.load() - queued], [['queued'], queued]]
+    return gauges
+
+
+def snapshot() -> Dict[str, Any]:
+    """本进程全部指标的当前值，可以 json 序列化，发给前端汇总"""
+    return {
+        'metrics': {metric.name: metric.snapshot() for metric in _METRICS},
+        'gauges': _gauges(),
+    }
+
+
+class InferenceCollector(Collector):
+    """把各个进程的 snapshot() 转成 Prometheus 指标，sources 返回 {副本名: snapshot}，本地模式下只有 local 一项"""
+
+    def __init__(self, sources: Callable[[], Dict[str, Dict[str, Any]]]) -> None:
+        self.sources = sources
+
+    def collect(self):
+        return self._families(self.sources())
+
+    def describe(self):
+        # 注册时只需要指标名，不去连接副本
+        return self._families({})
+
+    @staticmethod
+    def _families(snapshots: Dict[str, Dict[str, Any]]):
+        for metric in _METRICS:
+            samples = [(labels + [replica], value)
+                       for replica, data in snapshots.items()
+                       for labels, value in data['metrics'].get(metric.name, [])]
+            yield metric.family(list(metric.labelnames) + ['replica'], samples)
+        for name, (documentation, labelnames) in _GAUGES.items():
+            family = GaugeMetricFamily(name, documentation, labels=list(labelnames) + ['replica'])
+            for replica, data in snapshots.items():
+                for labels, value in data['gauges'].get(name, []):
+                    family.add_metric(labels + [replica], value)
+            yield family
+
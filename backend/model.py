@@ -1,23 +1,131 @@
 from pathlib import Path
+import os
 import sys
+import tempfile
+import time
 import torch
 import configargparse
-from modelscope import Qwen2_5_VLForConditionalGeneration, AutoProcessor, AutoTokenizer
 from qwen_vl_utils import process_vision_info  # 你需要有这个工具文件
+from scheduler import BatchScheduler
+from kv_cache import PrefixCache, SessionKVCache
+from session_store import SessionStore
+from response_cache import ResponseCache
+from semantic_cache import SemanticAnswerCache
+from weights import load_model_mmap, log_load
+from media_cache import VisionInputCache
+from media_pool import MediaPreprocessPool
+from vision_cache import VisionEncoderCache
+from engines import FakeEngine, GenerationParams, HFEngine, OpenAIEngine
+from generation_profiles import GenerationProfile, load_profiles
+from quantization import QUANTIZATION_MODES, load_model
+from speculative import DraftModelProposer, PromptLookupProposer, load_draft_model
+from device import configure_cpu, device_map_for, input_device, resolve_device
+from native import allocate_lock
+from startup import STARTUP, process_uptime
+from PIL import Image
 
-parser = configargparse.ArgParser(description='Configuration for a chatbot')
+parser = configargparse.ArgParser(description='Configuration for a chatbot', ignore_unknown_config_file_keys=True)
 parser.add_argument('-c', '--config', is_config_file=True,
                     help='config file path', default='./config/config.ini')
 parser.add_argument('--model_path', help='Path of the model')
 parser.add_argument('--bot_type', help='Type of the bot')
-parser.add_argument('--origins', nargs='+', help='List of allowed origins', required=True)
-
-args = parser.parse_args()
-MODEL_PATH = args.model_path
+parser.add_argument('--engine', choices=['hf', 'openai', 'fake'], default='hf',
+                    help='Inference backend: in-process transformers model, OpenAI-compatible server or fake for load tests')
+parser.add_argument('--openai_base_url', default='http://127.0.0.1:8000/v1', help='Base URL of the OpenAI-compatible server')
+parser.add_argument('--openai_model', default='Qwen2.5-VL-3B-Instruct', help='Model name served by that server')
+parser.add_argument('--openai_api_key', default='EMPTY', help='API key sent to that server')
+parser.add_argument('--openai_timeout', type=float, default=600, help='Seconds before a request to that server fails')
+parser.add_argument('--engine_max_concurrency', type=int, default=64,
+                    help='Max requests in flight to the openai/fake engine before new ones are rejected with 429')
+parser.add_argument('--fake_token_latency', type=float, default=0.02, help='Seconds per token of the fake engine')
+parser.add_argument('--fake_output_tokens', type=int, default=64, help='Tokens generated per request by the fake engine')
+parser.add_argument('--device', default='auto',
+                    help='auto picks cuda, then mps, then cpu; or cpu / cuda / cuda:N / mps. cuda spreads the model over all GPUs')
+parser.add_argument('--intra_op_threads', type=int, default=0,
+                    help='torch threads inside one operator, 0 uses the number of pinned cores or the torch default')
+parser.add_argument('--inter_op_threads', type=int, default=0, help='torch threads running independent operators, 0 keeps the default')
+parser.add_argument('--cpu_cores', default='', help='Pin this process to these cores, e.g. 0-15,32-47')
+parser.add_argument('--numa_node', type=int, default=-1,
+                    help='Pin this process to the cores of this NUMA node so weights and KV caches stay in local memory')
+parser.add_argument('--weights_mmap', action='store_true',
+                    help='Memory-map safetensors weights read-only so CPU replicas on one host share one copy')
+parser.add_argument('--quantization', choices=QUANTIZATION_MODES, default='none',
+                    help='int8_dynamic: int8 linear layers for CPU nodes; int8/int4_weight_only: torchao or bitsandbytes')
+parser.add_argument('--quantization_group_size', type=int, default=128, help='Group size of int4 weight-only scales')
+parser.add_argument('--max_batch_size', type=int, default=8, help='Max concurrent sequences per decode step')
+parser.add_argument('--max_queue_size', type=int, default=64,
+                    help='Max requests waiting for a batch slot before new ones are rejected with 429')
+parser.add_argument('--multimodal_token_budget', type=int, default=16384,
+                    help='Max image/video tokens generated together in one multimodal batch')
+parser.add_argument('--speculative', choices=['none', 'ngram', 'draft'], default='none',
+                    help='Speculative decoding: draft tokens from prompt n-gram lookup or from a small draft model')
+parser.add_argument('--speculative_tokens', type=int, default=4, help='Draft tokens verified per decode step')
+parser.add_argument('--speculative_max_ngram', type=int, default=3, help='Longest n-gram matched by ngram lookup')
+parser.add_argument('--draft_model_path', default='',
+                    help='Small model sharing the tokenizer, e.g. Qwen2.5-0.5B-Instruct, used when speculative = draft')
+parser.add_argument('--retry_after_seconds', type=int, default=5, help='Retry-After sent with 429 responses')
+parser.add_argument('--kv_cache_budget_mb', type=int, default=2048,
+                    help='Device memory kept for per-session KV caches, 0 disables reuse')
+parser.add_argument('--kv_cache_offload', action='store_true',
+                    help='Move least recently used session caches to CPU RAM instead of dropping them')
+parser.add_argument('--kv_cache_cpu_budget_mb', type=int, default=8192,
+                    help='CPU memory kept for offloaded session caches')
+parser.add_argument('--session_max_count', type=int, default=20000, help='Sessions kept in memory per bot')
+parser.add_argument('--session_max_mb', type=int, default=512, help='Memory kept for chat histories per bot')
+parser.add_argument('--session_ttl_seconds', type=float, default=7200,
+                    help='Idle time after which a session leaves memory')
+parser.add_argument('--session_spill_path', default='',
+                    help='SQLite file for sessions evicted from memory, empty drops them instead')
+parser.add_argument('--session_disk_ttl_days', type=float, default=30, help='Idle days before a spilled session is deleted')
+parser.add_argument('--prefix_cache', action='store_true',
+                    help="Share the KV cache of each bot's system prompt across sessions")
+parser.add_argument('--media_cache_mb', type=int, default=2048,
+                    help='Memory kept for preprocessed image/video inputs, keyed by file content')
+parser.add_argument('--media_cache_dir', default='',
+                    help='Directory for a persistent copy of preprocessed media, empty keeps them in memory only')
+parser.add_argument('--media_cache_disk_mb', type=int, default=20480, help='Disk space kept under media_cache_dir')
+parser.add_argument('--vision_cache_mb', type=int, default=1024,
+                    help='Device memory kept for vision encoder outputs of media seen in each session, 0 disables it')
+parser.add_argument('--vision_cache_session_mb', type=int, default=128,
+                    help='Vision encoder outputs kept for one session')
+parser.add_argument('--media_workers', type=int, default=2,
+                    help='Processes decoding and preprocessing media in parallel, 0 preprocesses in the calling thread')
+parser.add_argument('--media_worker_timeout', type=float, default=300,
+                    help='Seconds before a media worker stuck on one file is restarted')
+parser.add_argument('--response_cache', action='store_true',
+                    help='Reuse answers of identical low-temperature text requests and coalesce identical requests in flight')
+parser.add_argument('--response_cache_size', type=int, default=4096, help='Answers kept in the response cache')
+parser.add_argument('--response_cache_ttl_seconds', type=float, default=3600, help='Seconds an answer stays reusable')
+parser.add_argument('--response_cache_max_temperature', type=float, default=0.3,
+                    help='Only requests sampled at or below this temperature are cached')
+parser.add_argument('--semantic_cache', action='store_true',
+                    help='Answer first-turn questions similar to a known question from the index instead of the model')
+parser.add_argument('--semantic_cache_datasets', nargs='*', default=[],
+                    help='QA json files from fine_tuning/prepare_data.py seeding the index')
+parser.add_argument('--semantic_cache_threshold', type=float, default=0.92,
+                    help='Cosine similarity above which a stored answer is returned')
+parser.add_argument('--semantic_cache_dim', type=int, default=256, help='Dimensions of the hashed n-gram vectors')
+parser.add_argument('--semantic_cache_max_learned', type=int, default=20000,
+                    help='Generated first-turn answers added to the index, oldest overwritten first')
+parser.add_argument('--generation_profiles', default='./config/generation_profiles.json',
+                    help='JSON file with per-bot token budget, stop strings, deadline and sampling parameters')
+parser.add_argument('--warmup', action='store_true',
+                    help='Run a few generations of representative shapes before reporting ready')
+parser.add_argument('--warmup_prompt_tokens', type=int, nargs='+', default=[16, 512],
+                    help='Prompt lengths prefilled during warm-up')
+parser.add_argument('--warmup_new_tokens', type=int, default=4, help='Tokens decoded per warm-up request')
+parser.add_argument('--warmup_multimodal', action='store_true', help='Also run one small image through warm-up')
 
 PROJECT_ROOT = Path(__file__).absolute().parents[0].absolute()
 sys.path.insert(0, str(PROJECT_ROOT))
 
+
+def parse_args():
+    # wsgi.py / replica.py 各自还有自己的参数，这里只取本模块认识的部分
+    args, _ = parser.parse_known_args()
+    return args
+
+
 class QwModel(object):
     instance = None
     def __new__(cls, *args, **kwargs):
@@ -28,16 +136,189 @@ class QwModel(object):
     def __init__(self) -> None:
         if hasattr(self, "initialized") and self.initialized:
             return
-        self.processor = AutoProcessor.from_pretrained(MODEL_PATH, use_fast=True)
-        self.tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH, use_fast=True)
-        self.model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
-            MODEL_PATH,
-            torch_dtype=torch.bfloat16,
-            device_map="auto"
-        )
-        #self.model = self.model.to('cuda')
+        # modelscope 和模型类在构造时才导入：只 import 本模块（或 chatbot）时不需要完整的模型依赖
+        from modelscope import AutoProcessor, AutoTokenizer
+        # 从进程启动到开始构造模型：解释器启动和 torch / transformers 等模块的 import
+        STARTUP.add('import', process_uptime())
+        self.args = args = parse_args()
+        with STARTUP.phase('processor'):
+            self.processor = AutoProcessor.from_pretrained(args.model_path, use_fast=True)
+            self.tokenizer = AutoTokenizer.from_pretrained(args.model_path, use_fast=True)
+        # 相对路径按 backend 目录解析
+        self.generation_profiles = load_profiles(str(PROJECT_ROOT / args.generation_profiles)
+                                                 if args.generation_profiles else '')
+        # 所有 Bot 共用，键里带 Bot 名称
+        self.response_cache = ResponseCache(
+            args.response_cache_size, args.response_cache_ttl_seconds, args.response_cache_max_temperature,
+        ) if args.response_cache else None
+        self.semantic_cache = None
+        if args.semantic_cache:
+            with STARTUP.phase('semantic_index'):
+                self.semantic_cache = SemanticAnswerCache(args.semantic_cache_threshold, dim=args.semantic_cache_dim,
+                                                          max_learned=args.semantic_cache_max_learned)
+                # 相对路径按 backend 目录解析，与从哪里启动无关
+                self.semantic_cache.load_seeds([str(PROJECT_ROOT / path) for path in args.semantic_cache_datasets])
+        if args.engine != 'hf':
+            # 生成在别处进行，本进程只需要 tokenizer 渲染 prompt、解码输出
+            self.model = None
+            self.engine = self._remote_engine()
+            self.initialized = True
+            return
+        # 先绑核再加载，权重分配在本节点的内存上
+        configure_cpu(args.intra_op_threads, args.inter_op_threads, args.cpu_cores, args.numa_node)
+        with STARTUP.phase('weights'):
+            self.model = self._load_weights()
+            self.speculator = self._speculator()
+        with STARTUP.phase('engine'):
+            self._build_engine()
         self.initialized = True
 
+    def _load_weights(self):
+        from modelscope import Qwen2_5_VLForConditionalGeneration
+        args = self.args
+        started_at = time.perf_counter()
+        if args.quantization != 'none':
+            # 量化后的权重是新分配的张量，不能再映射共享，weights_mmap 不生效
+            model = load_model(Qwen2_5_VLForConditionalGeneration, args.model_path, args.quantization,
+                               args.quantization_group_size, device=args.device)
+            log_load(args.quantization, started_at)
+        elif args.weights_mmap and resolve_device(args.device).type == 'cpu':
+            # 多个副本进程映射同一份权重文件，物理内存里只有一份
+            model = load_model_mmap(Qwen2_5_VLForConditionalGeneration, args.model_path, torch.bfloat16)
+            log_load('mmap', started_at)
+        else:
+            model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
+                args.model_path,
+                torch_dtype=torch.bfloat16,
+                device_map=device_map_for(args.device)
+            )
+            log_load('from_pretrained', started_at)
+        return model
+
+    def _build_engine(self) -> None:
+        args = self.args
+        # 所有 Bot 共用一个调度器，把并发的文本请求合并成批次 decode
+        self.kv_cache = SessionKVCache(
+            device_budget_bytes=args.kv_cache_budget_mb * 1024 * 1024,
+            offload=args.kv_cache_offload,
+            cpu_budget_bytes=args.kv_cache_cpu_budget_mb * 1024 * 1024,
+        )
+        self.prefix_cache = PrefixCache() if args.prefix_cache else None
+        # 追问同一图片/视频时复用视觉编码器的输出，不再经过 ViT
+        self.vision_cache = VisionEncoderCache(
+            max_bytes=args.vision_cache_mb * 1024 * 1024,
+            max_session_bytes=args.vision_cache_session_mb * 1024 * 1024,
+        ) if args.vision_cache_mb > 0 else None
+        self.scheduler = BatchScheduler(self.model, self.tokenizer, max_batch_size=args.max_batch_size,
+                                        kv_cache=self.kv_cache, prefix_cache=self.prefix_cache,
+                                        max_queue_size=args.max_queue_size,
+                                        retry_after=args.retry_after_seconds,
+                                        multimodal_token_budget=args.multimodal_token_budget,
+                                        vision_cache=self.vision_cache,
+                                        speculator=self.speculator)
+        # 图片/视频的解码和预处理在子进程中进行，与生成并行
+        self.media_pool = MediaPreprocessPool(args.model_path, args.media_workers, self.model.dtype,
+                                              timeout=args.media_worker_timeout) if args.media_workers > 0 else None
+        # 同一图片/视频在追问时不再重复解码和预处理
+        self.media_cache = VisionInputCache(
+            self.processor,
+            max_bytes=args.media_cache_mb * 1024 * 1024,
+            disk_dir=args.media_cache_dir or None,
+            disk_max_bytes=args.media_cache_disk_mb * 1024 * 1024,
+            storage_dtype=self.model.dtype,
+            pool=self.media_pool,
+        )
+        self.engine = HFEngine(self.processor, self.scheduler, self.media_cache, device=input_device(self.model))
+
+    def generation_profile(self, bot_type: str) -> GenerationProfile:
+        """Bot 的生成配置，配置文件里没有单独列出的 Bot 使用 default"""
+        return self.generation_profiles.get(bot_type, self.generation_profiles['default'])
+
+    def warm_up(self) -> None:
+        """报告就绪之前按典型形状跑几次生成
+
+        第一次 forward 时的算子选择、内存池分配、预处理子进程里的 import 都在这里完成，
+        不落到重启后的第一批用户请求上。只对本进程内的模型生效。
+        """
+        args = self.args
+        if not args.warmup or args.engine != 'hf':
+            return
+        # 预热失败只影响第一批请求的延迟：记录下来照常就绪，不让 /healthz 失败导致进程被反复重启
+        with STARTUP.phase('warmup'):
+            params = GenerationParams(max_new_tokens=args.warmup_new_tokens, temperature=0)
+            try:
+                self._warm_up_text(params)
+            except Exception as e:
+                STARTUP.warn('warmup', e)
+            if args.warmup_multimodal:
+                try:
+                    self._warm_up_image(params)
+                except Exception as e:
+                    STARTUP.warn('warmup_multimodal', e)
+
+    def _warm_up_text(self, params: GenerationParams) -> None:
+        args = self.args
+        filler = self.tokenizer.encode('力是物体对物体的作用，')
+
+        def prompt(length: int):
+            return (filler * (length // len(filler) + 1))[:length]
+
+        for length in args.warmup_prompt_tokens:
+            self.engine.submit(prompt(length), params).wait()
+        # 满批 decode：同时提交 max_batch_size 条长度不同的请求
+        shortest = min(args.warmup_prompt_tokens)
+        pending = [self.engine.submit(prompt(shortest + i), params) for i in range(args.max_batch_size)]
+        for request in pending:
+            request.wait()
+
+    def _warm_up_image(self, params: GenerationParams) -> None:
+        fd, path = tempfile.mkstemp(suffix='.png')
+        os.close(fd)
+        try:
+            Image.new('RGB', (224, 224), (200, 120, 40)).save(path)
+            messages = [{'role': 'user', 'content': [{'type': 'image', 'image': f'file://{path}'},
+                                                     {'type': 'text', 'text': '图里是什么？'}]}]
+            request = self.engine.submit_multimodal(messages, params)
+            request.wait()
+        finally:
+            os.unlink(path)
+
+    def _speculator(self):
+        args = self.args
+        if args.speculative == 'ngram':
+            return PromptLookupProposer(args.speculative_tokens, max_ngram=args.speculative_max_ngram)
+        if args.speculative == 'draft':
+            started_at = time.perf_counter()
+            draft = load_draft_model(args.draft_model_path, self.model, self.model.dtype)
+            log_load('draft model', started_at)
+            eos_ids = self.model.generation_config.eos_token_id
+            eos_ids = [eos_ids] if isinstance(eos_ids, int) else list(eos_ids or [])
+            return DraftModelProposer(draft, args.speculative_tokens, eos_ids + [self.tokenizer.eos_token_id])
+        return None
+
+    def _remote_engine(self):
+        args = self.args
+        if args.engine == 'openai':
+            # 比如 demo/ 里用 vLLM 启动的 OpenAI 兼容服务
+            return OpenAIEngine(self.tokenizer, args.openai_base_url, args.openai_model, api_key=args.openai_api_key,
+                                timeout=args.openai_timeout, max_concurrency=args.engine_max_concurrency,
+                                retry_after=args.retry_after_seconds)
+        return FakeEngine(self.tokenizer, token_latency=args.fake_token_latency,
+                          output_tokens=args.fake_output_tokens, max_concurrency=args.engine_max_concurrency,
+                          retry_after=args.retry_after_seconds)
+
+    def create_session_store(self, namespace: str) -> SessionStore:
+        """每个 Bot 一份会话历史存储，写入同一个 SQLite 文件时按 namespace 区分"""
+        args = self.args
+        return SessionStore(
+            namespace,
+            max_sessions=args.session_max_count,
+            max_bytes=args.session_max_mb * 1024 * 1024,
+            ttl_seconds=args.session_ttl_seconds,
+            spill_path=args.session_spill_path or None,
+            disk_ttl_seconds=args.session_disk_ttl_days * 24 * 3600,
+        )
+
     def generate_multimodal_response(self, messages, max_new_tokens=128):
         text = self.processor.apply_chat_template(
             messages, tokenize=False, add_generation_prompt=True
@@ -50,7 +331,7 @@ class QwModel(object):
             padding=True,
             return_tensors="pt",
         )
-        inputs = inputs.to("cuda")
+        inputs = inputs.to(input_device(self.model))
         with torch.no_grad():
             generated_ids = self.model.generate(**inputs, max_new_tokens=max_new_tokens)
         generated_ids_trimmed = [
@@ -61,4 +342,17 @@ class QwModel(object):
         )
         return output_text[0] if output_text else ""
 
-qw_model = QwModel()
\ No newline at end of file
+_load_lock = allocate_lock()
+
+
+def get_model() -> QwModel:
+    """第一次调用时加载模型；import 本模块本身不解析参数也不加载任何东西"""
+    with _load_lock:
+        return QwModel()
+
+
+def __getattr__(name: str):
+    # 兼容原来的 from model import qw_model：用到时才加载
+    if name == 'qw_model':
+        return get_model()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
\ No newline at end of file
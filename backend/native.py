@@ -0,0 +1,27 @@
+import importlib
+from typing import Any, Callable
+
+try:
+    from gevent.monkey import get_original, is_module_patched
+except ImportError:  # 没有 gevent 时 threading 本来就是系统线程
+    def get_original(module: str, name: str):
+        return getattr(importlib.import_module(module), name)
+
+    def is_module_patched(module: str) -> bool:
+        return False
+
+# wsgi.py 里 monkey.patch_all() 会把 threading 换成协程实现。推理线程、后台预处理线程这些真正的系统线程之间
+# 需要用未被替换的原生线程和锁，否则一个线程阻塞在协程锁上会卡住整个事件循环。
+start_new_thread = get_original('_thread', 'start_new_thread')
+allocate_lock = get_original('_thread', 'allocate_lock')
+
+
+def run_blocking(fn: Callable, *args) -> Any:
+    """执行会长时间阻塞的调用（等待子进程、解码文件等）
+
+    gevent 下放到 hub 的线程池里执行，只让出当前协程；没有打补丁时（推理副本进程）直接在当前线程调用。
+    """
+    if is_module_patched('threading'):
+        import gevent
+        return gevent.get_hub().threadpool.apply(fn, args)
+    return fn(*args)
@@ -0,0 +1,163 @@
+"""对比各量化方式在一组固定问题上的精度和速度
+
+    python quant_report.py --modes none int8_dynamic int8_weight_only
+
+第一个方式作为基准：先用它贪心生成每个问题的回答，其他方式在同样的输入上
+  - 逐 token 比较：把基准回答作为输入（teacher forcing），看每个位置的 argmax 与基准 token 一致的比例，
+    以及基准回答的困惑度（越接近基准越好）
+  - 完整生成：贪心回答与基准完全相同的问题数
+速度分别统计 prefill 耗时和 decode 的 token/s，结果以 markdown 表格输出，可选同时写入 json。
+"""
+import gc
+import json
+import math
+import time
+from typing import Dict, List, Tuple
+
+import configargparse
+import torch
+from modelscope import AutoTokenizer, Qwen2_5_VLForConditionalGeneration
+
+from device import input_device
+from quantization import QUANTIZATION_MODES, load_model, weight_bytes
+
+
+PROMPTS = [
+    '什么是牛顿第二定律？请给出公式并举一个例子。',
+    '浮力的大小与哪些因素有关？',
+    '请解释欧姆定律，并计算 12V 电压加在 4Ω 电阻上的电流。',
+    '为什么月球总是同一面朝向地球？',
+    '动能定理和机械能守恒定律有什么区别？',
+    '串联电路和并联电路中电流、电压分别有什么规律？',
+    '光年是时间单位还是距离单位？它等于多少米？',
+    '一个物体从 20 米高处自由下落，落地时的速度是多少？',
+]
+
+
+def _encode(tokenizer, prompt: str) -> List[int]:
+    return tokenizer.apply_chat_template([{'role': 'user', 'content': prompt}], tokenize=True,
+                                         add_generation_prompt=True)
+
+
+def _positions(start: int, length: int, device) -> torch.Tensor:
+    # 与 BatchScheduler 一样显式给出位置，纯文本时 Qwen2.5-VL 的三个 rope 维度相同
+    return torch.arange(start, start + length, device=device).unsqueeze(0)
+
+
+@torch.no_grad()
+def greedy(model, prompt_ids: List[int], max_new_tokens: int, eos_ids) -> Tuple[List[int], float, float]:
+    """贪心生成，返回 (生成的 token, prefill 秒数, decode 秒数)"""
+    device = input_device(model)
+    started_at = time.perf_counter()
+    outputs = model(input_ids=torch.tensor([prompt_ids], device=device),
+                    position_ids=_positions(0, len(prompt_ids), device), use_cache=True)
+    token = int(outputs.logits[0, -1].argmax())
+    prefill = time.perf_counter() - started_at
+
+    generated = [token]
+    started_at = time.perf_counter()
+    while token not in eos_ids and len(generated) < max_new_tokens:
+        outputs = model(input_ids=torch.tensor([[token]], device=device),
+                        position_ids=_positions(len(prompt_ids) + len(generated) - 1, 1, device),
+                        past_key_values=outputs.past_key_values, use_cache=True)
+        token = int(outputs.logits[0, -1].argmax())
+        generated.append(token)
+    return generated, prefill, time.perf_counter() - started_at
+
+
+@torch.no_grad()
+def score(model, prompt_ids: List[int], reference: List[int]) -> Tuple[float, float]:
+    """以基准回答为输入时，返回 (argmax 与基准一致的比例, 基准回答的平均负对数似然)"""
+    device = input_device(model)
+    ids = prompt_ids + reference
+    logits = model(input_ids=torch.tensor([ids], device=device), position_ids=_positions(0, len(ids), device)).logits
+    logits = logits[0, len(prompt_ids) - 1:-1].float()
+    target = torch.tensor(reference, device=device)
+    agreement = (logits.argmax(dim=-1) == target).float().mean().item()
+    nll = -torch.log_softmax(logits, dim=-1).gather(-1, target.unsqueeze(-1)).mean().item()
+    return agreement, nll
+
+
+def evaluate(mode: str, args, tokenizer, prompts: List[List[int]], baseline) -> Tuple[Dict, List[List[int]]]:
+    started_at = time.perf_counter()
+    model = load_model(Qwen2_5_VLForConditionalGeneration, args.model_path, mode, args.quantization_group_size,
+                       device=args.device)
+    load_seconds = time.perf_counter() - started_at
+    eos_ids = {tokenizer.eos_token_id, *tokenizer.convert_tokens_to_ids(['<|im_end|>', '<|endoftext|>'])} - {None}
+
+    outputs, prefill, decode, decoded = [], 0.0, 0.0, 0
+    for prompt_ids in prompts:
+        greedy(model, prompt_ids, 2, eos_ids)  # 预热，排除第一次调用的初始化开销
+        generated, prefill_seconds, decode_seconds = greedy(model, prompt_ids, args.max_new_tokens, eos_ids)
+        outputs.append(generated)
+        prefill += prefill_seconds
+        decode += decode_seconds
+        decoded += len(generated) - 1
+
+    reference = baseline if baseline is not None else outputs
+    scores = [score(model, prompt_ids, ref) for prompt_ids, ref in zip(prompts, reference)]
+    result = {
+        'mode': mode,
+        'load_seconds': round(load_seconds, 2),
+        'weight_mb': round(weight_bytes(model) / (1 << 20), 1),
+        'prefill_ms': round(prefill / len(prompts) * 1000, 1),
+        'decode_tokens_per_second': round(decoded / decode, 2) if decode else 0.0,
+        'top1_agreement': round(sum(agreement for agreement, _ in scores) / len(scores), 4),
+        'reference_perplexity': round(math.exp(sum(nll for _, nll in scores) / len(scores)), 4),
+        'exact_match': f'{sum(out == ref for out, ref in zip(outputs, reference))}/{len(prompts)}',
+    }
+    del model
+    gc.collect()
+    return result, outputs
+
+
+def main() -> None:
+    parser = configargparse.ArgParser(description='Accuracy and latency of quantized loading modes',
+                                      ignore_unknown_config_file_keys=True)
+    parser.add_argument('-c', '--config', is_config_file=True, help='config file path', default='./config/config.ini')
+    parser.add_argument('--model_path', help='Path of the model')
+    parser.add_argument('--modes', nargs='+', choices=QUANTIZATION_MODES, default=['none', 'int8_dynamic'],
+                        help='Modes to compare, the first one is the baseline')
+    parser.add_argument('--quantization_group_size', type=int, default=128, help='Group size of int4 weight-only scales')
+    parser.add_argument('--max_new_tokens', type=int, default=64, help='Tokens generated per prompt')
+    parser.add_argument('--prompts', default='', help='JSON file with a list of questions, defaults to the built-in set')
+    parser.add_argument('--device', default='auto', help='auto, cpu, cuda, cuda:N or mps')
+    parser.add_argument('--threads', type=int, default=0, help='torch CPU threads, 0 keeps the default')
+    parser.add_argument('--output', default='', help='Also write the results to this JSON file')
+    args, _ = parser.parse_known_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    questions = PROMPTS
+    if args.prompts:
+        with open(args.prompts, encoding='utf-8') as f:
+            questions = json.load(f)
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path, use_fast=True)
+    prompts = [_encode(tokenizer, question) for question in questions]
+
+    results, baseline = [], None
+    for mode in args.modes:
+        try:
+            result, outputs = evaluate(mode, args, tokenizer, prompts, baseline)
+        except (ImportError, RuntimeError, ValueError) as e:
+            print(f'{mode}: 跳过，{e}')
+            continue
+        if baseline is None:
+            baseline = outputs
+        results.append(result)
+
+    if not results:
+        return
+    columns = list(results[0])
+    print('| ' + ' | '.join(columns) + ' |')
+    print('|' + '---|' * len(columns))
+    for result in results:
+        print('| ' + ' | '.join(str(result[column]) for column in columns) + ' |')
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'baseline': results[0]['mode'], 'prompts': questions, 'results': results}, f,
+                      ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import torch
+from torch import nn
+
+from device import device_map_for, resolve_device
+
+
+QUANTIZATION_MODES = ('none', 'int8_dynamic', 'int8_weight_only', 'int4_weight_only')
+
+
+def _language_linear(module: nn.Module, name: str) -> bool:
+    # 只量化语言模型和 lm_head：视觉编码器每个媒体只跑一次，耗时占比小，对精度更敏感
+    return isinstance(module, nn.Linear) and not name.startswith(('visual', 'model.visual'))
+
+
+def load_model(model_cls, model_path: str, mode: str = 'none', group_size: int = 128, device: str = 'auto'):
+    """按量化方式加载模型，device 的写法见 device.resolve_device
+
+    none             bfloat16，与原来相同
+    int8_dynamic     CPU 上的 int8 动态量化：Linear 权重存 int8，激活按行动态量化，用 fbgemm/onednn 的 int8 矩阵乘；
+                     其余部分为 float32（CPU 上 bf16 矩阵乘很慢，float32 反而更快）
+    int8_weight_only 只量化权重，计算时反量化为 bf16；需要 torchao，没有时在 CUDA 上退回 bitsandbytes
+    int4_weight_only 同上，按 group_size 分组的 int4 权重
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f'unknown quantization mode: {mode}')
+
+    device_map = device_map_for(device)
+    device_type = resolve_device(device).type
+    if mode == 'int8_dynamic':
+        if device_type != 'cpu':
+            raise ValueError('int8_dynamic only runs on CPU, set device = cpu or use int8_weight_only on GPU')
+        model = model_cls.from_pretrained(model_path, torch_dtype=torch.float32, device_map='cpu')
+        # 按输出通道分别取 scale，比整个矩阵一个 scale 的默认配置精度高得多
+        qconfig = torch.ao.quantization.per_channel_dynamic_qconfig
+        spec = {name: qconfig for name, module in model.named_modules() if _language_linear(module, name)}
+        torch.ao.quantization.quantize_dynamic(model, spec, dtype=torch.qint8, inplace=True)
+        return model.eval()
+
+    if mode == 'none':
+        return model_cls.from_pretrained(model_path, torch_dtype=torch.bfloat16, device_map=device_map)
+
+    try:
+        from torchao.quantization import quantize_
+    except ImportError:
+        if device_type != 'cuda':
+            raise RuntimeError(f'{mode} without CUDA requires torchao (pip install torchao)')
+        return model_cls.from_pretrained(model_path, torch_dtype=torch.bfloat16, device_map=device_map,
+                                         quantization_config=_bitsandbytes_config(mode))
+    model = model_cls.from_pretrained(model_path, torch_dtype=torch.bfloat16, device_map=device_map)
+    quantize_(model, _torchao_config(mode, group_size), filter_fn=_language_linear)
+    return model.eval()
+
+
+def _torchao_config(mode: str, group_size: int):
+    from torchao import quantization
+
+    # 新版 torchao 用配置类，旧版（0.8 及以前）用同名的小写函数
+    if mode == 'int8_weight_only':
+        config = getattr(quantization, 'Int8WeightOnlyConfig', None)
+        return config() if config is not None else quantization.int8_weight_only()
+    config = getattr(quantization, 'Int4WeightOnlyConfig', None)
+    if config is not None:
+        return config(group_size=group_size)
+    return quantization.int4_weight_only(group_size=group_size)
+
+
+def _bitsandbytes_config(mode: str):
+    from transformers import BitsAndBytesConfig
+
+    skip = ['visual', 'lm_head']
+    if mode == 'int8_weight_only':
+        return BitsAndBytesConfig(load_in_8bit=True, llm_int8_skip_modules=skip)
+    return BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_quant_type='nf4', bnb_4bit_compute_dtype=torch.bfloat16,
+                              llm_int8_skip_modules=skip)
+
+
+def weight_bytes(model: nn.Module) -> int:
+    """模型权重实际占用的字节数（量化后的 int8/int4 数据加上 scale 等），tied 的权重只算一次"""
+    def nbytes(value) -> int:
+        if isinstance(value, (tuple, list)):
+            return sum(nbytes(item) for item in value)
+        if not isinstance(value, torch.Tensor):
+            return 0
+        if hasattr(value, '__tensor_flatten__'):
+            # torchao 的量化张量是包装了 int 数据和 scale 的张量子类
+            names, _ = value.__tensor_flatten__()
+            return sum(nbytes(getattr(value, name)) for name in names)
+        size = value.numel() * value.element_size()
+        if value.is_quantized and value.qscheme() in (torch.per_channel_affine, torch.per_channel_symmetric):
+            size += nbytes(value.q_per_channel_scales()) + nbytes(value.q_per_channel_zero_points())
+        return size
+
+    unique = {id(value): value for value in model.state_dict(keep_vars=True).values()}
+    return sum(nbytes(value) for value in unique.values())
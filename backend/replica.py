@@ -0,0 +1,337 @@
+import contextlib
+import itertools
+import json
+import socket
+import socketserver
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import configargparse
+
+import metrics
+from logger import MyLogger
+from scheduler import CancelToken, QueueFullError
+
+
+LOGGER = MyLogger()
+
+# 前端与推理副本之间的协议：每个请求一条 TCP 连接，双方都按行发送 JSON。
+# 前端发送一行请求，副本逐行回复：流式对话每段文本一行，最后一行带 response；出错时回复一行带 error 的消息。
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def _write_message(stream, message: Dict[str, Any]) -> None:
+    stream.write(json.dumps(message, ensure_ascii=False).encode('utf-8') + b'\n')
+    stream.flush()
+
+
+def _read_message(stream) -> Optional[Dict[str, Any]]:
+    line = stream.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+
+def _shutdown(sock: socket.socket) -> None:
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass  # 已经关闭
+
+
+class ReplicaUnavailableError(RuntimeError):
+    """没有可以连接的推理副本"""
+
+
+class ReplicaServer(socketserver.ThreadingTCPServer):
+    """推理副本：持有模型和各个 Bot（以及它们的会话历史），处理前端转发过来的请求
+
+    每条连接一个线程，线程里直接调用 Bot，生成仍由共享的推理引擎完成（本地模型时合并成批次）。
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address: str, bots: Dict[str, Any], engine) -> None:
+        self.bots = bots
+        self.engine = engine
+        super().__init__(parse_address(address), _ReplicaHandler)
+
+    def dispatch(self, message: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        op = message.get('op')
+        if op == 'load':
+            yield {'load': self.engine.load()}
+            return
+        if op == 'metrics':
+            yield metrics.snapshot()
+            return
+        if op == 'warm':
+            # 预解码在后台线程进行，立即回复，不占用前端的上传请求
+            threading.Thread(target=self.engine.warm_media, args=(message['item'],), daemon=True).start()
+            yield {'ok': True}
+            return
+
+        bot = self.bots[message['bot_type']]
+        if op == 'locate':
+            # 只查看不读取：in 会把磁盘上的会话读回本副本的内存，探测本身就会让会话换到这个副本
+            yield {'has_session': bot.user_histories.peek(message['user_id']), 'load': self.engine.load()}
+        elif op == 'chat':
+            args = (message['user_id'], message['new_messages'], message['max_length'])
+            if message.get('stream'):
+                yield from bot.stream_response(*args, system_prompt=message.get('system_prompt'))
+            else:
+                yield bot.reply(*args, system_prompt=message.get('system_prompt'))
+        elif op == 'reset':
+            bot.reset_history(message['user_id'])
+            yield {'ok': True}
+        elif op == 'refresh':
+            bot.refresh_system_prompt()
+            yield {'ok': True}
+        else:
+            raise ValueError(f'unknown op: {op}')
+
+
+class _ReplicaHandler(socketserver.StreamRequestHandler):
+
+    def handle(self) -> None:
+        message = _read_message(self.rfile)
+        if message is None:
+            return
+        try:
+            # 前端断开后写入失败，关闭 dispatch 生成器，Bot 随之取消还在进行的生成
+            with contextlib.closing(self.server.dispatch(message)) as replies:
+                for reply in replies:
+                    _write_message(self.wfile, reply)
+        except QueueFullError as e:
+            _write_message(self.wfile, {'error': str(e), 'status': 429, 'retry_after': e.retry_after})
+        except (BrokenPipeError, ConnectionResetError):
+            LOGGER.warning(f"前端断开连接: {message.get('op')} {message.get('user_id')}")
+        except Exception as e:
+            LOGGER.exception(f'副本处理请求失败: {e}')
+            _write_message(self.wfile, {'error': str(e), 'status': 500})
+
+
+class ReplicaClient(object):
+
+    def __init__(self, address: str, connect_timeout: float = 5, timeout: float = 600) -> None:
+        self.address = address
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+
+    def request(self, message: Dict[str, Any], cancel_token: Optional[CancelToken] = None) -> Iterator[Dict[str, Any]]:
+        """发送一条请求并逐条产出回复，副本返回错误时抛出对应的异常
+
+        cancel_token 被取消时断开连接，副本下一次写入失败后取消对应的生成，这里随之读到连接结束
+        """
+        try:
+            sock = socket.create_connection(parse_address(self.address), timeout=self.connect_timeout)
+        except OSError as e:
+            raise ReplicaUnavailableError(f'{self.address}: {e}') from e
+        sock.settimeout(self.timeout)
+        if cancel_token is not None:
+            cancel_token.bind(lambda: _shutdown(sock))
+        with sock, sock.makefile('rwb') as stream:
+            _write_message(stream, message)
+            while True:
+                try:
+                    reply = _read_message(stream)
+                except OSError:
+                    # gevent 下断开连接会让正在等待读取的一方直接出错
+                    if cancel_token is not None and cancel_token.cancelled:
+                        return
+                    raise
+                if reply is None:
+                    return
+                if 'error' in reply:
+                    if reply.get('status') == 429:
+                        raise QueueFullError(reply['retry_after'])
+                    raise RuntimeError(f"{self.address}: {reply['error']}")
+                yield reply
+
+    def call(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        for reply in self.request(message):
+            return reply
+        raise ReplicaUnavailableError(f'{self.address}: connection closed without reply')
+
+
+class ReplicaRouter(object):
+    """为每个请求挑选推理副本
+
+    会话历史只存在处理过它的副本里。前端记住每个会话上次发往的副本，之后直接发给它；
+    不知道时（新会话、前端重启或副本出错后）才问一遍各个副本谁持有该会话，
+    都没有时选当前负载最低的副本，负载相同时轮流分配。
+    """
+
+    def __init__(self, addresses: List[str], connect_timeout: float = 5, timeout: float = 600,
+                 max_affinity: int = 100000) -> None:
+        self.clients = [ReplicaClient(address, connect_timeout, timeout) for address in addresses]
+        self._rotation = itertools.count()
+        # (bot_type, user_id) -> 副本，按最近使用排序，超过 max_affinity 时丢弃最久未用的
+        self.max_affinity = max_affinity
+        self._affinity: 'OrderedDict[Tuple[str, str], ReplicaClient]' = OrderedDict()
+
+    def route(self, bot_type: str, user_id: str) -> ReplicaClient:
+        key = (bot_type, user_id)
+        client = self._affinity.get(key)
+        if client is not None:
+            self._affinity.move_to_end(key)
+            return client
+        client = self._locate(bot_type, user_id)
+        self._affinity[key] = client
+        if len(self._affinity) > self.max_affinity:
+            self._affinity.popitem(last=False)
+        return client
+
+    def forget(self, bot_type: str, user_id: str) -> None:
+        """会话所在的副本连不上时调用，下一次请求重新查找"""
+        self._affinity.pop((bot_type, user_id), None)
+
+    def _locate(self, bot_type: str, user_id: str) -> ReplicaClient:
+        start = next(self._rotation) % len(self.clients)
+        candidates = []
+        for client in self.clients[start:] + self.clients[:start]:
+            try:
+                reply = client.call({'op': 'locate', 'bot_type': bot_type, 'user_id': user_id})
+            except (ReplicaUnavailableError, OSError) as e:
+                LOGGER.warning(f'推理副本不可用: {e}')
+                continue
+            if reply['has_session']:
+                return client
+            candidates.append((reply['load'], client))
+        if not candidates:
+            raise ReplicaUnavailableError('no inference replica is reachable')
+        return min(candidates, key=lambda candidate: candidate[0])[1]
+
+    def warm_media(self, item: Dict[str, Any]) -> None:
+        """让负载最低的副本提前预解码刚上传的媒体文件；副本配置了共享的 media_cache_dir 时其他副本也能命中"""
+        candidates = []
+        for client in self.clients:
+            try:
+                candidates.append((client.call({'op': 'load'})['load'], client))
+            except (ReplicaUnavailableError, OSError) as e:
+                LOGGER.warning(f'推理副本不可用: {e}')
+        if candidates:
+            min(candidates, key=lambda candidate: candidate[0])[1].call({'op': 'warm', 'item': item})
+
+    def reachable(self) -> int:
+        """能连上的副本数；副本在模型加载和预热完成后才开始监听"""
+        count = 0
+        for client in self.clients:
+            try:
+                client.call({'op': 'load'})
+                count += 1
+            except (ReplicaUnavailableError, OSError):
+                pass
+        return count
+
+    def metrics(self) -> Dict[str, Dict[str, Any]]:
+        """各个副本的指标快照 {副本地址: snapshot}，连不上的副本跳过"""
+        snapshots = {}
+        for client in self.clients:
+            try:
+                snapshots[client.address] = client.call({'op': 'metrics'})
+            except (ReplicaUnavailableError, OSError) as e:
+                LOGGER.warning(f'推理副本不可用: {e}')
+        return snapshots
+
+    def broadcast(self, message: Dict[str, Any]) -> None:
+        for client in self.clients:
+            try:
+                client.call(message)
+            except (ReplicaUnavailableError, OSError) as e:
+                LOGGER.warning(f'推理副本不可用: {e}')
+
+
+class RemoteBot(object):
+    """HTTP 前端里代替 Bot 的代理，接口与 Bot 一致，实际生成转发给推理副本"""
+
+    def __init__(self, router: ReplicaRouter, bot_type: str) -> None:
+        self.router = router
+        self.bot_type = bot_type
+
+    def _chat(self, user_id: str, new_messages, max_length: int, system_prompt, stream: bool,
+              cancel_token: Optional[CancelToken] = None) -> Iterator[Dict]:
+        client = self.router.route(self.bot_type, user_id)
+        try:
+            yield from client.request({
+                'op': 'chat',
+                'bot_type': self.bot_type,
+                'user_id': user_id,
+                'new_messages': new_messages,
+                'max_length': max_length,
+                'system_prompt': system_prompt,
+                'stream': stream,
+            }, cancel_token)
+        except ReplicaUnavailableError:
+            self.router.forget(self.bot_type, user_id)
+            raise
+
+    def generate_response(self, user_id: str, new_messages, max_length: int, system_prompt=None) -> str:
+        for reply in self._chat(user_id, new_messages, max_length, system_prompt, stream=False):
+            return reply['response']
+        raise ReplicaUnavailableError('connection closed without reply')
+
+    def reply(self, user_id: str, new_messages, max_length: int, system_prompt=None,
+              cancel_token: Optional[CancelToken] = None) -> Dict[str, Any]:
+        # 副本按流式生成：只有逐段写回时，副本才能在前端断开后的下一次写入时发现并取消生成
+        result = None
+        for reply in self._chat(user_id, new_messages, max_length, system_prompt, True, cancel_token):
+            result = reply
+        if result is None or 'response' not in result:
+            if cancel_token is not None and cancel_token.cancelled:
+                return {'response': '', 'usage': {'finish_reason': 'cancelled'}}
+            raise ReplicaUnavailableError('connection closed without reply')
+        return result
+
+    def stream_response(self, user_id: str, new_messages, max_length: int, system_prompt=None,
+                        cancel_token: Optional[CancelToken] = None) -> Iterator[Dict]:
+        replies = self._chat(user_id, new_messages, max_length, system_prompt, True, cancel_token)
+        # 先读到第一条回复，副本队列已满时在这里就抛出 QueueFullError，与 Bot.stream_response 一致
+        first = next(replies, None)
+        if first is None:
+            raise ReplicaUnavailableError('connection closed without reply')
+        return itertools.chain([first], replies)
+
+    def reset_history(self, user_id: str) -> None:
+        self.router.broadcast({'op': 'reset', 'bot_type': self.bot_type, 'user_id': user_id})
+
+    def refresh_system_prompt(self) -> None:
+        self.router.broadcast({'op': 'refresh', 'bot_type': self.bot_type})
+
+
+def main() -> None:
+    parser = configargparse.ArgParser(description='Inference replica', ignore_unknown_config_file_keys=True)
+    parser.add_argument('-c', '--config', is_config_file=True,
+                        help='config file path', default='./config/config.ini')
+    parser.add_argument('--replica_listen', default='127.0.0.1:6001', help='host:port this replica listens on')
+    args, _ = parser.parse_known_args()
+
+    from model import get_model
+    from chatbot import AstronomyBot, BotShop, ChatBot, ElectricityBot, MechanicsBot
+    from startup import STARTUP
+
+    qw_model = get_model()
+
+    bots = {
+        'normal': BotShop(ChatBot).buy_bot(qw_model=qw_model, max_history=8),
+        'astronomy': BotShop(AstronomyBot).buy_bot(qw_model=qw_model, max_history=8),
+        'electricity': BotShop(ElectricityBot).buy_bot(qw_model=qw_model, max_history=8),
+        'mechanics': BotShop(MechanicsBot).buy_bot(qw_model=qw_model, max_history=8),
+    }
+    # 预热完成后才监听端口：滚动重启时前端在此之前连不上新副本，请求继续发给其他副本
+    qw_model.warm_up()
+    metrics.watch(bots, qw_model.engine)
+    server = ReplicaServer(args.replica_listen, bots, qw_model.engine)
+    STARTUP.mark_ready()
+    LOGGER.info(f'推理副本监听 {args.replica_listen}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""在一台机器上检查 HTTP 前端 + 推理副本的部署方式
+
+    python replica_check.py --model_path ./tiny-model
+    python replica_check.py --engine hf --model_path ./tiny-model
+
+启动 replicas 个 replica.py 子进程（默认 fake 引擎，只需要分词器；hf 时用小模型真正生成），
+本进程按 wsgi.py --replica_addresses 的方式作为前端，通过 HTTP 依次检查：
+  - 路由：每个会话只在一个副本上有历史，多个会话分散到各个副本
+  - 会话亲和：同一会话的第二轮发往同一副本，prompt 里带着第一轮的历史
+  - 取消：流式请求读到第一段后断开，副本上的生成随之取消，且这一轮不写入历史
+  - 指标：前端 /metrics 汇总了各个副本的请求数，带 replica 标签
+有检查不通过时打印出来并以非零状态退出。
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+from typing import Dict, List, Tuple
+
+import configargparse
+from prometheus_client.parser import text_string_to_metric_families
+
+
+BACKEND = os.path.dirname(os.path.abspath(__file__))
+
+
+def start_replicas(args, addresses: List[str]) -> List[subprocess.Popen]:
+    replicas = []
+    for address in addresses:
+        command = [sys.executable, 'replica.py', '--replica_listen', address, '--engine', args.engine,
+                   '--model_path', args.model_path, '--fake_token_latency', str(args.fake_token_latency),
+                   '--fake_output_tokens', str(args.fake_output_tokens), '--media_workers', '0']
+        replicas.append(subprocess.Popen(command, cwd=BACKEND, stdout=subprocess.DEVNULL,
+                                         stderr=subprocess.DEVNULL))
+    return replicas
+
+
+def chat(port: int, user_id: str, text: str, stream: bool = False):
+    body = json.dumps({'bot_type': {'value': 'normal'}, 'currentMessage': text, 'stream': stream}).encode()
+    return urllib.request.urlopen(urllib.request.Request(
+        f'http://127.0.0.1:{port}/chat', body,
+        {'Content-Type': 'application/json', 'Cookie': f'user_id={user_id}'}))
+
+
+def owners(router, user_id: str) -> List[str]:
+    """持有该会话历史的副本；locate 只查看，不会把会话读到别的副本上"""
+    return [client.address for client in router.clients
+            if client.call({'op': 'locate', 'bot_type': 'normal', 'user_id': user_id})['has_session']]
+
+
+def scrape(port: int) -> Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float]:
+    text = urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics').read().decode('utf-8')
+    return {(sample.name, tuple(sorted(sample.labels.items()))): sample.value
+            for family in text_string_to_metric_families(text) for sample in family.samples}
+
+
+def total(samples, name: str, **labels) -> float:
+    return sum(value for (sample, sample_labels), value in samples.items()
+               if sample == name and all(dict(sample_labels).get(k) == v for k, v in labels.items()))
+
+
+def main() -> None:
+    parser = configargparse.ArgParser(description='Front-end and inference replicas on one machine',
+                                      ignore_unknown_config_file_keys=True)
+    parser.add_argument('-c', '--config', is_config_file=True, help='config file path', default='./config/config.ini')
+    parser.add_argument('--model_path', help='Tokenizer (fake engine) or small model (hf engine) for the replicas')
+    parser.add_argument('--engine', choices=['fake', 'hf'], default='fake', help='Inference engine of the replicas')
+    parser.add_argument('--replicas', type=int, default=2, help='Replica processes to start')
+    parser.add_argument('--replica_port', type=int, default=6101, help='Port of the first replica')
+    parser.add_argument('--http_port', type=int, default=5101, help='Port of the front-end')
+    parser.add_argument('--users', type=int, default=4, help='Conversations, each with two turns')
+    parser.add_argument('--fake_token_latency', type=float, default=0.02, help='Seconds per token of the fake engine')
+    parser.add_argument('--fake_output_tokens', type=int, default=64, help='Tokens per request of the fake engine')
+    parser.add_argument('--startup_timeout', type=float, default=300, help='Seconds to wait for the replicas')
+    args, _ = parser.parse_known_args()
+
+    addresses = [f'127.0.0.1:{args.replica_port + index}' for index in range(args.replicas)]
+    replicas = start_replicas(args, addresses)
+    # wsgi.py 在 import 时解析参数，按前端模式启动
+    sys.argv = ['wsgi.py', '--origins', 'http://localhost', '--replica_addresses'] + addresses
+    sys.path.insert(0, BACKEND)
+    os.chdir(BACKEND)
+    import wsgi
+    from gevent.pywsgi import WSGIServer
+
+    failures = []
+
+    def check(name: str, ok: bool, detail='') -> None:
+        print(f'{name:<40} {"ok" if ok else "FAILED"} {detail}')
+        if not ok:
+            failures.append(name)
+
+    try:
+        deadline = time.time() + args.startup_timeout
+        while wsgi.router.reachable() < args.replicas:
+            if time.time() > deadline or any(replica.poll() is not None for replica in replicas):
+                print('replicas did not start')
+                sys.exit(1)
+            time.sleep(1)
+        server = WSGIServer(('127.0.0.1', args.http_port), wsgi.app, handler_class=wsgi.ChatHandler, log=None)
+        server.start()
+
+        users = [f'check-{index}' for index in range(args.users)]
+        first = {user: json.load(chat(args.http_port, user, '什么是牛顿第二定律？'))['usage'] for user in users}
+        placement = {user: owners(wsgi.router, user) for user in users}
+        check('each session lives on one replica', all(len(found) == 1 for found in placement.values()),
+              placement)
+        used = {found[0] for found in placement.values() if found}
+        check('sessions spread over replicas', len(used) == min(args.replicas, args.users), sorted(used))
+
+        second = {user: json.load(chat(args.http_port, user, '请举一个例子。'))['usage'] for user in users}
+        check('second turn carries the history',
+              all(second[user]['prompt_tokens'] > first[user]['prompt_tokens'] for user in users),
+              [(first[user]['prompt_tokens'], second[user]['prompt_tokens']) for user in users])
+        check('second turn stays on the same replica',
+              all(owners(wsgi.router, user) == placement[user] for user in users))
+
+        # 读到第一段输出后断开
+        response = chat(args.http_port, 'check-cancel', '讲讲万有引力。', stream=True)
+        while not response.readline().startswith(b'event: token'):
+            pass
+        response.close()
+        deadline = time.time() + 30
+        while (total(scrape(args.http_port), 'chatbot_requests_total', finish_reason='cancelled') < 1
+               and time.time() < deadline):
+            time.sleep(0.2)
+        samples = scrape(args.http_port)
+        check('disconnect cancels the generation',
+              total(samples, 'chatbot_requests_total', finish_reason='cancelled') == 1)
+        check('cancelled turn is not kept', owners(wsgi.router, 'check-cancel') == [])
+
+        per_replica = {address: total(samples, 'chatbot_requests_total', replica=address) for address in addresses}
+        check('/metrics aggregates every replica',
+              sum(per_replica.values()) == 2 * args.users + 1 and all(address in per_replica for address in used),
+              per_replica)
+        server.stop()
+    finally:
+        for replica in replicas:
+            replica.terminate()
+        for replica in replicas:
+            replica.wait()
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
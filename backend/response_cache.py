@@ -0,0 +1,105 @@
+import hashlib
+import json
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+from metrics import RESPONSE_CACHE
+from native import allocate_lock
+from scheduler import GenerationRequest
+
+
+class ResponseCache(object):
+    """纯文本回答的精确匹配缓存，相同的请求同时到达时只生成一次
+
+    键为 (Bot 名称, 规范化后的整段历史, 生成参数)；历史的第一条是 system prompt，
+    提示词改变后旧条目自然不再命中，按 LRU 和 TTL 淘汰。
+    条目保存的是生成请求本身：生成结束前到达的相同请求跟随它（follow）边生成边取，结束后的直接重放。
+    只缓存温度不超过 max_temperature 的请求，高温采样本来就期望每次回答不同。
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, max_temperature: float = 0.3) -> None:
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_temperature = max_temperature
+        self._entries: 'OrderedDict[str, _Entry]' = OrderedDict()
+        self._lock = allocate_lock()
+
+    def accepts(self, params) -> bool:
+        return params.temperature <= self.max_temperature
+
+    @staticmethod
+    def key(bot_name: str, history: List[Dict], params) -> str:
+        messages = [(msg['role'], _normalize(msg['content'])) for msg in history]
+        sampling = (params.max_new_tokens, params.temperature, params.top_p, params.top_k,
+                    params.repetition_penalty, params.min_new_tokens, list(params.stop))
+        payload = json.dumps([bot_name, messages, sampling], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get_or_submit(self, key: str, submit: Callable[[], GenerationRequest], bot_type: str) -> GenerationRequest:
+        """命中时返回跟随已有生成的请求，否则调用 submit 生成并记录；结果按 bot_type 计入 chatbot_response_cache"""
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry.expired(now, self.ttl_seconds):
+                    del self._entries[key]
+                    entry = None
+                owner = entry is None
+                if owner:
+                    # 先占位再提交，提交期间到达的相同请求等待这一次生成
+                    entry = self._entries[key] = _Entry(now)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+                else:
+                    self._entries.move_to_end(key)
+
+            if owner:
+                RESPONSE_CACHE.labels(bot_type, 'miss').inc()
+                try:
+                    entry.request = submit()
+                    entry.request.response_cache = 'miss'
+                    return entry.request
+                except BaseException:
+                    # 队列已满等情况不留下条目，等待者各自重新提交
+                    with self._lock:
+                        if self._entries.get(key) is entry:
+                            del self._entries[key]
+                    raise
+                finally:
+                    entry.submitted.set()
+
+            entry.submitted.wait()
+            if entry.request is None:
+                continue
+            label = 'hit' if entry.request.done.is_set() else 'coalesced'
+            RESPONSE_CACHE.labels(bot_type, label).inc()
+            follower = entry.request.follow()
+            follower.response_cache = label
+            return follower
+
+
+
+class _Entry(object):
+
+    def __init__(self, created_at: float) -> None:
+        self.created_at = created_at
+        self.request: Optional[GenerationRequest] = None
+        # submit 返回（或失败）后置位
+        self.submitted = threading.Event()
+
+    def expired(self, now: float, ttl_seconds: float) -> bool:
+        # 过期、生成失败、因超过截止时间或被取消而截断的不再复用
+        if now - self.created_at > ttl_seconds:
+            return True
+        return self.request is not None and (self.request.error is not None
+                                             or self.request.finish_reason in ('deadline', 'cancelled'))
+
+
+def _normalize(content) -> str:
+    # 全角/半角标点、首尾和连续空白不同的问题视为同一个问题
+    if not isinstance(content, str):
+        content = json.dumps(content, ensure_ascii=False, sort_keys=True)
+    return ' '.join(unicodedata.normalize('NFKC', content).split())
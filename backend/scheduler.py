@@ -0,0 +1,1111 @@
+import collections
+import contextlib
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import torch
+from transformers import DynamicCache, LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
+
+from device import input_device
+from kv_cache import PrefixCache, SessionKVCache, slice_past
+from logger import MyLogger
+from metrics import GENERATION_INTERRUPTED, WASTED_TOKENS
+from native import allocate_lock, get_original, start_new_thread
+from speculative import PromptLookupProposer
+from vision_cache import VisionEncoderCache
+
+
+LOGGER = MyLogger()
+_get_ident = get_original('_thread', 'get_ident')
+
+# 推理跑在原生系统线程上，否则一次 forward 就会卡住整个事件循环。请求的 Event 仍用 threading.Event
+# （patch 后即 gevent Event），gevent 的 Event 可以在别的系统线程里 set，等待方在协程里等待，不会阻塞事件循环。
+_WAIT_INTERVAL = 0.5
+
+
+class QueueFullError(RuntimeError):
+    """等待队列已满，调用方应在 retry_after 秒后重试"""
+
+    def __init__(self, retry_after: int) -> None:
+        super().__init__('generation queue is full')
+        self.retry_after = retry_after
+
+
+def _wait_event(event: threading.Event) -> None:
+    # 带超时轮询：gevent 下事件由原生线程置位，没有其它待处理事件时 hub 会误判为永久阻塞
+    while not event.wait(_WAIT_INTERVAL):
+        pass
+
+
+class WorkerJob(object):
+    """在推理线程里执行的任意函数，比如不经过批处理的多模态生成"""
+
+    def __init__(self, fn: Callable[[], Any]) -> None:
+        self.fn = fn
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self.done = threading.Event()
+
+    def run(self) -> None:
+        try:
+            self.result = self.fn()
+        except Exception as e:
+            self.error = e
+        self.done.set()
+
+    def wait(self):
+        _wait_event(self.done)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class CancelToken(object):
+    """HTTP 层持有的取消标记：客户端断开时调用 cancel()，绑定在上面的回调（取消生成请求、断开副本连接）依次执行"""
+
+    def __init__(self) -> None:
+        self.cancelled = False
+        self._callbacks: List[Callable[[], None]] = []
+
+    def bind(self, callback: Callable[[], None]) -> None:
+        if self.cancelled:
+            callback()
+        else:
+            self._callbacks.append(callback)
+
+    def cancel(self) -> None:
+        if self.cancelled:
+            return
+        self.cancelled = True
+        for callback in self._callbacks:
+            callback()
+
+
+class GenerationRequest(object):
+    """排队等待生成的单条请求，由调度线程填充结果"""
+
+    def __init__(self, prompt_ids: List[int], max_new_tokens: int, temperature: float = 1.0,
+                 top_p: float = 1.0, top_k: int = 0, session_id: Optional[str] = None,
+                 prefix: Optional[Tuple[str, List[int]]] = None, stop: Sequence[str] = (),
+                 deadline_seconds: float = 0, repetition_penalty: float = 1.0, min_new_tokens: int = 0) -> None:
+        self.prompt_ids = list(prompt_ids)
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.repetition_penalty = repetition_penalty
+        self.min_new_tokens = min_new_tokens
+        self.session_id = session_id
+        # (Bot 名称, system prompt 的 token)，用于共享的前缀 KV cache
+        self.prefix = prefix
+        # prefill 时直接从会话 / 前缀 KV cache 复用的 prompt token 数
+        self.cached_tokens = 0
+        self.output_ids: List[int] = []
+        self.finish_reason: Optional[str] = None
+        self.error: Optional[BaseException] = None
+        self.done = threading.Event()
+        # 每产生一个 token 或请求结束时置位，供流式输出的一方等待
+        self.updated = threading.Event()
+        self.submitted_at = time.perf_counter()
+        # 开始 prefill / generate 的时刻，之前都在排队
+        self.started_at: Optional[float] = None
+        self.first_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        # 停止串和截止时间（perf_counter 时刻，包括排队时间），见 limit_reached
+        self.stop = tuple(text for text in stop if text)
+        self.stop_string: Optional[str] = None
+        self.deadline = self.submitted_at + deadline_seconds if deadline_seconds > 0 else None
+        # 一个 token 至少对应半个字符（生僻字可能拆成多个字节 token），只解码结尾这么多 token 就能覆盖停止串
+        self._stop_window = 2 * max((len(text) for text in self.stop), default=0) + 2
+        # 投机解码的统计：草稿方式、提出 / 被接受的草稿 token 数、目标模型的 decode 次数
+        self.speculative: Optional[str] = None
+        self.draft_tokens = 0
+        self.accepted_tokens = 0
+        self.decode_steps = 0
+        # 经过响应缓存时为 hit / coalesced / miss，见 ResponseCache
+        self.response_cache: Optional[str] = None
+        # 等待同一生成结果的其他请求（响应缓存合并的相同请求），见 follow()
+        self._followers: List['GenerationRequest'] = []
+        self._followers_lock = allocate_lock()
+        self._leader: Optional['GenerationRequest'] = None
+        # 还在接收结果的消费者数（自己和跟随者），都取消后 cancelled 置位，调度器在下一步 decode 之前结束本请求
+        self._consumers = 1
+        self.cancelled = False
+
+    def push(self, token: int) -> None:
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        with self._followers_lock:
+            self.output_ids.append(token)
+            followers = list(self._followers)
+        self.updated.set()
+        for follower in followers:
+            follower.push(token)
+
+    def mark_done(self) -> None:
+        self.finished_at = time.perf_counter()
+        with self._followers_lock:
+            self.done.set()
+            followers, self._followers = self._followers, []
+        self.updated.set()
+        for follower in followers:
+            follower._finish_like(self)
+        # 跟随者没有单独占用生成，只统计实际生成的请求
+        if self._leader is None and self.finish_reason in ('cancelled', 'deadline'):
+            GENERATION_INTERRUPTED.labels(self.finish_reason).inc()
+            if self.finish_reason == 'cancelled':
+                WASTED_TOKENS.inc(len(self.output_ids))
+
+    def cancel(self) -> None:
+        """调用方不再需要结果（客户端断开）
+
+        跟随者只是离开，不影响其他仍在等待的消费者；所有消费者都离开后才真正停止生成。
+        """
+        if self.done.is_set():
+            return
+        if self._leader is not None:
+            self._leader._release(self)
+            self.finish_reason = 'cancelled'
+            self.mark_done()
+        else:
+            self._release(None)
+
+    def _release(self, follower: Optional['GenerationRequest']) -> None:
+        with self._followers_lock:
+            if follower is not None:
+                if follower not in self._followers:
+                    return
+                self._followers.remove(follower)
+            self._consumers -= 1
+            if self._consumers <= 0:
+                self.cancelled = True
+
+    def follow(self) -> 'GenerationRequest':
+        """返回跟随本请求的新请求：已生成的 token 立即可取，之后的 token 和结束状态与本请求同步
+
+        每个消费者各自持有一个请求对象，iter_tokens 清除 updated 时不会互相影响。
+        """
+        follower = GenerationRequest(self.prompt_ids, self.max_new_tokens, self.temperature, self.top_p,
+                                     self.top_k)
+        follower.cached_tokens = len(self.prompt_ids)
+        follower._leader = self
+        with self._followers_lock:
+            for token in self.output_ids:
+                follower.push(token)
+            finished = self.done.is_set()
+            if not finished:
+                self._followers.append(follower)
+                self._consumers += 1
+        if finished:
+            follower._finish_like(self)
+        return follower
+
+    def _finish_like(self, leader: 'GenerationRequest') -> None:
+        self.finish_reason = leader.finish_reason
+        self.stop_string = leader.stop_string
+        self.error = leader.error
+        self.mark_done()
+
+    def interrupted(self) -> Optional[str]:
+        """已被取消时返回 cancelled，超过截止时间时返回 deadline，否则返回 None；调度器在每步 decode 之前检查"""
+        if self.cancelled:
+            return 'cancelled'
+        if self.deadline is not None and time.perf_counter() >= self.deadline:
+            return 'deadline'
+        return None
+
+    def limit_reached(self, tokenizer) -> Optional[str]:
+        """每产生一个 token 后检查：生成出停止串时返回 stop，否则同 interrupted()"""
+        if self.stop:
+            tail = tokenizer.decode(self.output_ids[-self._stop_window:], skip_special_tokens=True)
+            for text in self.stop:
+                if text in tail:
+                    self.stop_string = text
+                    return 'stop'
+        return self.interrupted()
+
+    def wait(self) -> List[int]:
+        """阻塞直到生成结束，返回新生成的 token id"""
+        _wait_event(self.done)
+        if self.error is not None:
+            raise self.error
+        return self.output_ids
+
+    def iter_tokens(self) -> Iterator[int]:
+        """边生成边产出 token id，生成出错时在最后抛出异常"""
+        sent = 0
+        while True:
+            _wait_event(self.updated)
+            self.updated.clear()
+            while sent < len(self.output_ids):
+                yield self.output_ids[sent]
+                sent += 1
+            if self.done.is_set() and sent == len(self.output_ids):
+                break
+        if self.error is not None:
+            raise self.error
+
+    def usage(self) -> Dict[str, Any]:
+        usage = {
+            'prompt_tokens': len(self.prompt_ids),
+            'completion_tokens': len(self.output_ids),
+            'max_new_tokens': self.max_new_tokens,
+            'cached_tokens': self.cached_tokens,
+            'finish_reason': self.finish_reason,
+        }
+        if self.stop_string is not None:
+            usage['stop_string'] = self.stop_string
+        if self.started_at is not None:
+            usage['queue_wait'] = round(self.started_at - self.submitted_at, 4)
+        if self.first_token_at is not None:
+            usage['time_to_first_token'] = round(self.first_token_at - self.submitted_at, 4)
+        if self.finished_at is not None:
+            usage['latency'] = round(self.finished_at - self.submitted_at, 4)
+        if self.speculative is not None:
+            usage['speculative'] = self.speculative_stats()
+        if self.response_cache is not None:
+            usage['response_cache'] = self.response_cache
+        return usage
+
+    def speculative_stats(self) -> Dict[str, Any]:
+        # 第一个 token 来自 prefill，其余 token 平均每次 decode 得到的个数即相对逐个 decode 的步数加速比
+        decoded = max(len(self.output_ids) - 1, 0)
+        return {
+            'mode': self.speculative,
+            'draft_tokens': self.draft_tokens,
+            'accepted_tokens': self.accepted_tokens,
+            'acceptance_rate': round(self.accepted_tokens / self.draft_tokens, 4) if self.draft_tokens else 0.0,
+            'decode_steps': self.decode_steps,
+            'speedup': round(decoded / self.decode_steps, 4) if self.decode_steps else 1.0,
+        }
+
+
+class MultimodalRequest(GenerationRequest):
+    """带图片/视频的生成请求，inputs 是 processor 输出的单条样本（batch 维为 1）
+
+    调度线程把同时排队、采样参数相同的多条请求拼成一个 batch 调用一次 model.generate。
+    """
+
+    def __init__(self, inputs, max_new_tokens: int, visual_tokens: int, generation_kwargs: Dict[str, Any],
+                 session_id: Optional[str] = None, media_keys: Optional[Dict[str, List[Optional[str]]]] = None,
+                 stop: Sequence[str] = (), deadline_seconds: float = 0) -> None:
+        super().__init__(inputs['input_ids'][0].tolist(), max_new_tokens, session_id=session_id, stop=stop,
+                         deadline_seconds=deadline_seconds)
+        self.inputs = inputs
+        self.visual_tokens = visual_tokens
+        self.generation_kwargs = generation_kwargs
+        self.media_keys = media_keys or {}
+
+
+class _BatchStreamer(BaseStreamer):
+    """把 model.generate 每一步产生的 token 按行分发给对应的请求，某一行结束后立即通知该请求"""
+
+    def __init__(self, requests: List[GenerationRequest], append_token: Callable[[GenerationRequest, int], bool]) -> None:
+        self.requests = requests
+        self.append_token = append_token
+        self.prompt_received = False
+
+    def put(self, value) -> None:
+        # generate 第一次调用 put 传入的是 prompt
+        if not self.prompt_received:
+            self.prompt_received = True
+            return
+        # 投机解码（prompt lookup）时一步可能确认多个 token，除第一个外都是被接受的草稿
+        for request, tokens in zip(self.requests, value.reshape(len(self.requests), -1).tolist()):
+            request.accepted_tokens += len(tokens) - 1
+            for token in tokens:
+                # 已结束的行 generate 仍会继续填充 pad token
+                if request.finish_reason is None and self.append_token(request, token):
+                    request.mark_done()
+
+    def end(self) -> None:
+        for request in self.requests:
+            if not request.done.is_set():
+                request.finish_reason = request.finish_reason or 'length'
+                request.mark_done()
+
+
+class _RequestsFinished(StoppingCriteria):
+    """各行的请求结束（遇到 EOS、停止串，达到各自的 max_new_tokens 或截止时间，或被取消）后停止该行，
+    全部结束时 generate 返回
+    """
+
+    def __init__(self, requests: List[GenerationRequest], pause: Optional[Callable[[], None]] = None) -> None:
+        self.requests = requests
+        self.pause = pause
+
+    def __call__(self, input_ids: torch.Tensor, scores: torch.Tensor, **kwargs) -> torch.Tensor:
+        # 每一步之后把模型交回调度线程，等它走完一步文本 decode 再继续
+        if self.pause is not None:
+            self.pause()
+        for request in self.requests:
+            # 两步之间被取消的行不必等到下一个 token
+            if request.finish_reason is None and request.cancelled:
+                request.finish_reason = 'cancelled'
+                request.mark_done()
+        return torch.tensor([request.finish_reason is not None for request in self.requests],
+                            dtype=torch.bool, device=input_ids.device)
+
+
+class _ShiftRopeDeltas(LogitsProcessor):
+    """prefill 之后、第一步 decode 之前把每行的 rope_deltas 加上该行左侧 padding 的长度，只执行一次"""
+
+    def __init__(self, owner, padding: torch.Tensor) -> None:
+        self.owner = owner
+        self.padding = padding
+        self.applied = False
+
+    def __call__(self, input_ids: torch.Tensor, scores: torch.Tensor) -> torch.Tensor:
+        if not self.applied:
+            self.applied = True
+            self.owner.rope_deltas = self.owner.rope_deltas + self.padding.to(self.owner.rope_deltas.device)
+        return scores
+
+
+class _InterleavedRun(object):
+    """在单独的系统线程里执行一次多模态 generate，但与调度线程轮流使用模型
+
+    generate 每走完一步（prefill 或一步 decode）就在 pause 里停下，直到调度线程调用 step 才继续，
+    两个线程不会同时执行 forward。这样多模态请求生成期间，正在 decode 的文本 batch 仍然每轮前进一步。
+    """
+
+    def __init__(self, batch: List[MultimodalRequest]) -> None:
+        self.batch = batch
+        self.finished = False
+        # _turn 由调度线程释放，允许 generate 继续；_yielded 由 generate 线程在停下或结束时释放
+        self._turn = allocate_lock()
+        self._turn.acquire()
+        self._yielded = allocate_lock()
+        self._yielded.acquire()
+
+    def start(self, target: Callable[['_InterleavedRun'], None]) -> None:
+        def run():
+            self._turn.acquire()
+            try:
+                target(self)
+            finally:
+                self.finished = True
+                self._yielded.release()
+
+        start_new_thread(run, ())
+
+    def pause(self) -> None:
+        """generate 线程里调用"""
+        self._yielded.release()
+        self._turn.acquire()
+
+    def step(self) -> None:
+        """调度线程里调用：让 generate 执行到下一次 pause 或结束"""
+        self._turn.release()
+        self._yielded.acquire()
+
+
+class BatchScheduler(object):
+    """连续批处理调度器
+
+    所有 Bot 共享同一个模型，并发请求先进入队列，调度线程逐步执行 decode：
+    新请求单独 prefill 后拼入正在运行的 batch（左侧 padding 对齐 KV cache），
+    结束的序列在每一步之后立刻离开 batch，空出的位置由排队的请求补上。
+    调度线程是独立的系统线程，所有用到模型的操作都在这里串行执行；等待队列有上限，
+    满了直接抛 QueueFullError，由 HTTP 层返回 429，而不是无限堆积。
+    带图片/视频的请求另外排队，同时到达的若干条按视觉 token 预算合成一个 padded batch 一次 generate；
+    generate 在单独的线程里执行，每一步之后与文本 batch 的 decode 轮流进行（见 _InterleavedRun），同一时间只有一批。
+    给出 speculator 时文本请求使用投机解码：每步为每条序列提出若干草稿 token，目标模型一次 forward 同时验证，
+    按投机采样的规则接受，输出分布与逐个采样相同；单条的多模态批次用 transformers 的 prompt lookup。
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size: int = 8,
+                 kv_cache: Optional[SessionKVCache] = None,
+                 prefix_cache: Optional[PrefixCache] = None,
+                 max_queue_size: int = 64, retry_after: int = 5,
+                 multimodal_token_budget: int = 16384,
+                 vision_cache: Optional[VisionEncoderCache] = None,
+                 speculator=None) -> None:
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.multimodal_token_budget = multimodal_token_budget
+        self.max_queue_size = max_queue_size
+        self.retry_after = retry_after
+        self.kv_cache = kv_cache
+        self.prefix_cache = prefix_cache
+        self.vision_cache = vision_cache
+        self.speculator = speculator
+        if vision_cache is not None:
+            vision_cache.install(model)
+        self.eos_token_ids = self._collect_eos_ids()
+        config = getattr(model, 'config', None)
+        self._visual_token_ids = [token_id for token_id in (getattr(config, 'image_token_id', None),
+                                                            getattr(config, 'video_token_id', None))
+                                  if token_id is not None]
+
+        # deque 的 append / popleft 本身是线程安全的；_wakeup 是系统锁，当作信号量唤醒空闲的调度线程
+        self._pending: Deque[GenerationRequest] = collections.deque()
+        self._jobs: Deque[WorkerJob] = collections.deque()
+        self._multimodal: Deque[MultimodalRequest] = collections.deque()
+        self._padding_shifts_rope: Optional[bool] = None
+        # 正在生成的多模态批次
+        self._multimodal_run: Optional[_InterleavedRun] = None
+        self._wakeup = allocate_lock()
+        self._wakeup.acquire()
+        self._start_lock = allocate_lock()
+        self._started = False
+
+        # 正在 decode 的 batch 状态，各张量第 0 维与 self._active 一一对应
+        self._active: List[GenerationRequest] = []
+        self._past: Optional[Tuple[Tuple[torch.Tensor, torch.Tensor], ...]] = None
+        self._attention_mask: Optional[torch.Tensor] = None
+        self._positions: Optional[torch.Tensor] = None
+        self._next_tokens: Optional[torch.Tensor] = None
+        self._device: Optional[torch.device] = None
+
+    @property
+    def device(self) -> torch.device:
+        # device_map 切分到多张卡时输入放在词嵌入所在的卡上，模型不会移动，只查一次
+        if self._device is None:
+            self._device = input_device(self.model)
+        return self._device
+
+    def _collect_eos_ids(self) -> set:
+        eos_ids = set()
+        generation_config = getattr(self.model, 'generation_config', None)
+        configured = getattr(generation_config, 'eos_token_id', None)
+        if isinstance(configured, int):
+            eos_ids.add(configured)
+        elif configured:
+            eos_ids.update(configured)
+        if self.tokenizer.eos_token_id is not None:
+            eos_ids.add(self.tokenizer.eos_token_id)
+        return eos_ids
+
+    def submit(self, prompt_ids: List[int], max_new_tokens: int, temperature: float = 1.0,
+               top_p: float = 1.0, top_k: int = 0, session_id: Optional[str] = None,
+               prefix: Optional[Tuple[str, List[int]]] = None, stop: Sequence[str] = (),
+               deadline_seconds: float = 0, repetition_penalty: float = 1.0,
+               min_new_tokens: int = 0) -> GenerationRequest:
+        """把请求放进队列，立即返回，调用方通过 request.wait() 取结果
+
+        带 session_id 的请求会复用该会话上一轮留下的 KV cache，结束后再把新的 cache 存回去；
+        会话没有可用 cache 时，用 prefix 指定的共享 system prompt cache 跳过这部分 prefill
+        """
+        self.check_capacity()
+        request = GenerationRequest(prompt_ids, max_new_tokens, temperature, top_p, top_k, session_id, prefix,
+                                    stop=stop, deadline_seconds=deadline_seconds,
+                                    repetition_penalty=repetition_penalty, min_new_tokens=min_new_tokens)
+        if self.speculator is not None:
+            request.speculative = self.speculator.name
+        self._pending.append(request)
+        self._notify()
+        return request
+
+    def submit_multimodal(self, inputs, max_new_tokens: int, session_id: Optional[str] = None,
+                          media_keys: Optional[Dict[str, List[Optional[str]]]] = None, stop: Sequence[str] = (),
+                          deadline_seconds: float = 0, **generation_kwargs) -> MultimodalRequest:
+        """提交一条多模态请求，inputs 为已经放到模型设备上的单条 processor 输出，generation_kwargs 传给 generate
+
+        media_keys 按类型给出各图片/视频的内容键（与 inputs 中的顺序一致），与 session_id 一起用于缓存视觉编码结果
+        """
+        self.check_capacity()
+        input_ids = inputs['input_ids']
+        visual_tokens = sum(int((input_ids == token_id).sum()) for token_id in self._visual_token_ids)
+        request = MultimodalRequest(inputs, max_new_tokens, visual_tokens, generation_kwargs, session_id, media_keys,
+                                    stop=stop, deadline_seconds=deadline_seconds)
+        self._multimodal.append(request)
+        self._notify()
+        return request
+
+    def call(self, fn: Callable[[], Any]) -> WorkerJob:
+        """在调度线程里执行 fn（在两步 decode 之间），与批处理生成串行使用模型"""
+        self.check_capacity()
+        job = WorkerJob(fn)
+        self._jobs.append(job)
+        self._notify()
+        return job
+
+    def discard_session(self, session_id: str) -> None:
+        """丢弃会话的 KV cache。cache 只由调度线程访问，所以排进任务队列；不检查队列上限，也不等待执行"""
+        if self.kv_cache is None:
+            return
+        self._jobs.append(WorkerJob(lambda: self.kv_cache.discard(session_id)))
+        self._notify()
+
+    def queue_size(self) -> int:
+        return len(self._pending) + len(self._jobs) + len(self._multimodal)
+
+    def load(self) -> int:
+        """正在生成和排队的请求总数，多副本部署时用来选择最空闲的副本"""
+        running = len(self._multimodal_run.batch) if self._multimodal_run is not None else 0
+        return len(self._active) + running + self.queue_size()
+
+    def check_capacity(self) -> None:
+        """队列已满时抛出 QueueFullError，供调用方在改动会话状态之前提前检查"""
+        if self.queue_size() >= self.max_queue_size:
+            raise QueueFullError(self.retry_after)
+
+    def _notify(self) -> None:
+        with self._start_lock:
+            if not self._started:
+                self._started = True
+                start_new_thread(self._loop, ())
+        try:
+            self._wakeup.release()
+        except RuntimeError:
+            pass  # 已经处于唤醒状态
+
+    def generate(self, prompt_ids: List[int], max_new_tokens: int, **sampling) -> List[int]:
+        return self.submit(prompt_ids, max_new_tokens, **sampling).wait()
+
+    def _loop(self) -> None:
+        while True:
+            if (not self._pending and not self._active and not self._jobs and not self._multimodal
+                    and self._multimodal_run is None):
+                self._wakeup.acquire(timeout=1.0)
+                continue
+            if self._jobs:
+                self._jobs.popleft().run()
+            self._drop_interrupted()
+            if self._multimodal and self._multimodal_run is None:
+                self._multimodal_run = _InterleavedRun(self._take_multimodal())
+                self._multimodal_run.start(self._generate_multimodal)
+            try:
+                self._admit()
+                if self._active:
+                    self._speculative_step() if self.speculator is not None else self._step()
+            except Exception as e:
+                LOGGER.exception(f'批处理生成失败: {e}')
+                self._fail_all(e)
+            if self._multimodal_run is not None:
+                self._multimodal_run.step()
+                if self._multimodal_run.finished:
+                    self._multimodal_run = None
+
+    def _drop_interrupted(self) -> None:
+        """在两步 decode 之间结束被取消或超过截止时间的请求：排队的直接移出队列，正在生成的让出 batch 中的位置"""
+        for queue in (self._pending, self._multimodal):
+            for request in list(queue):
+                reason = request.interrupted()
+                if reason is not None:
+                    queue.remove(request)
+                    request.finish_reason = reason
+                    request.mark_done()
+        if not self._active:
+            return
+        keep = []
+        for index, request in enumerate(self._active):
+            reason = request.interrupted()
+            if reason is None:
+                keep.append(index)
+            else:
+                request.finish_reason = reason
+                self._finish(request, index)
+        if len(keep) != len(self._active):
+            self._retain(keep)
+
+    def _take_multimodal(self) -> List[MultimodalRequest]:
+        """按到达顺序取出一批多模态请求：采样参数相同，视觉 token 总数不超过预算（第一条总是取出）"""
+        batch = [self._multimodal.popleft()]
+        visual_tokens = batch[0].visual_tokens
+        while self._multimodal and len(batch) < self.max_batch_size:
+            request = self._multimodal[0]
+            if (request.generation_kwargs != batch[0].generation_kwargs
+                    or visual_tokens + request.visual_tokens > self.multimodal_token_budget):
+                break
+            batch.append(self._multimodal.popleft())
+            visual_tokens += request.visual_tokens
+        return batch
+
+    @torch.no_grad()
+    def _generate_multimodal(self, run: _InterleavedRun) -> None:
+        batch = run.batch
+        kwargs = dict(batch[0].generation_kwargs)
+        pad_token_id = kwargs.get('pad_token_id', self.tokenizer.pad_token_id) or 0
+        started_at = time.perf_counter()
+        for request in batch:
+            request.started_at = started_at
+        try:
+            inputs = _collate_multimodal([request.inputs for request in batch], pad_token_id)
+            LOGGER.debug(f'多模态批次: {len(batch)} 条, 视觉 token {sum(r.visual_tokens for r in batch)}')
+            padding = (inputs['attention_mask'] == 0).sum(dim=1, keepdim=True)
+            logits_processor = LogitsProcessorList()
+            if padding.any() and self._padding_shifts_positions():
+                logits_processor.append(_ShiftRopeDeltas(self._rope_owner(), padding))
+            # transformers 的辅助生成只支持 batch 为 1，且多模态输入没有可用的文本草稿模型，只用 prompt lookup
+            speculative = len(batch) == 1 and isinstance(self.speculator, PromptLookupProposer)
+            if speculative:
+                kwargs.update(prompt_lookup_num_tokens=self.speculator.num_tokens,
+                              max_matching_ngram_size=self.speculator.max_ngram)
+            with self._vision_keys(batch), self._count_verify_steps(batch[0] if speculative else None):
+                self.model.generate(
+                    **inputs,
+                    max_new_tokens=max(request.max_new_tokens for request in batch),
+                    streamer=_BatchStreamer(batch, self._append_token),
+                    stopping_criteria=StoppingCriteriaList([_RequestsFinished(batch, run.pause)]),
+                    logits_processor=logits_processor,
+                    **kwargs,
+                )
+        except Exception as e:
+            LOGGER.exception(f'多模态生成失败: {e}')
+            for request in batch:
+                if not request.done.is_set():
+                    request.error = e
+                    request.mark_done()
+
+    @contextlib.contextmanager
+    def _count_verify_steps(self, request: Optional[GenerationRequest]) -> Iterator[None]:
+        """统计 generate 内部投机解码的 decode 次数和草稿 token 数（prefill 之后每次 forward 除第一个以外的输入都是草稿），
+        被接受的草稿数由 _BatchStreamer 统计
+        """
+        if request is None:
+            yield
+            return
+
+        forwards = []
+        # generate 与文本 decode 交替执行，只统计 generate 所在线程的 forward
+        owner = _get_ident()
+
+        def count(module, args, kwargs):
+            if _get_ident() != owner:
+                return
+            forwards.append(kwargs['input_ids'].shape[1])
+            if len(forwards) > 1:
+                request.decode_steps += 1
+                request.draft_tokens += forwards[-1] - 1
+
+        request.speculative = self.speculator.name
+        handle = self.model.register_forward_pre_hook(count, with_kwargs=True)
+        try:
+            yield
+        finally:
+            handle.remove()
+
+    def _vision_keys(self, batch: List[MultimodalRequest]):
+        """按 batch 中的顺序给出每个图片/视频的 (会话, 内容键)，供视觉编码缓存使用"""
+        if self.vision_cache is None:
+            return contextlib.nullcontext()
+        keys = {'image': [], 'video': []}
+        for request in batch:
+            for kind in keys:
+                keys[kind] += [(request.session_id, key) if request.session_id and key else None
+                               for key in request.media_keys.get(kind, [])]
+        return self.vision_cache.using(keys)
+
+    def _rope_owner(self):
+        inner = getattr(self.model, 'model', None)
+        return inner if hasattr(inner, 'rope_deltas') else self.model
+
+    def _padding_shifts_positions(self) -> bool:
+        """当前 transformers 版本的 Qwen2.5-VL 在左侧 padding 时 decode 位置是否会偏移
+
+        有的版本 decode 时用 attention_mask 的累加和（不含 padding）加上 rope_deltas 作为位置，
+        而 rope_deltas 是 prefill 时按含 padding 的长度算的，padding 的行位置整体少了 padding 的长度。
+        这里不经过模型计算，直接调用一次 prepare_inputs_for_generation 看 decode 位置是否等于 cache_position。
+        """
+        if self._padding_shifts_rope is None:
+            owner = self._rope_owner()
+            if not hasattr(owner, 'rope_deltas'):
+                self._padding_shifts_rope = False
+                return False
+            saved = owner.rope_deltas
+            owner.rope_deltas = torch.zeros((1, 1), dtype=torch.long, device=self.device)
+            try:
+                model_inputs = self.model.prepare_inputs_for_generation(
+                    torch.tensor([[0, 0, 0]], device=self.device),
+                    past_key_values=DynamicCache(),
+                    attention_mask=torch.tensor([[0, 1, 1]], device=self.device),
+                    cache_position=torch.tensor([2], device=self.device),
+                    use_cache=True,
+                )
+                position_ids = model_inputs.get('position_ids')
+                self._padding_shifts_rope = position_ids is not None and int(position_ids.reshape(-1)[-1]) != 2
+            except Exception as e:
+                LOGGER.warning(f'无法确定多模态 decode 的位置计算方式，按不偏移处理: {e}')
+                self._padding_shifts_rope = False
+            finally:
+                owner.rope_deltas = saved
+        return self._padding_shifts_rope
+
+    def _admit(self) -> None:
+        while len(self._active) < self.max_batch_size and self._pending:
+            request = self._pending.popleft()
+            request.started_at = time.perf_counter()
+            try:
+                past, first_token = self._prefill(request)
+            except Exception as e:
+                LOGGER.exception(f'prefill 失败: {e}')
+                request.error = e
+                request.mark_done()
+                continue
+            if self._append_token(request, first_token):
+                if self._keeps_cache(request):
+                    self._store_cache(request, past)
+                request.mark_done()
+                continue
+            self._join(request, past, first_token, len(request.prompt_ids))
+
+    def _reusable_cache(self, request: GenerationRequest):
+        """找出 prompt 开头可以直接复用的 KV cache，返回 (token 数, past)"""
+        cached, past = 0, None
+        if request.session_id is not None and self.kv_cache is not None:
+            cached, past = self.kv_cache.lookup(request.session_id, request.prompt_ids, self.device)
+        if request.prefix is None or self.prefix_cache is None:
+            return cached, past
+
+        key, prefix_ids = request.prefix
+        length = min(len(prefix_ids), len(request.prompt_ids) - 1)
+        if length <= cached or request.prompt_ids[:len(prefix_ids)] != prefix_ids:
+            return cached, past
+        prefix_past = self.prefix_cache.get(key, prefix_ids)
+        if prefix_past is None:
+            prefix_past = self._encode_prefix(prefix_ids)
+            self.prefix_cache.put(key, prefix_ids, prefix_past)
+        return length, slice_past(prefix_past, length)
+
+    @torch.no_grad()
+    def _encode_prefix(self, prefix_ids: List[int]):
+        input_ids = torch.tensor([prefix_ids], dtype=torch.long, device=self.device)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            position_ids=torch.arange(len(prefix_ids), device=self.device).unsqueeze(0),
+            past_key_values=DynamicCache(),
+            use_cache=True,
+        )
+        return outputs.past_key_values.to_legacy_cache()
+
+    @torch.no_grad()
+    def _prefill(self, request: GenerationRequest):
+        length = len(request.prompt_ids)
+        cached, past = self._reusable_cache(request)
+        request.cached_tokens = cached
+
+        # 只需要计算缓存之后的 token
+        input_ids = torch.tensor([request.prompt_ids[cached:]], dtype=torch.long, device=self.device)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=torch.ones((1, length), dtype=torch.long, device=self.device),
+            position_ids=torch.arange(cached, length, device=self.device).unsqueeze(0),
+            past_key_values=DynamicCache.from_legacy_cache(past) if past is not None else DynamicCache(),
+            use_cache=True,
+        )
+        first_token = self._sample(outputs.logits[:, -1, :], [request])[0]
+        return outputs.past_key_values.to_legacy_cache(), first_token
+
+    def _join(self, request: GenerationRequest, past, token: int, next_position: int) -> None:
+        """把 prefill 完成的单条序列拼进正在 decode 的 batch"""
+        length = past[0][0].shape[2]
+        mask = torch.ones((1, length), dtype=torch.long, device=self.device)
+        position = torch.tensor([next_position], dtype=torch.long, device=self.device)
+        token = torch.tensor([token], dtype=torch.long, device=self.device)
+
+        if not self._active:
+            self._past, self._attention_mask = past, mask
+            self._positions, self._next_tokens = position, token
+        else:
+            total = max(length, self._attention_mask.shape[1])
+            batch_past = _left_pad_past(self._past, total)
+            new_past = _left_pad_past(past, total)
+            self._past = tuple(
+                (torch.cat([bk, nk], dim=0), torch.cat([bv, nv], dim=0))
+                for (bk, bv), (nk, nv) in zip(batch_past, new_past)
+            )
+            self._attention_mask = torch.cat(
+                [_left_pad_mask(self._attention_mask, total), _left_pad_mask(mask, total)], dim=0)
+            self._positions = torch.cat([self._positions, position])
+            self._next_tokens = torch.cat([self._next_tokens, token])
+        self._active.append(request)
+
+    @torch.no_grad()
+    def _step(self) -> None:
+        batch_size = len(self._active)
+        attention_mask = torch.cat(
+            [self._attention_mask, self._attention_mask.new_ones((batch_size, 1))], dim=1)
+        outputs = self.model(
+            input_ids=self._next_tokens.unsqueeze(1),
+            attention_mask=attention_mask,
+            position_ids=self._positions.unsqueeze(1),
+            past_key_values=DynamicCache.from_legacy_cache(self._past),
+            use_cache=True,
+        )
+        self._past = outputs.past_key_values.to_legacy_cache()
+        self._attention_mask = attention_mask
+        self._positions = self._positions + 1
+
+        tokens = self._sample(outputs.logits[:, -1, :], self._active)
+        keep = []
+        for index, (request, token) in enumerate(zip(self._active, tokens)):
+            request.decode_steps += 1
+            if self._append_token(request, token):
+                self._finish(request, index)
+            else:
+                keep.append(index)
+        self._next_tokens = torch.tensor(tokens, dtype=torch.long, device=self.device)
+        if len(keep) != batch_size:
+            self._retain(keep)
+
+    @torch.no_grad()
+    def _speculative_step(self) -> None:
+        """一次 forward 验证每条序列的草稿：输入 [上一个 token, 草稿...]，各位置的 logits 依次检验下一个草稿
+
+        草稿 token d 以目标分布中的概率 p(d) 接受（贪心时即 d 是否为 argmax）；被拒绝时从去掉 d 后的分布中重新采样，
+        全部接受时再从最后一个位置采样一个 token，所以每步至少前进一个 token，且输出分布与逐个采样相同。
+        """
+        drafts = []
+        for request in self._active:
+            # 剩下的长度放不下的草稿没有意义
+            room = request.max_new_tokens - len(request.output_ids) - 1
+            draft = self.speculator.propose(request, request.prompt_ids + request.output_ids) if room > 0 else []
+            drafts.append(draft[:room])
+        width = max(len(draft) for draft in drafts)
+        if width == 0:
+            self._step()
+            return
+
+        batch_size = len(self._active)
+        previous = self._next_tokens.tolist()
+        input_ids = torch.tensor([[token] + draft + [token] * (width - len(draft))
+                                  for token, draft in zip(previous, drafts)], dtype=torch.long, device=self.device)
+        attention_mask = torch.cat(
+            [self._attention_mask, self._attention_mask.new_ones((batch_size, width + 1))], dim=1)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=self._positions.unsqueeze(1) + torch.arange(width + 1, device=self.device),
+            past_key_values=DynamicCache.from_legacy_cache(self._past),
+            use_cache=True,
+        )
+
+        rows = [request for request in self._active for _ in range(width + 1)]
+        # 第 j 个位置之前还有这一行的前 j 个草稿 token
+        drafted = [draft[:j] for draft in drafts for j in range(width + 1)]
+        probs = self._token_probs(outputs.logits.reshape(batch_size * (width + 1), -1), rows, drafted)
+        probs = probs.view(batch_size, width + 1, -1)
+        # 草稿较短的行后面补的是占位 token，只检验各行自己的草稿长度
+        draft_ids = input_ids[:, 1:]
+        draft_probs = probs[:, :width].gather(-1, draft_ids.unsqueeze(-1)).squeeze(-1)
+        accept = (torch.rand_like(draft_probs) < draft_probs).tolist()
+        accepted = []
+        for draft, row in zip(drafts, accept):
+            count = 0
+            while count < len(draft) and row[count]:
+                count += 1
+            accepted.append(count)
+
+        index = torch.arange(batch_size, device=self.device)
+        final = probs[index, torch.tensor(accepted, device=self.device)]
+        for row, (draft, count) in enumerate(zip(drafts, accepted)):
+            if count < len(draft):
+                final[row, draft[count]] = 0.0
+        final_tokens = torch.multinomial(final, num_samples=1).squeeze(1).tolist()
+
+        keep, kept, next_tokens = [], [], []
+        for row, (request, draft, count) in enumerate(zip(self._active, drafts, accepted)):
+            request.decode_steps += 1
+            request.draft_tokens += len(draft)
+            request.accepted_tokens += count
+            emitted = 0
+            for token in draft[:count] + [final_tokens[row]]:
+                emitted += 1
+                if self._append_token(request, token):
+                    break
+            # cache 中保留上一个 token 和被接受的草稿，即本步输入的前 emitted 个位置
+            kept.append(emitted)
+            next_tokens.append(request.output_ids[-1])
+            if request.finish_reason is None:
+                keep.append(row)
+
+        self._compact(outputs.past_key_values.to_legacy_cache(), attention_mask, kept)
+        self._positions = self._positions + torch.tensor(kept, dtype=torch.long, device=self.device)
+        self._next_tokens = torch.tensor(next_tokens, dtype=torch.long, device=self.device)
+        for row, request in enumerate(self._active):
+            if request.finish_reason is not None:
+                self._finish(request, row)
+        if len(keep) != batch_size:
+            self._retain(keep)
+
+    def _compact(self, past, attention_mask: torch.Tensor, kept: List[int]) -> None:
+        """每行只保留原有 cache 加上本步输入的前 kept[i] 个位置，右对齐后左侧补 padding，保持 batch 的布局不变"""
+        length = self._attention_mask.shape[1]
+        grow = max(kept)
+        shift = torch.tensor([grow - count for count in kept], device=self.device).unsqueeze(1)
+        columns = torch.arange(length + grow, device=self.device).unsqueeze(0) - shift
+        padding = columns < 0
+        columns = columns.clamp(min=0)
+        self._attention_mask = attention_mask.gather(1, columns).masked_fill(padding, 0)
+        self._past = tuple(
+            (k.gather(2, self._expand_columns(columns, k)), v.gather(2, self._expand_columns(columns, v)))
+            for k, v in past
+        )
+
+    @staticmethod
+    def _expand_columns(columns: torch.Tensor, tensor: torch.Tensor) -> torch.Tensor:
+        return columns[:, None, :, None].expand(tensor.shape[0], tensor.shape[1], columns.shape[1], tensor.shape[3])
+
+    def _finish(self, request: GenerationRequest, index: int) -> None:
+        if self._keeps_cache(request):
+            self._store_cache(request, self._row_past(index))
+        if self.speculator is not None:
+            self.speculator.release(request)
+        request.mark_done()
+
+    def _append_token(self, request: GenerationRequest, token: int) -> bool:
+        """记录新 token，返回该序列是否已经结束"""
+        request.push(token)
+        if token in self.eos_token_ids:
+            request.finish_reason = 'stop'
+        elif len(request.output_ids) >= request.max_new_tokens:
+            request.finish_reason = 'length'
+        else:
+            request.finish_reason = request.limit_reached(self.tokenizer)
+        return request.finish_reason is not None
+
+    def _row_past(self, index: int):
+        """取出 batch 中第 index 条序列去掉左侧 padding 后的 KV cache（复制一份，不引用整个 batch）"""
+        pad = int((self._attention_mask[index] == 0).sum().item())
+        return tuple(
+            (k[index:index + 1, :, pad:].clone(), v[index:index + 1, :, pad:].clone())
+            for k, v in self._past
+        )
+
+    def _keeps_cache(self, request: GenerationRequest) -> bool:
+        return request.session_id is not None and self.kv_cache is not None
+
+    def _store_cache(self, request: GenerationRequest, past) -> None:
+        # cache 中包含 prompt 和除最后一个以外的所有生成 token
+        token_ids = request.prompt_ids + request.output_ids[:-1]
+        self.kv_cache.store(request.session_id, token_ids, past)
+
+    def _retain(self, keep: List[int]) -> None:
+        """只保留 keep 中的序列，并裁掉所有序列共有的左侧 padding"""
+        if not keep:
+            self._reset()
+            return
+        index = torch.tensor(keep, dtype=torch.long, device=self.device)
+        mask = self._attention_mask.index_select(0, index)
+        offset = int((mask.sum(dim=0) == 0).long().cumprod(dim=0).sum().item())
+        self._past = tuple(
+            (k.index_select(0, index)[:, :, offset:], v.index_select(0, index)[:, :, offset:])
+            for k, v in self._past
+        )
+        self._attention_mask = mask[:, offset:]
+        self._positions = self._positions.index_select(0, index)
+        self._next_tokens = self._next_tokens.index_select(0, index)
+        self._active = [self._active[i] for i in keep]
+
+    def _reset(self) -> None:
+        self._active = []
+        self._past = None
+        self._attention_mask = None
+        self._positions = None
+        self._next_tokens = None
+
+    def _fail_all(self, error: BaseException) -> None:
+        for request in self._active:
+            if self.speculator is not None:
+                self.speculator.release(request)
+            request.error = error
+            request.mark_done()
+        self._reset()
+
+    def _sample(self, logits: torch.Tensor, requests: List[GenerationRequest]) -> List[int]:
+        """按每条请求各自的 temperature / top_k / top_p 采样，temperature<=0 时贪心"""
+        logits = self._penalize(logits.float(), requests)
+        greedy = logits.argmax(dim=-1)
+        probs, sorted_index = self._sorted_probs(logits, requests)
+        choice = torch.multinomial(probs, num_samples=1)
+        sampled = sorted_index.gather(-1, choice).squeeze(1)
+
+        use_greedy = torch.tensor([r.temperature <= 0 for r in requests], device=logits.device)
+        return torch.where(use_greedy, greedy, sampled).tolist()
+
+    def _token_probs(self, logits: torch.Tensor, requests: List[GenerationRequest],
+                     drafted: Optional[List[List[int]]] = None) -> torch.Tensor:
+        """与 _sample 相同的采样分布，按词表顺序给出；贪心的请求为 argmax 处的 one-hot"""
+        logits = self._penalize(logits.float(), requests, drafted)
+        probs, sorted_index = self._sorted_probs(logits, requests)
+        probs = torch.zeros_like(logits).scatter_(-1, sorted_index, probs)
+        probs = probs / probs.sum(dim=-1, keepdim=True)
+        greedy = torch.zeros_like(logits).scatter_(-1, logits.argmax(dim=-1, keepdim=True), 1.0)
+        use_greedy = torch.tensor([r.temperature <= 0 for r in requests], device=logits.device)
+        return torch.where(use_greedy.unsqueeze(1), greedy, probs)
+
+    def _penalize(self, logits: torch.Tensor, requests: List[GenerationRequest],
+                  drafted: Optional[List[List[int]]] = None) -> torch.Tensor:
+        """repetition_penalty 和 min_new_tokens，含义与 transformers 的同名参数相同
+
+        repetition_penalty 作用于 prompt 和已生成的 token；生成数不足 min_new_tokens 时屏蔽结束 token。
+        drafted 为投机解码验证时各行之前的草稿 token，也算作已生成。
+        """
+        rows = [index for index, request in enumerate(requests)
+                if request.repetition_penalty != 1.0 or request.min_new_tokens > 0]
+        if not rows:
+            return logits
+        logits = logits.clone()
+        eos = torch.tensor(sorted(self.eos_token_ids), dtype=torch.long, device=logits.device)
+        for index in rows:
+            request = requests[index]
+            previous = drafted[index] if drafted is not None else []
+            if request.repetition_penalty != 1.0:
+                seen = torch.tensor(request.prompt_ids + request.output_ids + previous,
+                                    dtype=torch.long, device=logits.device).unique()
+                scores = logits[index, seen]
+                logits[index, seen] = torch.where(scores > 0, scores / request.repetition_penalty,
+                                                  scores * request.repetition_penalty)
+            if len(request.output_ids) + len(previous) < request.min_new_tokens and len(eos):
+                logits[index, eos] = float('-inf')
+        return logits
+
+    @staticmethod
+    def _sorted_probs(logits: torch.Tensor, requests: List[GenerationRequest]):
+        """经 temperature / top_k / top_p 处理后从大到小排列的概率（未归一化）及对应的 token id"""
+        temperature = torch.tensor([max(r.temperature, 1e-5) for r in requests], device=logits.device)
+        top_k = torch.tensor([r.top_k if r.top_k > 0 else logits.shape[-1] for r in requests],
+                             device=logits.device)
+        top_p = torch.tensor([r.top_p for r in requests], device=logits.device)
+
+        sorted_logits, sorted_index = torch.sort(logits / temperature.unsqueeze(1), dim=-1, descending=True)
+        ranks = torch.arange(logits.shape[-1], device=logits.device).unsqueeze(0)
+        sorted_logits = sorted_logits.masked_fill(ranks >= top_k.unsqueeze(1), float('-inf'))
+        probs = torch.softmax(sorted_logits, dim=-1)
+        # 累计概率在当前 token 之前就已超过 top_p 的部分全部丢弃，至少保留概率最大的一个
+        probs = probs.masked_fill(probs.cumsum(dim=-1) - probs > top_p.unsqueeze(1), 0.0)
+        return probs, sorted_index
+
+
+def _collate_multimodal(samples: List[Dict[str, torch.Tensor]], pad_token_id: int) -> Dict[str, torch.Tensor]:
+    """把多条单样本 processor 输出拼成一个 batch：文本左侧 padding，图片/视频张量按样本顺序拼接"""
+    length = max(sample['input_ids'].shape[1] for sample in samples)
+    batch = {
+        'input_ids': torch.cat([_left_pad(sample['input_ids'], length, pad_token_id) for sample in samples]),
+        'attention_mask': torch.cat([_left_pad(sample['attention_mask'], length, 0) for sample in samples]),
+    }
+    for sample in samples:
+        for name in sample.keys():
+            if name not in batch:
+                batch[name] = torch.cat([other[name] for other in samples if name in other])
+    return batch
+
+
+def _left_pad(tensor: torch.Tensor, total: int, value: int) -> torch.Tensor:
+    if tensor.shape[1] == total:
+        return tensor
+    return torch.cat([tensor.new_full((tensor.shape[0], total - tensor.shape[1]), value), tensor], dim=1)
+
+
+def _left_pad_past(past, total: int):
+    length = past[0][0].shape[2]
+    if length == total:
+        return past
+    padded = []
+    for k, v in past:
+        pad_shape = (k.shape[0], k.shape[1], total - length, k.shape[3])
+        padded.append((torch.cat([k.new_zeros(pad_shape), k], dim=2),
+                       torch.cat([v.new_zeros(pad_shape), v], dim=2)))
+    return tuple(padded)
+
+
+def _left_pad_mask(mask: torch.Tensor, total: int) -> torch.Tensor:
+    if mask.shape[1] == total:
+        return mask
+    return torch.cat([mask.new_zeros((mask.shape[0], total - mask.shape[1])), mask], dim=1)
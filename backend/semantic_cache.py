@@ -0,0 +1,188 @@
+import json
+import os
+import re
+import time
+import unicodedata
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from logger import MyLogger
+from metrics import RESPONSE_CACHE
+from native import allocate_lock
+from scheduler import GenerationRequest
+
+
+LOGGER = MyLogger()
+
+# 去掉标点和空白，只比较内容
+_NOISE = re.compile(r'[\W_]+')
+_MIX = np.uint64(0x9E3779B97F4A7C15)
+_PRIME = np.uint64(1000003)
+
+
+def normalize_question(text: str) -> str:
+    return _NOISE.sub('', unicodedata.normalize('NFKC', text).lower())
+
+
+class HashingEmbedder(object):
+    """字符 n-gram 的特征哈希向量，按 idf 加权后归一化，点积即余弦相似度
+
+    不需要额外的模型，中文问题按字切分就有很好的区分度。整批文本拼成一个码点数组后一次性计算所有 n-gram 的哈希，
+    没有逐条文本的 Python 循环。带符号的哈希让冲突的特征期望上互相抵消。
+    idf 在 fit 时按种子问题统计，之后加入的问题沿用。
+    """
+
+    def __init__(self, dim: int = 256, ngrams: Tuple[int, ...] = (1, 2, 3)) -> None:
+        self.dim = dim
+        self.ngrams = ngrams
+        self.idf = np.ones(dim, dtype=np.float32)
+
+    def fit_embed(self, texts: List[str]) -> np.ndarray:
+        """按这批文本统计 idf，并返回它们的向量"""
+        counts = self._counts(texts)
+        if texts:
+            document_frequency = (counts != 0).sum(axis=0)
+            self.idf = (np.log((1 + len(texts)) / (1 + document_frequency)) + 1).astype(np.float32)
+        return self._normalize(counts)
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        return self._normalize(self._counts(texts))
+
+    def _normalize(self, counts: np.ndarray) -> np.ndarray:
+        vectors = counts * self.idf
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors
+
+    def _counts(self, texts: List[str], chunk: int = 8192) -> np.ndarray:
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for start in range(0, len(texts), chunk):
+            out[start:start + chunk] = self._chunk_counts(texts[start:start + chunk])
+        return out
+
+    def _chunk_counts(self, texts: List[str]) -> np.ndarray:
+        normalized = [normalize_question(text) for text in texts]
+        # 各条文本之间用码点 0 隔开，跨过分隔符的 n-gram 丢弃
+        corpus = '\0'.join(normalized) + '\0'
+        codes = np.frombuffer(corpus.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+        rows = np.repeat(np.arange(len(texts)), [len(text) + 1 for text in normalized])
+
+        flat = np.zeros(len(texts) * self.dim, dtype=np.float64)
+        for n in self.ngrams:
+            if len(codes) < n:
+                continue
+            count = len(codes) - n + 1
+            hashes = np.full(count, n, dtype=np.uint64)
+            valid = np.ones(count, dtype=bool)
+            for offset in range(n):
+                window = codes[offset:offset + count]
+                hashes = hashes * _PRIME ^ window
+                valid &= window != 0
+            hashes = hashes * _MIX
+            buckets = (hashes >> np.uint64(40)) % np.uint64(self.dim)
+            signs = np.where(hashes & np.uint64(1 << 20), 1.0, -1.0)
+            index = rows[:count][valid] * self.dim + buckets[valid].astype(np.int64)
+            flat += np.bincount(index, weights=signs[valid], minlength=flat.size)
+        return flat.reshape(len(texts), self.dim)
+
+
+class SemanticAnswerCache(object):
+    """首轮问题的相似问答索引，相似度达到 threshold 时直接用已有回答，不经过大模型
+
+    种子来自微调数据（fine_tuning/dataset/*.json 的 instruction / output），所有 Bot 共用；
+    之后各个 Bot 正常生成完的首轮回答也加入索引，只对同一个 Bot 生效，放在一个 max_learned 条的环形区域里。
+    向量存在一个预先分配的 float32 矩阵中，查询是一次矩阵-向量乘法，256 维、10 万条时约 100MB 内存、十毫秒左右，
+    耗时主要是读一遍矩阵的内存带宽。
+    """
+
+    def __init__(self, threshold: float = 0.92, dim: int = 256, max_learned: int = 20000) -> None:
+        self.threshold = threshold
+        self.max_learned = max_learned
+        self.embedder = HashingEmbedder(dim)
+        self._lock = allocate_lock()
+        self._bot_ids: Dict[str, int] = {}
+        # 没有种子时也预留好学习区域，不调用 load_seeds 也能 learn
+        self._allocate(np.zeros((0, dim), dtype=np.float32), [], [])
+
+    def _allocate(self, vectors: np.ndarray, questions: List[str], answers: List[str]) -> None:
+        """前面放种子，后面留出 max_learned 行的环形区域，已学到的回答清空"""
+        self._vectors = np.zeros((len(questions) + self.max_learned, self.embedder.dim), dtype=np.float32)
+        self._vectors[:len(questions)] = vectors
+        # 每行所属的 Bot：0 为种子（所有 Bot 共用），-1 为已作废
+        self._owners = np.full(len(self._vectors), -1, dtype=np.int32)
+        self._owners[:len(questions)] = 0
+        self._questions: List[str] = questions + [''] * self.max_learned
+        self._answers: List[str] = answers + [''] * self.max_learned
+        self._seed_count = len(questions)
+        self._learned = 0
+
+    def load_seeds(self, paths: Iterable[str]) -> int:
+        """读取微调用的问答 json（[{instruction, input, output}, ...]），返回加入的条数"""
+        pairs = {}
+        for path in paths:
+            if not os.path.isfile(path):
+                LOGGER.warning(f'语义缓存的种子文件不存在: {path}')
+                continue
+            with open(path, encoding='utf-8') as f:
+                for item in json.load(f):
+                    question = '\n'.join(part for part in (item.get('instruction'), item.get('input')) if part)
+                    if question and item.get('output'):
+                        pairs.setdefault(normalize_question(question), (question, item['output']))
+
+        started_at = time.perf_counter()
+        questions = [question for question, _ in pairs.values()]
+        vectors = self.embedder.fit_embed(questions)
+        with self._lock:
+            self._allocate(vectors, questions, [answer for _, answer in pairs.values()])
+        LOGGER.info(f'语义缓存索引 {len(questions)} 条种子问答，耗时 {time.perf_counter() - started_at:.2f}s')
+        return len(questions)
+
+    def lookup(self, bot_name: str, question: str) -> Optional[Tuple[str, float]]:
+        """返回 (回答, 相似度)，没有足够相似的问题时返回 None"""
+        vector = self.embedder.embed([question])[0]
+        with self._lock:
+            owner = self._bot_ids.get(bot_name, -2)
+            # 只扫描用到的行
+            size = self._seed_count + min(self._learned, self.max_learned)
+            scores = self._vectors[:size] @ vector
+            scores[(self._owners[:size] != 0) & (self._owners[:size] != owner)] = -1.0
+            best = int(scores.argmax()) if len(scores) else -1
+            score = float(scores[best]) if best >= 0 else -1.0
+            if score < self.threshold:
+                return None
+            return self._answers[best], score
+
+    def learn(self, bot_name: str, question: str, answer: str) -> None:
+        """记下某个 Bot 完整生成的首轮回答，超出 max_learned 时覆盖最早的"""
+        if self.max_learned <= 0 or not normalize_question(question) or not answer:
+            return
+        vector = self.embedder.embed([question])[0]
+        with self._lock:
+            owner = self._bot_ids.setdefault(bot_name, len(self._bot_ids) + 1)
+            row = self._seed_count + self._learned % self.max_learned
+            self._vectors[row] = vector
+            self._owners[row] = owner
+            self._questions[row] = question
+            self._answers[row] = answer
+            self._learned += 1
+
+    def forget(self, bot_name: str) -> None:
+        """Bot 的提示词改变后，它之前生成的回答不再使用"""
+        with self._lock:
+            owner = self._bot_ids.get(bot_name)
+            if owner is not None:
+                self._owners[self._owners == owner] = -1
+
+
+
+def answered_request(tokenizer, prompt_ids: List[int], answer: str, bot_type: str) -> GenerationRequest:
+    """把索引里的回答包装成已经完成的生成请求，流式输出和用量统计照常工作"""
+    RESPONSE_CACHE.labels(bot_type, 'semantic').inc()
+    token_ids = tokenizer.encode(answer, add_special_tokens=False)
+    request = GenerationRequest(prompt_ids, len(token_ids))
+    for token in token_ids:
+        request.push(token)
+    request.finish_reason = 'stop'
+    request.response_cache = 'semantic'
+    request.mark_done()
+    return request
@@ -0,0 +1,191 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Dict, Iterator, List, Optional
+
+
+def estimate_history_bytes(history: List[Dict]) -> int:
+    """粗略估算一段历史占用的内存：文本按 UTF-8 计，token id 按每个 36 字节计"""
+    size = 0
+    for msg in history:
+        content = msg.get('content', '')
+        size += len(content.encode('utf-8')) if isinstance(content, str) else len(str(content))
+        size += 36 * len(msg.get('token_ids') or ()) + 200
+    return size
+
+
+class _Session(object):
+
+    def __init__(self, history: List[Dict]) -> None:
+        self.history = history
+        self.nbytes = estimate_history_bytes(history)
+        self.last_access = time.time()
+
+
+class SessionStore(MutableMapping):
+    """有上限的会话历史存储，用来替代 Bot 里无限增长的 user_histories 字典
+
+    内存中的会话按最近访问排序：超过数量/内存上限时淘汰最久未访问的会话，空闲超过 ttl 的会话也会被淘汰。
+    配置了 spill_path 时，被淘汰的会话写入本地 SQLite，下次访问时再读回内存，
+    磁盘上超过 disk_ttl 未访问的会话才真正删除。
+    len() 和迭代只包含内存中的会话，磁盘上的数量见 stats()。
+    """
+
+    def __init__(self, namespace: str, max_sessions: int = 20000, max_bytes: int = 512 * 1024 * 1024,
+                 ttl_seconds: float = 7200, spill_path: Optional[str] = None,
+                 disk_ttl_seconds: float = 30 * 24 * 3600) -> None:
+        self.namespace = namespace
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.disk_ttl_seconds = disk_ttl_seconds
+        self._sessions: 'OrderedDict[str, _Session]' = OrderedDict()
+        self._lock = threading.RLock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self._db: Optional[sqlite3.Connection] = None
+        if spill_path:
+            self._db = sqlite3.connect(spill_path, check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS sessions ('
+                'namespace TEXT, session_id TEXT, history TEXT, last_access REAL, '
+                'PRIMARY KEY (namespace, session_id))'
+            )
+            self._db.execute('DELETE FROM sessions WHERE last_access < ?',
+                             (time.time() - self.disk_ttl_seconds,))
+            self._db.commit()
+
+    def __getitem__(self, session_id: str) -> List[Dict]:
+        with self._lock:
+            session = self._load(session_id)
+            if session is None:
+                raise KeyError(session_id)
+            return session.history
+
+    def __setitem__(self, session_id: str, history: List[Dict]) -> None:
+        with self._lock:
+            self._remove(session_id)
+            session = _Session(history)
+            self._sessions[session_id] = session
+            self.nbytes += session.nbytes
+            self._evict()
+
+    def __delitem__(self, session_id: str) -> None:
+        with self._lock:
+            found = self._remove(session_id) is not None
+            if self._db is not None:
+                cursor = self._db.execute('DELETE FROM sessions WHERE namespace = ? AND session_id = ?',
+                                          (self.namespace, session_id))
+                self._db.commit()
+                found = found or cursor.rowcount > 0
+            if not found:
+                raise KeyError(session_id)
+
+    def __contains__(self, session_id) -> bool:
+        with self._lock:
+            found = self._load(session_id) is not None
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return found
+
+    def peek(self, session_id: str) -> bool:
+        """是否持有该会话（内存中未过期或已写入磁盘），不读回内存、不更新访问时间，也不计入命中统计"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None and session.last_access >= time.time() - self.ttl_seconds:
+                return True
+            if self._db is None:
+                return session is not None
+            row = self._db.execute('SELECT 1 FROM sessions WHERE namespace = ? AND session_id = ?',
+                                   (self.namespace, session_id)).fetchone()
+            return row is not None or session is not None
+
+    def __iter__(self) -> Iterator[str]:
+        with self._lock:
+            return iter(list(self._sessions.keys()))
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            self._expire()
+            disk_sessions = 0
+            if self._db is not None:
+                disk_sessions = self._db.execute('SELECT COUNT(*) FROM sessions WHERE namespace = ?',
+                                                 (self.namespace,)).fetchone()[0]
+            return {
+                'sessions': len(self._sessions),
+                'bytes': self.nbytes,
+                'disk_sessions': disk_sessions,
+                'hits': self.hits,
+                'misses': self.misses,
+                'disk_hits': self.disk_hits,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+    def _load(self, session_id: str) -> Optional[_Session]:
+        self._expire()
+        session = self._sessions.get(session_id)
+        if session is not None:
+            session.last_access = time.time()
+            self._sessions.move_to_end(session_id)
+            return session
+        if self._db is None:
+            return None
+
+        row = self._db.execute('SELECT history FROM sessions WHERE namespace = ? AND session_id = ?',
+                               (self.namespace, session_id)).fetchone()
+        if row is None:
+            return None
+        self._db.execute('DELETE FROM sessions WHERE namespace = ? AND session_id = ?',
+                         (self.namespace, session_id))
+        self._db.commit()
+        self.disk_hits += 1
+        session = _Session(json.loads(row[0]))
+        self._sessions[session_id] = session
+        self.nbytes += session.nbytes
+        self._evict()
+        return session
+
+    def _remove(self, session_id: str) -> Optional[_Session]:
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self.nbytes -= session.nbytes
+        return session
+
+    def _spill(self, session_id: str) -> None:
+        session = self._remove(session_id)
+        if session is not None and self._db is not None:
+            self._db.execute(
+                'INSERT OR REPLACE INTO sessions (namespace, session_id, history, last_access) VALUES (?, ?, ?, ?)',
+                (self.namespace, session_id, json.dumps(session.history, ensure_ascii=False), session.last_access)
+            )
+            self._db.commit()
+
+    def _expire(self) -> None:
+        # OrderedDict 头部是最久未访问的会话，遇到第一个未过期的就可以停下
+        deadline = time.time() - self.ttl_seconds
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if session.last_access >= deadline:
+                break
+            self._spill(session_id)
+            self.expirations += 1
+
+    def _evict(self) -> None:
+        # 刚写入的会话在末尾，至少保留它
+        while len(self._sessions) > 1 and (len(self._sessions) > self.max_sessions or self.nbytes > self.max_bytes):
+            self._spill(next(iter(self._sessions)))
+            self.evictions += 1
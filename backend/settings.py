@@ -1,10 +1,26 @@
 import json
 import os
-from typing import Dict, Any
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，只保证单进程内的互斥
+    fcntl = None
 
 SETTINGS_FILE = './config/user_settings.json'
 
 class SettingsManager:
+    """用户设置的读写
+
+    设置缓存在内存里，每次读取前只 stat 一次文件，inode / mtime / 大小变化（包括其他进程写入）时才重新解析。
+    写入先写临时文件再 os.replace，读者不会看到写了一半的文件；
+    多个进程同时修改时用设置文件旁边的锁文件串行化读-改-写。
+    version 在内容变化时加一，Bot 据此跳过不必要的提示词刷新。
+    """
+
     def __init__(self):
         self.default_settings = {
             "chat_bot_prompt": "你是一个友善、乐于助人的AI助手。请用简洁明了的方式回答用户的问题。",
@@ -12,6 +28,11 @@ class SettingsManager:
             "electricity_bot_prompt": "你是一名专注于电学的物理专家，你的任务是帮助用户学习电学知识。如果用户提出与电学无关的问题，请礼貌地提醒他们你专注于电学。另外，对于普通的问候或对你身份的询问，以及对你的电学解释结果的追问，可以正常回复。",
             "mechanics_bot_prompt": "你是一名专注于力学的物理专家，你的任务是帮助用户学习力学知识。如果用户提出与力无关的问题，请礼貌地提醒他们你专注于力学。另外，对于普通的问候或对你身份的询问，以及对你的力学解释结果的追问，可以正常回复。"
         }
+        self._lock = threading.RLock()
+        self._settings: Dict[str, Any] = self.default_settings.copy()
+        self._file_key: Optional[Tuple[int, int, int]] = None
+        self.version = 0
+        self.reloads = 0
         self.ensure_settings_file()
 
     def ensure_settings_file(self):
@@ -20,24 +41,23 @@ class SettingsManager:
         if not os.path.exists(SETTINGS_FILE):
             self.save_settings(self.default_settings)
 
+    def current_version(self) -> int:
+        """检查文件是否被改动过，返回当前设置的版本号"""
+        with self._lock:
+            self._reload_if_changed()
+            return self.version
+
     def load_settings(self) -> Dict[str, Any]:
         """加载设置"""
-        try:
-            with open(SETTINGS_FILE, 'r', encoding='utf-8') as f:
-                settings = json.load(f)
-                # 确保所有默认设置都存在
-                for key, value in self.default_settings.items():
-                    if key not in settings:
-                        settings[key] = value
-                return settings
-        except (FileNotFoundError, json.JSONDecodeError):
-            return self.default_settings.copy()
+        with self._lock:
+            self._reload_if_changed()
+            return self._settings.copy()
 
     def save_settings(self, settings: Dict[str, Any]) -> bool:
         """保存设置"""
         try:
-            with open(SETTINGS_FILE, 'w', encoding='utf-8') as f:
-                json.dump(settings, f, ensure_ascii=False, indent=2)
+            with self._file_lock():
+                self._write(settings)
             return True
         except Exception as e:
             print(f"保存设置失败: {e}")
@@ -45,15 +65,85 @@ class SettingsManager:
 
     def get_prompt(self, bot_type: str) -> str:
         """获取指定机器人类型的提示词"""
-        settings = self.load_settings()
         prompt_key = f"{bot_type}_bot_prompt"
-        return settings.get(prompt_key, self.default_settings.get(prompt_key, ""))
+        with self._lock:
+            self._reload_if_changed()
+            return self._settings.get(prompt_key, self.default_settings.get(prompt_key, ""))
 
     def update_prompt(self, bot_type: str, prompt: str) -> bool:
         """更新指定机器人类型的提示词"""
-        settings = self.load_settings()
-        prompt_key = f"{bot_type}_bot_prompt"
-        settings[prompt_key] = prompt
-        return self.save_settings(settings)
+        try:
+            with self._file_lock():
+                # 持锁后再读一次，避免覆盖其他进程刚写入的修改
+                self._reload_if_changed()
+                settings = self._settings.copy()
+                settings[f"{bot_type}_bot_prompt"] = prompt
+                self._write(settings)
+            return True
+        except Exception as e:
+            print(f"保存设置失败: {e}")
+            return False
+
+    @contextmanager
+    def _file_lock(self):
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(SETTINGS_FILE + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _stat_key() -> Optional[Tuple[int, int, int]]:
+        try:
+            stat = os.stat(SETTINGS_FILE)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _reload_if_changed(self) -> None:
+        key = self._stat_key()
+        if key is None or key == self._file_key:
+            return
+        self._file_key = key
+        try:
+            with open(SETTINGS_FILE, 'r', encoding='utf-8') as f:
+                settings = json.load(f)
+        except json.JSONDecodeError as e:
+            # 文件被手工改坏时沿用内存中的设置，直到文件再次变化
+            print(f"读取设置失败: {e}")
+            return
+        self.reloads += 1
+        # 确保所有默认设置都存在
+        for name, value in self.default_settings.items():
+            if name not in settings:
+                settings[name] = value
+        self._apply(settings)
+
+    def _write(self, settings: Dict[str, Any]) -> None:
+        directory = os.path.dirname(SETTINGS_FILE)
+        fd, tmp_path = tempfile.mkstemp(prefix='.user_settings.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(settings, f, ensure_ascii=False, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, SETTINGS_FILE)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self._file_key = self._stat_key()
+        merged = self.default_settings.copy()
+        merged.update(settings)
+        self._apply(merged)
+
+    def _apply(self, settings: Dict[str, Any]) -> None:
+        if settings != self._settings:
+            self._settings = settings
+            self.version += 1
 
 settings_manager = SettingsManager()
\ No newline at end of file
@@ -0,0 +1,105 @@
+from typing import Dict, List, Tuple
+
+import torch
+from transformers import DynamicCache
+
+from device import input_device
+from logger import MyLogger
+
+
+LOGGER = MyLogger()
+
+
+class PromptLookupProposer(object):
+    """在 prompt 和已生成的内容里查找与结尾 n-gram 相同的片段，把它后面的 token 当作草稿
+
+    不需要额外的模型；物理讲解里公式、单位和术语经常原样重复前几轮的内容，这类片段很容易整段命中。
+    从最长的 n-gram 开始匹配，同一长度取最近的一次出现。
+    """
+
+    name = 'ngram'
+
+    def __init__(self, num_tokens: int, max_ngram: int = 3, min_ngram: int = 1) -> None:
+        self.num_tokens = num_tokens
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+
+    def propose(self, request, context: List[int]) -> List[int]:
+        for size in range(self.max_ngram, self.min_ngram - 1, -1):
+            if len(context) <= size:
+                continue
+            suffix = context[-size:]
+            first = suffix[0]
+            for start in range(len(context) - size - 1, -1, -1):
+                if context[start] == first and context[start:start + size] == suffix:
+                    return context[start + size:start + size + self.num_tokens]
+        return []
+
+    def release(self, request) -> None:
+        pass
+
+
+class DraftModelProposer(object):
+    """用同一分词器的小模型（比如 Qwen2.5-0.5B-Instruct）贪心生成草稿
+
+    每条请求保留一份草稿模型的 KV cache，下一步只补上目标模型新确认的 token，
+    被拒绝的草稿 token 从 cache 中裁掉。请求结束时由调度器调用 release 释放。
+    """
+
+    name = 'draft'
+
+    def __init__(self, model, num_tokens: int, eos_token_ids=()) -> None:
+        self.model = model
+        self.num_tokens = num_tokens
+        self.eos_token_ids = set(eos_token_ids)
+        self._states: Dict[object, Tuple[DynamicCache, List[int]]] = {}
+
+    @property
+    def device(self) -> torch.device:
+        return input_device(self.model)
+
+    @torch.no_grad()
+    def propose(self, request, context: List[int]) -> List[int]:
+        cache, cached_ids = self._states.get(request, (None, []))
+        # 至少留一个 token 重新输入，用它的 logits 预测草稿的第一个 token
+        common = 0
+        limit = min(len(cached_ids), len(context) - 1)
+        while common < limit and cached_ids[common] == context[common]:
+            common += 1
+        if cache is None:
+            cache = DynamicCache()
+        else:
+            cache.crop(common)
+
+        pending = context[common:]
+        position = common
+        drafts = []
+        for _ in range(self.num_tokens):
+            outputs = self.model(input_ids=torch.tensor([pending], dtype=torch.long, device=self.device),
+                                 position_ids=torch.arange(position, position + len(pending), device=self.device)[None],
+                                 past_key_values=cache, use_cache=True)
+            token = int(outputs.logits[0, -1].argmax())
+            drafts.append(token)
+            if token in self.eos_token_ids:
+                break
+            position += len(pending)
+            pending = [token]
+        # 最后一个草稿 token 还没有输入过草稿模型
+        self._states[request] = (cache, context + drafts[:-1])
+        return drafts
+
+    def release(self, request) -> None:
+        self._states.pop(request, None)
+
+
+def load_draft_model(model_path: str, target, dtype: torch.dtype):
+    from modelscope import AutoModelForCausalLM
+
+    # 草稿模型很小，整个放在目标模型输入所在的设备上
+    draft = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=dtype,
+                                                 device_map={'': str(input_device(target))}).eval()
+    target_vocab = target.get_output_embeddings().weight.shape[0]
+    draft_vocab = draft.get_output_embeddings().weight.shape[0]
+    if target_vocab != draft_vocab:
+        LOGGER.warning(f'草稿模型词表大小 {draft_vocab} 与目标模型 {target_vocab} 不同，请确认两者使用同一分词器')
+    return draft
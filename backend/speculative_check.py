@@ -0,0 +1,93 @@
+"""检查投机解码的贪心输出与逐个 token 的贪心输出完全相同
+
+    python speculative_check.py
+
+用随机初始化的小 Qwen2 模型（不需要下载权重）分别跑 BatchScheduler 的普通 decode 和两种投机解码
+（ngram 查找、同词表的草稿模型），同一批 prompt 同时提交，比较每条请求生成的 token。
+模型用 float64，排除矩阵乘法顺序不同带来的舍入差异；有不一致时打印出来并以非零状态退出。
+"""
+import random
+import sys
+import types
+from typing import Dict, List
+
+import configargparse
+import torch
+from transformers import Qwen2Config, Qwen2ForCausalLM
+
+from scheduler import BatchScheduler, GenerationRequest
+from speculative import DraftModelProposer, PromptLookupProposer
+
+
+def tiny_model(vocab_size: int, layers: int, seed: int) -> Qwen2ForCausalLM:
+    torch.manual_seed(seed)
+    config = Qwen2Config(vocab_size=vocab_size, hidden_size=64, intermediate_size=128, num_hidden_layers=layers,
+                         num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=1024,
+                         eos_token_id=None, bos_token_id=None, pad_token_id=0)
+    return Qwen2ForCausalLM(config).to(torch.float64).eval()
+
+
+def make_prompts(vocab_size: int, count: int, seed: int) -> List[List[int]]:
+    # 开头一段重复出现，ngram 查找才有草稿可以提出；长度各不相同，batch 里有左侧 padding
+    rng = random.Random(seed)
+    prompts = []
+    for index in range(count):
+        phrase = [rng.randrange(1, vocab_size) for _ in range(rng.randint(3, 8))]
+        tail = [rng.randrange(1, vocab_size) for _ in range(rng.randint(1, 12))]
+        prompts.append(phrase * rng.randint(2, 4) + tail + phrase[:index % len(phrase) + 1])
+    return prompts
+
+
+def run(model, prompts: List[List[int]], max_new_tokens: int, speculator=None,
+        **sampling) -> List[GenerationRequest]:
+    # 随机模型没有分词器，调度器只在这里读取 eos / pad；没有停止串时不会解码文本
+    tokenizer = types.SimpleNamespace(eos_token_id=None, pad_token_id=0)
+    scheduler = BatchScheduler(model, tokenizer, max_batch_size=len(prompts), speculator=speculator)
+    requests = [scheduler.submit(prompt, max_new_tokens, temperature=0, **sampling) for prompt in prompts]
+    for request in requests:
+        request.wait()
+    return requests
+
+
+def main() -> None:
+    parser = configargparse.ArgParser(description='Speculative decoding must match plain greedy decoding')
+    parser.add_argument('--vocab_size', type=int, default=128, help='Vocabulary size of the random models')
+    parser.add_argument('--prompts', type=int, default=6, help='Prompts decoded together in one batch')
+    parser.add_argument('--max_new_tokens', type=int, default=48, help='Tokens generated per prompt')
+    parser.add_argument('--speculative_tokens', type=int, default=4, help='Draft tokens verified per decode step')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the models and prompts')
+    args = parser.parse_args()
+
+    model = tiny_model(args.vocab_size, layers=2, seed=args.seed)
+    # 草稿模型取目标模型的词嵌入、第一层和输出层，与目标模型部分一致，接受和拒绝两条路径都能走到
+    draft = tiny_model(args.vocab_size, layers=1, seed=args.seed + 1)
+    draft.load_state_dict(model.state_dict(), strict=False)
+    prompts = make_prompts(args.vocab_size, args.prompts, args.seed)
+    cases: Dict[str, Dict] = {
+        'greedy': {},
+        'repetition_penalty': {'repetition_penalty': 1.3, 'min_new_tokens': 8},
+    }
+
+    failures = 0
+    for name, sampling in cases.items():
+        expected = [request.output_ids for request in run(model, prompts, args.max_new_tokens, **sampling)]
+        speculators = [PromptLookupProposer(args.speculative_tokens),
+                       DraftModelProposer(draft, args.speculative_tokens)]
+        for speculator in speculators:
+            requests = run(model, prompts, args.max_new_tokens, speculator, **sampling)
+            outputs = [request.output_ids for request in requests]
+            mismatched = [index for index, (a, b) in enumerate(zip(expected, outputs)) if a != b]
+            status = 'ok' if not mismatched else f'MISMATCH {mismatched}'
+            # 接受的草稿太少时这项检查没有意义，一并打印出来
+            accepted = sum(request.accepted_tokens for request in requests)
+            drafted = sum(request.draft_tokens for request in requests)
+            print(f'{name:<20} {speculator.name:<6} {status:<8} accepted {accepted}/{drafted} draft tokens')
+            for index in mismatched:
+                print(f'  prompt {index}: expected {expected[index]}')
+                print(f'  {" " * len(str(index))}         got      {outputs[index]}')
+            failures += len(mismatched)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
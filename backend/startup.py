@@ -0,0 +1,81 @@
+import contextlib
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+from logger import MyLogger
+
+
+LOGGER = MyLogger()
+
+_MODULE_LOADED_AT = time.perf_counter()
+
+
+def process_uptime() -> float:
+    """本进程启动至今的秒数，包括解释器启动和各模块的 import"""
+    try:
+        with open('/proc/self/stat') as f:
+            # 第 22 个字段是进程启动时刻（开机后的时钟滴答数），进程名可能含空格，从右括号之后开始数
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return time.perf_counter() - _MODULE_LOADED_AT
+
+
+class StartupTimer(object):
+    """记录启动各阶段（import、processor、weights、engine、warmup）的耗时和当前进度
+
+    /readyz 用它判断是否就绪，未就绪时返回正在进行的阶段；加载失败时记下错误，/healthz 据此返回失败。
+    预热这类可选步骤失败只记为 warnings，不影响就绪。
+    """
+
+    def __init__(self) -> None:
+        self.phases: Dict[str, float] = {}
+        self.current: Optional[str] = None
+        self.ready = False
+        self.ready_after: Optional[float] = None
+        self.error: Optional[str] = None
+        self.warnings: List[str] = []
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        self.current = name
+        started_at = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            self.error = f'{name}: {e!r}'
+            raise
+        finally:
+            self.add(name, time.perf_counter() - started_at)
+            self.current = None
+
+    def add(self, name: str, seconds: float) -> None:
+        self.phases[name] = round(self.phases.get(name, 0.0) + seconds, 3)
+
+    def warn(self, name: str, error: BaseException) -> None:
+        LOGGER.exception(f'{name} 失败，继续启动: {error!r}')
+        self.warnings.append(f'{name}: {error!r}')
+
+    def mark_ready(self) -> None:
+        self.ready = True
+        self.ready_after = round(process_uptime(), 3)
+        report = self.report()
+        LOGGER.info(f"启动完成，共 {report['total_seconds']}s: {report['phases']}")
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            'ready': self.ready,
+            'phase': self.current,
+            'phases': dict(self.phases),
+            # 就绪后固定为从进程启动到就绪的耗时
+            'total_seconds': self.ready_after if self.ready else round(process_uptime(), 3),
+            'error': self.error,
+            'warnings': list(self.warnings),
+        }
+
+
+# 每个进程一份
+STARTUP = StartupTimer()
@@ -0,0 +1,40 @@
+import json
+from typing import Any, Dict
+
+
+class IncrementalDecoder(object):
+    """增量解码：每次只返回新增的完整文本
+
+    单个汉字可能被拆成多个 byte-level token，解码出来以 '\\ufffd' 结尾时先不输出，
+    等后续 token 补齐后再一起返回。每次只解码最近的一小段 token，开销与回答长度无关。
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens: bool = True) -> None:
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.ids = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def _decode(self, ids) -> str:
+        return self.tokenizer.decode(ids, skip_special_tokens=self.skip_special_tokens,
+                                     clean_up_tokenization_spaces=False)
+
+    def push(self, token: int) -> str:
+        self.ids.append(token)
+        prefix_text = self._decode(self.ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.ids[self.prefix_offset:])
+        if len(new_text) > len(prefix_text) and not new_text.endswith('\ufffd'):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.ids)
+            return new_text[len(prefix_text):]
+        return ''
+
+    @property
+    def text(self) -> str:
+        return self._decode(self.ids)
+
+
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    """按 Server-Sent Events 格式编码一条事件"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
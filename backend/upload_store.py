@@ -0,0 +1,177 @@
+import hashlib
+import os
+import re
+import tempfile
+import time
+from typing import Optional, Tuple
+
+from flask import Request
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from logger import MyLogger
+
+
+LOGGER = MyLogger()
+
+_PART_SUFFIX = '.part'
+# 上传中断留下的临时文件超过这个时间才清理，避免删掉正在写入的文件
+_STALE_PART_SECONDS = 3600
+_CLEANUP_INTERVAL = 600
+
+
+def _safe_ext(filename: str) -> str:
+    ext = os.path.splitext(filename or '')[1].lower()
+    return ext if re.fullmatch(r'\.[a-z0-9]{1,8}', ext) else ''
+
+
+class UploadSink(object):
+    """multipart 解析时直接写入的文件对象：边写边计算 sha256 并检查大小，数据落在上传目录下的临时文件里
+
+    超过 max_bytes 时立即抛出 413，不再继续读取请求体；没有 commit 的临时文件在 close 时删除。
+    """
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        fd, self.tmp_path = tempfile.mkstemp(prefix='.upload.', suffix=_PART_SUFFIX, dir=directory)
+        self._file = os.fdopen(fd, 'w+b')
+        self._sha = hashlib.sha256()
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.committed = False
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.close()
+            raise RequestEntityTooLarge(f'file exceeds {self.max_bytes // (1 << 20)}MB')
+        self._sha.update(data)
+        return self._file.write(data)
+
+    def read(self, size: int = -1) -> bytes:
+        return self._file.read(size)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        return self._file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def flush(self) -> None:
+        self._file.flush()
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    @property
+    def closed(self) -> bool:
+        return self._file.closed
+
+    @property
+    def digest(self) -> str:
+        return self._sha.hexdigest()
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self._file.close()
+        if not self.committed:
+            try:
+                os.unlink(self.tmp_path)
+            except FileNotFoundError:
+                pass
+
+
+class UploadStore(object):
+    """按内容寻址保存上传文件：文件名是内容的 sha256，同一个文件不论上传多少次只存一份
+
+    重复上传时丢弃新写的临时文件，只刷新已有文件的修改时间；
+    修改时间超过 ttl_seconds 的文件，以及总量超过 max_total_bytes 时最久未上传的文件会被定期删除。
+    """
+
+    def __init__(self, directory: str, max_file_bytes: int, ttl_seconds: float, max_total_bytes: int) -> None:
+        self.directory = os.path.abspath(directory)
+        self.max_file_bytes = max_file_bytes
+        self.ttl_seconds = ttl_seconds
+        self.max_total_bytes = max_total_bytes
+        self._last_cleanup = 0.0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def open_sink(self) -> UploadSink:
+        return UploadSink(self.directory, self.max_file_bytes)
+
+    def commit(self, sink: UploadSink, filename: str) -> Tuple[str, bool]:
+        """把写完的临时文件放到内容地址上，返回 (文件路径, 是否为重复上传)"""
+        path = os.path.join(self.directory, f'{sink.digest}{_safe_ext(filename)}')
+        sink.flush()
+        sink.committed = True
+        sink.close()
+        duplicate = os.path.exists(path)
+        if duplicate:
+            os.unlink(sink.tmp_path)
+            os.utime(path)
+        else:
+            os.replace(sink.tmp_path, path)
+        self.cleanup()
+        return path, duplicate
+
+    def cleanup(self, force: bool = False) -> None:
+        now = time.time()
+        if not force and now - self._last_cleanup < _CLEANUP_INTERVAL:
+            return
+        self._last_cleanup = now
+
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if not os.path.isfile(path):
+                continue
+            if name.endswith(_PART_SUFFIX):
+                if now - stat.st_mtime > _STALE_PART_SECONDS:
+                    self._remove(path)
+            elif now - stat.st_mtime > self.ttl_seconds:
+                self._remove(path)
+            else:
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_total_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.unlink(path)
+            LOGGER.info(f'清理上传文件: {path}')
+        except FileNotFoundError:
+            pass
+
+
+class StreamingUploadRequest(Request):
+    """multipart 中的文件直接流式写入 upload_store 给出的 UploadSink，而不是先缓冲到内存或匿名临时文件"""
+
+    upload_store: Optional[UploadStore] = None
+    # 只对上传接口放宽请求体大小限制
+    upload_endpoint = 'upload_file'
+
+    @property
+    def max_content_length(self) -> Optional[int]:
+        # 单个文件的上限，再给 multipart 的其他部分留 1MB，超过时 werkzeug 直接返回 413
+        if self.upload_store is not None and self.endpoint == self.upload_endpoint:
+            return self.upload_store.max_file_bytes + (1 << 20)
+        return super().max_content_length
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.upload_store is None:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        return self.upload_store.open_sink()
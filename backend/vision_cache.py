@@ -0,0 +1,131 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import torch
+
+from native import allocate_lock
+
+
+# (会话, 媒体内容的键)；媒体无法稳定标识（比如没有会话）时为 None，照常计算、不缓存
+EncoderKey = Optional[Tuple[str, str]]
+
+
+class VisionEncoderCache(object):
+    """按会话缓存视觉编码器（ViT）对每个图片/视频输出的 embedding，追问同一媒体时跳过视觉编码
+
+    通过替换模型的 get_image_features / get_video_features 接入：调度线程在 generate 前用 using()
+    给出本批次每个媒体项对应的键，命中的媒体项直接使用缓存，只有未命中的部分送进 ViT。
+    Qwen2.5-VL 的 ViT 按媒体项分别做注意力，单独计算与整批计算的结果相同。
+    总量超过 max_bytes 时淘汰全局最久未用的条目，单个会话超过 max_session_bytes 时淘汰该会话最久未用的条目。
+    """
+
+    def __init__(self, max_bytes: int, max_session_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.max_session_bytes = max_session_bytes
+        self._entries: 'OrderedDict[Tuple[str, str], torch.Tensor]' = OrderedDict()
+        self._session_bytes: Dict[str, int] = {}
+        # drop_session 由请求协程调用，其余都在调度线程里
+        self._lock = allocate_lock()
+        self._active: Dict[str, List[EncoderKey]] = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def install(self, model) -> None:
+        inner = getattr(model, 'model', model)
+        for kind, name in (('image', 'get_image_features'), ('video', 'get_video_features')):
+            original = getattr(inner, name, None)
+            if original is not None:
+                setattr(inner, name, self._wrap(kind, original, inner))
+
+    @contextmanager
+    def using(self, keys: Dict[str, List[EncoderKey]]) -> Iterator[None]:
+        """在 with 块内的 generate 中，keys[kind] 按顺序对应 batch 里的每个图片/视频"""
+        self._active = keys
+        try:
+            yield
+        finally:
+            self._active = {}
+
+    def drop_session(self, session_id: str) -> None:
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == session_id]:
+                self._discard(key)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'sessions': len(self._session_bytes),
+                'bytes': self.nbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _wrap(self, kind: str, original, inner):
+        def get_features(pixel_values: torch.Tensor, grid_thw: torch.Tensor):
+            keys = self._active.get(kind)
+            if not keys or len(keys) != grid_thw.shape[0]:
+                return original(pixel_values, grid_thw)
+
+            results = [self._get(key) for key in keys]
+            missing = [index for index, embeds in enumerate(results) if embeds is None]
+            if missing:
+                # pixel_values 按媒体项顺序排列，每项占 t*h*w 行
+                pieces = torch.split(pixel_values, grid_thw.prod(-1).tolist())
+                computed = original(torch.cat([pieces[index] for index in missing]), grid_thw[missing])
+                if isinstance(computed, torch.Tensor):
+                    merge = inner.visual.spatial_merge_size ** 2
+                    computed = torch.split(computed, (grid_thw[missing].prod(-1) // merge).tolist())
+                for index, embeds in zip(missing, computed):
+                    results[index] = embeds
+                    self._put(keys[index], embeds)
+            return tuple(results)
+        return get_features
+
+    def _get(self, key: EncoderKey) -> Optional[torch.Tensor]:
+        if key is None:
+            return None
+        with self._lock:
+            embeds = self._entries.get(key)
+            if embeds is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return embeds
+
+    def _put(self, key: EncoderKey, embeds: torch.Tensor) -> None:
+        nbytes = embeds.numel() * embeds.element_size()
+        if key is None or nbytes > self.max_session_bytes or nbytes > self.max_bytes:
+            return
+        session_id = key[0]
+        with self._lock:
+            self._discard(key)
+            # 复制一份，不引用整个 batch 的输出
+            self._entries[key] = embeds.detach().clone()
+            self._session_bytes[session_id] = self._session_bytes.get(session_id, 0) + nbytes
+            self.nbytes += nbytes
+            while self._session_bytes.get(session_id, 0) > self.max_session_bytes:
+                self._evict(next(k for k in self._entries if k[0] == session_id))
+            while self.nbytes > self.max_bytes:
+                self._evict(next(iter(self._entries)))
+
+    def _evict(self, key: Tuple[str, str]) -> None:
+        self._discard(key)
+        self.evictions += 1
+
+    def _discard(self, key: Tuple[str, str]) -> None:
+        embeds = self._entries.pop(key, None)
+        if embeds is None:
+            return
+        nbytes = embeds.numel() * embeds.element_size()
+        self.nbytes -= nbytes
+        remaining = self._session_bytes[key[0]] - nbytes
+        if remaining > 0:
+            self._session_bytes[key[0]] = remaining
+        else:
+            del self._session_bytes[key[0]]
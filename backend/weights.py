@@ -0,0 +1,132 @@
+import glob
+import json
+import os
+import re
+import struct
+import time
+from typing import Dict
+
+import torch
+from transformers import GenerationConfig
+from transformers.modeling_utils import no_init_weights
+
+from logger import MyLogger
+
+
+LOGGER = MyLogger()
+
+_SAFETENSORS_DTYPES = {
+    'BF16': torch.bfloat16,
+    'F16': torch.float16,
+    'F32': torch.float32,
+    'F64': torch.float64,
+    'I64': torch.int64,
+    'I32': torch.int32,
+    'I16': torch.int16,
+    'I8': torch.int8,
+    'U8': torch.uint8,
+    'BOOL': torch.bool,
+}
+
+
+def mmap_safetensors(path: str) -> Dict[str, torch.Tensor]:
+    """把一个 safetensors 文件映射进内存，返回的张量都是映射区域上的视图，不复制数据
+
+    映射是私有只读的（MAP_PRIVATE）：同一台机器上映射同一文件的进程共用页缓存里的同一份物理内存，
+    只有被写入的页才会复制成进程私有，所以推理时权重只占一份内存。
+    """
+    with open(path, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=os.path.getsize(path))
+    data = torch.empty(0, dtype=torch.uint8).set_(storage)[8 + header_size:]
+
+    tensors = {}
+    for name, info in header.items():
+        if name == '__metadata__':
+            continue
+        begin, end = info['data_offsets']
+        tensors[name] = data[begin:end].view(_SAFETENSORS_DTYPES[info['dtype']]).view(info['shape'])
+    return tensors
+
+
+def _rename_checkpoint_keys(model_cls, state_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+    # 新版 transformers 调整了模块层级，旧 checkpoint 的键名按模型类自带的映射改写
+    mapping = getattr(model_cls, '_checkpoint_conversion_mapping', None) or {}
+    renamed = {}
+    for key, tensor in state_dict.items():
+        for pattern, replacement in mapping.items():
+            key, count = re.subn(pattern, replacement, key)
+            if count:
+                break
+        renamed[key] = tensor
+    return renamed
+
+
+def load_model_mmap(model_cls, model_path: str, torch_dtype: torch.dtype):
+    """from_pretrained 的替代：权重直接使用 mmap 映射的张量，只适用于 CPU 推理
+
+    模型骨架在 no_init_weights 下创建，分配的参数内存从未写入、不会常驻，
+    load_state_dict(assign=True) 之后换成映射出来的张量。
+    checkpoint 的 dtype 与 torch_dtype 不同时只能转换出一份私有副本，会记一条警告。
+    """
+    files = sorted(glob.glob(os.path.join(model_path, '*.safetensors')))
+    if not files:
+        raise FileNotFoundError(f'no safetensors weights under {model_path}')
+
+    config = model_cls.config_class.from_pretrained(model_path)
+    with no_init_weights():
+        model = model_cls._from_config(config, torch_dtype=torch_dtype)
+
+    state_dict = {}
+    for file in files:
+        state_dict.update(mmap_safetensors(file))
+    state_dict = _rename_checkpoint_keys(model_cls, state_dict)
+
+    converted = [name for name, tensor in state_dict.items()
+                 if tensor.is_floating_point() and tensor.dtype != torch_dtype]
+    if converted:
+        LOGGER.warning(f'{len(converted)} 个权重的 dtype 与 {torch_dtype} 不同，转换后不再与其他进程共享')
+        for name in converted:
+            state_dict[name] = state_dict[name].to(torch_dtype)
+
+    missing, unexpected = model.load_state_dict(state_dict, strict=False, assign=True)
+    tied = set(getattr(model, '_tied_weights_keys', None) or ())
+    missing = [name for name in missing if name not in tied]
+    if missing or unexpected:
+        raise RuntimeError(f'checkpoint does not match the model: missing={missing[:5]} unexpected={unexpected[:5]}')
+    model.tie_weights()
+
+    try:
+        model.generation_config = GenerationConfig.from_pretrained(model_path)
+    except OSError:
+        pass  # 没有 generation_config.json 时沿用由 config 推出的默认值
+    return model.eval()
+
+
+def memory_usage() -> Dict[str, int]:
+    """当前进程的内存占用（MB）：resident 为常驻总量，shared 为与其他进程共用的部分（多副本共享的权重在这里），
+    private 为本进程独占的部分，pss 按共享进程数均摊后的占用。读不到 /proc 时返回空字典。
+    """
+    fields = {}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[1].isdigit():
+                    fields[parts[0].rstrip(':')] = int(parts[1])
+    except OSError:
+        return {}
+    to_mb = 1024
+    return {
+        'resident': fields.get('Rss', 0) // to_mb,
+        'shared': (fields.get('Shared_Clean', 0) + fields.get('Shared_Dirty', 0)) // to_mb,
+        'private': (fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0)) // to_mb,
+        'pss': fields.get('Pss', 0) // to_mb,
+    }
+
+
+def log_load(mode: str, started_at: float) -> None:
+    usage = memory_usage()
+    summary = ' '.join(f'{key}={value}MB' for key, value in usage.items())
+    LOGGER.info(f'模型权重加载完成（{mode}），耗时 {time.perf_counter() - started_at:.2f}s {summary}')
@@ -1,51 +1,208 @@
 from gevent import monkey
 monkey.patch_all()
 
-from flask import Flask, request, jsonify, make_response, Response
+from flask import Flask, request, jsonify, make_response, Response, stream_with_context
 import base64
 import mimetypes
 import json
-from chatbot import *
 from flask_cors import CORS
 import uuid
-from gevent.pywsgi import WSGIServer
+import socket
+from gevent.pywsgi import WSGIHandler, WSGIServer
+from gevent.socket import wait_read
 import configargparse
-from model import qw_model
 from logger import MyLogger
 import os
 from settings import settings_manager
+from streaming import sse_event
+from scheduler import CancelToken, QueueFullError
+from replica import RemoteBot, ReplicaRouter, ReplicaUnavailableError
+from upload_store import StreamingUploadRequest, UploadStore
+from startup import STARTUP
+import metrics
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+import gevent
 
 
 LOGGER: MyLogger = MyLogger()
 
 
-parser = configargparse.ArgParser(description='Configuration for the server')
+parser = configargparse.ArgParser(description='Configuration for the server',
+                                  ignore_unknown_config_file_keys=True)
 parser.add_argument('-c', '--config', is_config_file=True,
                     help='config file path', default='./config/config.ini')
 parser.add_argument('--origins', nargs='+', help='List of allowed origins', required=True)
 parser.add_argument('--model_path', help='Path of the model')
 parser.add_argument('--bot_type', help='Type of the bot')
-args = parser.parse_args()
+parser.add_argument('--replica_addresses', nargs='*', default=[],
+                    help='host:port of inference replicas; when set this process only serves HTTP and loads no model')
+parser.add_argument('--replica_timeout', type=float, default=600, help='Seconds to wait for a replica reply')
+parser.add_argument('--http_workers', type=int, default=1,
+                    help='HTTP worker processes sharing the listening socket, only used with replica_addresses')
+parser.add_argument('--upload_dir', default='./uploads', help='Directory of uploaded media files')
+parser.add_argument('--upload_max_mb', type=int, default=200, help='Maximum size of one uploaded file')
+parser.add_argument('--upload_ttl_days', type=float, default=7, help='Uploaded files unused for this long are deleted')
+parser.add_argument('--upload_max_total_mb', type=int, default=10240,
+                    help='Oldest uploads are deleted when the upload directory grows beyond this')
+parser.add_argument('--upload_predecode', action='store_true',
+                    help='Decode and preprocess uploaded media in the background right after upload')
+# 模型相关的参数由 model.py 解析
+args, _ = parser.parse_known_args()
 
 
+upload_store = UploadStore(args.upload_dir, args.upload_max_mb << 20, args.upload_ttl_days * 86400,
+                           args.upload_max_total_mb << 20)
+StreamingUploadRequest.upload_store = upload_store
+
 app: Flask = Flask(__name__)
 app.secret_key = '123456'  # 使用一个更复杂的密钥
+app.request_class = StreamingUploadRequest
 
 CORS(app, resources={r"/*": {
     'origins': args.origins,
     "supports_credentials": True
 }})
 
-chatbot_shop: BotShop = BotShop(ChatBot)
-astronomy_bot_shop: BotShop = BotShop(AstronomyBot)
-chatbot: ChatBot = chatbot_shop.buy_bot(qw_model=qw_model, max_history=8)
-astronomy_chatbot: AstronomyBot = astronomy_bot_shop.buy_bot(
-    qw_model=qw_model, max_history=8)
-electricity_shop: BotShop = BotShop(ElectricityBot)
-electricity_bot: ElectricityBot = electricity_shop.buy_bot(
-    qw_model=qw_model, max_history=8)
-mechanics_shop: BotShop = BotShop(MechanicsBot)
-mechanics_bot: MechanicsBot = mechanics_shop.buy_bot(qw_model=qw_model, max_history=8)
+if args.replica_addresses:
+    # 前端模式：本进程不加载模型，请求按会话归属和负载转发给推理副本（replica.py）
+    router = ReplicaRouter(args.replica_addresses, timeout=args.replica_timeout)
+    chatbot = RemoteBot(router, 'normal')
+    astronomy_chatbot = RemoteBot(router, 'astronomy')
+    electricity_bot = RemoteBot(router, 'electricity')
+    mechanics_bot = RemoteBot(router, 'mechanics')
+
+    def predecode_media(item):
+        try:
+            router.warm_media(item)
+        except Exception as e:
+            LOGGER.warning(f'预解码请求失败: {e}')
+
+    predecode_media_async = lambda item: gevent.spawn(predecode_media, item)
+    # 推理指标在副本里统计，抓取时逐个取回，每个 HTTP worker 输出的都是全部副本的数据
+    REGISTRY.register(metrics.InferenceCollector(router.metrics))
+    # 本进程不加载模型，是否可用看副本（/readyz 里检查）
+    STARTUP.mark_ready()
+else:
+    from chatbot import *
+    import model
+
+    chatbot = astronomy_chatbot = electricity_bot = mechanics_bot = None
+
+    def load_local_bots() -> None:
+        """后台加载模型并预热，期间 HTTP 服务已经启动，/healthz 正常、/readyz 返回 503"""
+        global chatbot, astronomy_chatbot, electricity_bot, mechanics_bot
+        try:
+            # 加载权重是长时间的阻塞调用，放到线程池里，事件循环继续响应健康检查
+            qw_model = gevent.get_hub().threadpool.apply(model.get_model)
+            chatbot_shop: BotShop = BotShop(ChatBot)
+            astronomy_bot_shop: BotShop = BotShop(AstronomyBot)
+            chatbot = chatbot_shop.buy_bot(qw_model=qw_model, max_history=8)
+            astronomy_chatbot = astronomy_bot_shop.buy_bot(qw_model=qw_model, max_history=8)
+            electricity_shop: BotShop = BotShop(ElectricityBot)
+            electricity_bot = electricity_shop.buy_bot(qw_model=qw_model, max_history=8)
+            mechanics_shop: BotShop = BotShop(MechanicsBot)
+            mechanics_bot = mechanics_shop.buy_bot(qw_model=qw_model, max_history=8)
+            # 预热请求经调度器生成，在协程里等待即可
+            qw_model.warm_up()
+            metrics.watch({'normal': chatbot, 'astronomy': astronomy_chatbot,
+                           'electricity': electricity_bot, 'mechanics': mechanics_bot}, qw_model.engine)
+        except Exception as e:
+            STARTUP.error = STARTUP.error or repr(e)
+            LOGGER.exception(f'模型加载失败: {e}')
+            return
+        STARTUP.mark_ready()
+
+    startup_greenlet = gevent.spawn(load_local_bots)
+    REGISTRY.register(metrics.InferenceCollector(lambda: {'local': metrics.snapshot()}))
+
+    # 解码和预处理是 CPU 密集的，放到 gevent 的线程池里，不阻塞其他请求
+    predecode_media_async = lambda item: gevent.get_hub().threadpool.spawn(model.get_model().engine.warm_media, item)
+
+class ChatHandler(WSGIHandler):
+    """把连接的 socket 放进 environ，生成期间据此发现客户端已经断开"""
+
+    def get_environ(self):
+        environ = super().get_environ()
+        environ['chatbot.socket'] = self.socket
+        return environ
+
+
+def _wait_disconnect(sock, cancel_token: CancelToken) -> None:
+    # 请求体已经读完，连接再变为可读只能是客户端关闭了连接，或者 keep-alive 连接上的下一个请求（此时不再监视）
+    try:
+        wait_read(sock.fileno())
+        closed = sock.recv(1, socket.MSG_PEEK) == b''
+    except OSError:
+        closed = True
+    if closed:
+        cancel_token.cancel()
+
+
+def watch_disconnect(cancel_token: CancelToken):
+    """客户端断开时取消 cancel_token，返回监视的协程，请求结束时 kill；不是经 ChatHandler 进来的请求返回 None"""
+    sock = request.environ.get('chatbot.socket')
+    if sock is None:
+        return None
+    return gevent.spawn(_wait_disconnect, sock, cancel_token)
+
+
+# 这些接口要用到模型，加载和预热完成之前直接返回 503
+_MODEL_ENDPOINTS = {'update_settings', 'update_prompt', 'generate_response', 'reset_history'}
+
+
+@app.before_request
+def reject_until_ready():
+    if STARTUP.ready or request.method == 'OPTIONS' or request.endpoint not in _MODEL_ENDPOINTS:
+        return None
+    response = make_response(jsonify({'error': '服务正在启动，请稍后重试', 'phase': STARTUP.current}), 503)
+    response.headers['Retry-After'] = '5'
+    response.headers.add('Access-Control-Allow-Origin', request.headers.get('Origin', '*'))
+    response.headers.add('Access-Control-Allow-Credentials', 'true')
+    return response
+
+
+@app.route('/healthz', methods=['GET'])
+def liveness():
+    """存活检查：进程能响应即可；模型加载失败时返回 500，让编排系统重启进程"""
+    if STARTUP.error:
+        return jsonify({'status': 'failed', 'error': STARTUP.error}), 500
+    return jsonify({'status': 'alive'})
+
+
+@app.route('/readyz', methods=['GET'])
+def readiness():
+    """就绪检查：模型加载并预热完成后返回 200，附带启动各阶段的耗时；前端模式下至少有一个副本可连接"""
+    report = STARTUP.report()
+    if args.replica_addresses:
+        report['replicas'] = router.reachable()
+        report['ready'] = report['replicas'] > 0
+    return jsonify(report), 200 if report['ready'] else 503
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus 抓取接口：各 Bot 的排队、首 token、总延迟、token 数和生成速度分布，会话数、队列状态和内存占用"""
+    return Response(generate_latest(REGISTRY), content_type=CONTENT_TYPE_LATEST)
+
+
+@app.errorhandler(QueueFullError)
+def handle_queue_full(error: QueueFullError):
+    """推理队列已满时返回 429，提示客户端稍后重试"""
+    response = make_response(jsonify({'error': '服务繁忙，请稍后重试', 'retry_after': error.retry_after}), 429)
+    response.headers['Retry-After'] = str(error.retry_after)
+    response.headers.add('Access-Control-Allow-Origin', request.headers.get('Origin', '*'))
+    response.headers.add('Access-Control-Allow-Credentials', 'true')
+    return response
+
+
+@app.errorhandler(ReplicaUnavailableError)
+def handle_replica_unavailable(error: ReplicaUnavailableError):
+    """推理副本都连不上时返回 503"""
+    LOGGER.error(f'推理副本不可用: {error}')
+    response = make_response(jsonify({'error': '推理服务暂不可用，请稍后重试'}), 503)
+    response.headers.add('Access-Control-Allow-Origin', request.headers.get('Origin', '*'))
+    response.headers.add('Access-Control-Allow-Credentials', 'true')
+    return response
 
 @app.route('/settings', methods=['GET'])
 def get_settings():
@@ -138,6 +295,7 @@ def upload_file():
         response.headers.add('Access-Control-Allow-Credentials', 'true')
         return response
 
+    # 文件边接收边写入上传目录并计算哈希，超过 upload_max_mb 时直接返回 413（见 StreamingUploadRequest.max_content_length）
     if 'file' not in request.files:
         return jsonify({'error': 'No file uploaded'}), 400
 
@@ -150,30 +308,30 @@ def upload_file():
     if not mimetype or not (mimetype.startswith('video/') or mimetype.startswith('image/')):
         return jsonify({'error': 'Only video and image files are supported'}), 400
 
-    # 保存文件到本地
-    upload_dir = './uploads'
-    os.makedirs(upload_dir, exist_ok=True)
-    file_ext = os.path.splitext(file.filename)[1]
-    save_name = f"{uuid.uuid4().hex}{file_ext}"
-    save_path = os.path.join(upload_dir, save_name)
-    file.save(save_path)
+    # 按内容保存，相同文件只存一份
+    save_path, duplicate = upload_store.commit(file.stream, file.filename)
+    digest = os.path.splitext(os.path.basename(save_path))[0]
 
     # 返回本地文件路径（file:// 协议）
-    file_url = f"file://{os.path.abspath(save_path)}"
+    file_url = f"file://{save_path}"
     file_type = 'video' if mimetype.startswith('video/') else 'image'
+    if args.upload_predecode and STARTUP.ready:
+        # 提前解码，之后 /chat 引用这个文件时直接命中媒体缓存
+        predecode_media_async({'type': file_type, file_type: file_url})
+    LOGGER.info(f'上传文件: {file.filename} -> {save_path} duplicate={duplicate}')
 
     return jsonify({
         'success': True,
-        'file_id': str(uuid.uuid4()),
+        'file_id': digest,
         'file_type': file_type,
         'file_path': file_url,  # 这里返回本地路径
-        'mimetype': mimetype
+        'mimetype': mimetype,
+        'duplicate': duplicate
     })
 
 @app.route('/chat', methods=['POST', 'OPTIONS'])
 def generate_response():
     if request.method == 'OPTIONS':
-        print("收到OPTIONS预检请求")
         response = make_response()
         response.headers.add('Access-Control-Allow-Origin',
                              request.headers.get('Origin', '*'))
@@ -182,26 +340,25 @@ def generate_response():
         response.headers.add('Access-Control-Allow-Credentials', 'true')
         return response
     
-    print('====收到的原始请求体====')
-    print(request.get_data(as_text=True))  # 新增，打印原始body
     data = request.json
     system_prompt = data.get('system_prompt', None)
-    LOGGER.info(f"system_prompt: {system_prompt}")
-    print("收到的数据：", data)
+    # 请求里是用户内容，只在 debug 级别记录；请求数和耗时见 /metrics
+    LOGGER.debug(f"system_prompt: {system_prompt}")
     
     bot_type = data.get('bot_type', {'value': 'normal'}).get('value', 'normal')
     messages = data.get('messages', [])
-    max_length = data.get('max_length', 100000)
+    # 不填时用各个 Bot 的 token 预算，填写的值也不会超过预算（config/generation_profiles.json）
+    max_length = data.get('max_length')
     current_message = data.get('currentMessage', '')
     user_id = request.cookies.get('user_id')
     
-    LOGGER.info(f'{user_id}:{current_message}')
+    LOGGER.debug(f'{user_id}:{current_message}')
     
     # 处理多模态消息（支持多文件）
     if isinstance(current_message, dict) and current_message.get('content'):
         if isinstance(current_message['content'], list):
             # 新的多文件格式
-            print(f"处理多文件消息: {len([item for item in current_message['content'] if item.get('type') in ['video', 'image']])} 个媒体文件")
+            LOGGER.debug(f"处理多文件消息: {len([item for item in current_message['content'] if item.get('type') in ['video', 'image']])} 个媒体文件")
             new_messages = [current_message]
         else:
             # 单文件格式（兼容性）
@@ -214,19 +371,34 @@ def generate_response():
     if not user_id:
         user_id = str(uuid.uuid4())
     
-    # 根据bot类型生成响应
+    # 根据bot类型选择机器人
     if bot_type == 'normal':
-        response = chatbot.generate_response(user_id, new_messages, max_length, system_prompt=system_prompt)
+        bot = chatbot
     elif bot_type == 'astronomy':
-        response = astronomy_chatbot.generate_response(user_id, new_messages, max_length, system_prompt=system_prompt)
+        bot = astronomy_chatbot
     elif bot_type == 'electricity':
-        response = electricity_bot.generate_response(user_id, new_messages, max_length, system_prompt=system_prompt)
+        bot = electricity_bot
     elif bot_type == 'mechanics':
-        response = mechanics_bot.generate_response(user_id, new_messages, 16000, system_prompt=system_prompt)
+        bot = mechanics_bot
     else:
         return jsonify({'error': 'Invalid bot type'}), 400
-    
-    resp = make_response(jsonify({'response': response, 'user_id': user_id}))
+
+    if data.get('stream', False):
+        return stream_chat_response(bot, user_id, new_messages, max_length, system_prompt)
+
+    # 学生关掉页面或客户端超时放弃时，生成在下一步 decode 之前停止，空出 batch 中的位置
+    cancel_token = CancelToken()
+    watcher = watch_disconnect(cancel_token)
+    try:
+        result = bot.reply(user_id, new_messages, max_length, system_prompt=system_prompt, cancel_token=cancel_token)
+    finally:
+        if watcher is not None:
+            watcher.kill()
+    if cancel_token.cancelled:
+        LOGGER.info(f"客户端已断开，取消生成: {user_id} {result['usage']}")
+    response = result['response']
+
+    resp = make_response(jsonify({'response': response, 'user_id': user_id, 'usage': result['usage']}))
     resp.headers.add('Access-Control-Allow-Origin',
                      request.headers.get('Origin', '*'))
     resp.headers.add('Access-Control-Allow-Credentials', 'true')
@@ -238,6 +410,42 @@ def generate_response():
     return resp
 
 
+def stream_chat_response(bot, user_id: str, new_messages, max_length: int, system_prompt) -> Response:
+    """以 Server-Sent Events 逐段返回生成结果，最后一条 done 事件携带 user_id 和用量统计"""
+    # 在返回响应之前提交请求，队列已满时 QueueFullError 交给 errorhandler 返回 429
+    cancel_token = CancelToken()
+    stream = bot.stream_response(user_id, new_messages, max_length, system_prompt=system_prompt,
+                                 cancel_token=cancel_token)
+    # 排队和 prefill 期间还没有输出，写不出数据就发现不了断开，所以同样监视连接
+    watcher = watch_disconnect(cancel_token)
+
+    def events():
+        try:
+            for event in stream:
+                if 'delta' in event:
+                    yield sse_event('token', {'delta': event['delta']})
+                else:
+                    LOGGER.info(f"bot: {user_id}->{event['response']}")
+                    yield sse_event('done', {'user_id': user_id, 'usage': event['usage']})
+        except Exception as e:
+            LOGGER.exception(f'流式生成失败: {e}')
+            yield sse_event('error', {'error': str(e), 'user_id': user_id})
+        finally:
+            # 写入失败（客户端断开）时 pywsgi 关闭本生成器；正常结束后取消不起作用
+            if watcher is not None:
+                watcher.kill()
+            cancel_token.cancel()
+
+    resp = Response(stream_with_context(events()), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'  # 避免反向代理缓冲整段输出
+    resp.headers.add('Access-Control-Allow-Origin',
+                     request.headers.get('Origin', '*'))
+    resp.headers.add('Access-Control-Allow-Credentials', 'true')
+    resp.set_cookie('user_id', user_id, httponly=True,
+                    secure=True, samesite='None', max_age=3600*24*30)
+    return resp
+
 
 @app.route('/reset', methods=['POST'])
 def reset_history():
@@ -252,5 +460,13 @@ def reset_history():
 
 if __name__ == '__main__':
     # app.run(host='0.0.0.0', port=5001, debug=True, use_reloader=False)
-    http_server = WSGIServer(('0.0.0.0', 5001), app)
+    http_server = WSGIServer(('0.0.0.0', 5001), app, handler_class=ChatHandler)
+    if args.http_workers > 1 and args.replica_addresses:
+        # 先绑定端口再 fork，各个 worker 共享同一个监听 socket，由内核分配连接
+        http_server.init_socket()
+        for _ in range(args.http_workers - 1):
+            if os.fork() == 0:
+                break
+    elif args.http_workers > 1:
+        LOGGER.warning('本进程加载了模型，http_workers 只在配置 replica_addresses 时生效')
     http_server.serve_forever()
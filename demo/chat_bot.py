@@ -36,7 +36,7 @@ if prompt := st.chat_input():
     st.session_state.messages.append({"role": "user", "content": prompt})
 
     input_ids = tokenizer.apply_chat_template(st.session_state.messages,tokenize=False,add_generation_prompt=True)
-    model_inputs = tokenizer([input_ids], return_tensors="pt").to('cuda')
+    model_inputs = tokenizer([input_ids], return_tensors="pt").to(model.device)
     generated_ids = model.generate(model_inputs.input_ids,max_new_tokens=max_length)
     generated_ids = [
         output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)